@@ -8,18 +8,49 @@ from bpy.types import Operator
 def reload_modules():
     print("reloading shits...")
     import importlib
+    from . import layout
+    importlib.reload(layout)
+    from . import instrument
+    importlib.reload(instrument)
+    from . import lmf
+    importlib.reload(lmf)
+    from . import welder
+    importlib.reload(welder)
+    from . import tangents
+    importlib.reload(tangents)
+    from . import snapshot
+    importlib.reload(snapshot)
+    from . import extract
+    importlib.reload(extract)
+    from . import cache
+    importlib.reload(cache)
     from . import builder
     importlib.reload(builder)
+    from . import optimize
+    importlib.reload(optimize)
+    from . import meshlet
+    importlib.reload(meshlet)
+    from . import simplify
+    importlib.reload(simplify)
+    from . import parallel
+    importlib.reload(parallel)
+    from . import pipeline
+    importlib.reload(pipeline)
+    from . import progress
+    importlib.reload(progress)
     from . import exporter
     importlib.reload(exporter)
 
-
 if "bpy" in locals():
     reload_modules()
 else:
     import bpy
     from . import builder
+    from . import cache
     from . import exporter
+    from . import optimize
+    from . import meshlet
+    from . import progress
 
 # the exporter
 bl_info = {
@@ -56,14 +87,46 @@ class LMFExporter(Operator, ExportHelper):
     vertex_has_bone: BoolProperty(name="Bone Weights+IDs", description="Bone Weights + ID for skeletal animation", default=(exporter.VTF_DEFAULT & exporter.VTF_BONE_DATA)!=0)
     vertex_has_tween: BoolProperty(name="Tween", description="XYZ vertex animation data", default=(exporter.VTF_DEFAULT & exporter.VTF_TWEEN)!=0)
 
+    # packed encodings (binary version 4+)
+    pack_positions: BoolProperty(name="Pack Positions", description="16 bit positions over the range of each mesh's vertices", default=False)
+    normal_encoding: EnumProperty(items=(
+        ('float', 'Float', '3x float32'),
+        ('oct16', 'Octahedral 2x16', 'Octahedral 2x snorm16'),
+        ('1010102', '10:10:10:2', 'snorm 10:10:10:2'),
+    ), name="Normal Encoding", description="How normals are stored", default='float')
+    pack_tangents: BoolProperty(name="Pack Tangents", description="10:10:10:2 tangent with the bitangent sign in w instead of tangent+bitangent floats (needs normals)", default=False)
+    uv_encoding: EnumProperty(items=(
+        ('float', 'Float', '2x float32'),
+        ('half', 'Half', '2x float16'),
+        ('unorm16', 'Unorm16', '2x unorm16 over the mesh uv range'),
+    ), name="UV Encoding", description="How uvs are stored", default='float')
+
     max_depth: IntProperty(name="Max Tree Depth", description="Maximum depth of the KD Tree", default=10, min=4, max=32)
     criterion: EnumProperty(items=(
         ('polycount', 'polycount', 'Triangle Count'),
         ('volume', 'volume', 'AABB Volume'),
         ('area', 'area', 'AABB Surface Area'),
         ('extent', 'extent', 'AABB Longest extent'),
+        ('budget', 'budget', 'Unique vertices + encoded bytes per leaf (Leaf Vertex/Byte Budget, threshold unused)'),
     ), name="Split Criterion", description="Split node based on what?", default="polycount")
     threshold: FloatProperty(name="Criterion Threshold", description="Maximum criterion value before splitting", default=1000, min=1)
+    split_strategy: EnumProperty(items=(
+        ('median', 'Median', 'Cut at the triangle median of the longest axis'),
+        ('sah', 'SAH', 'Cut at the cheapest binned surface area heuristic plane of all axes'),
+        ('spatial', 'Spatial (SBVH)', 'SAH, plus planes that cut through big triangles, which then go into both children (some triangles written twice, every leaf box still holds its whole triangles)'),
+    ), name="Split Strategy", description="Where to cut a node once the criterion says split", default="median")
+    sah_node_cost: FloatProperty(name="SAH Node Cost", description="Cost of visiting a node relative to drawing one triangle. Nodes whose best split isn't cheaper than drawing all their triangles become leaves", default=builder.SAH_NODE_COST, min=0)
+    max_duplication: FloatProperty(name="Max Duplication", description="Spatial splits may add at most this fraction of the triangle count as duplicates", default=builder.SPATIAL_MAX_DUPLICATION, min=0, max=4)
+
+    # vertex welding tolerance (0 = exact match)
+    weld_normal_tolerance: FloatProperty(name="Weld Normal Tolerance", description="Normals closer than this weld into one vertex (0 = exact)", default=0, min=0, max=1, precision=4)
+    weld_uv_tolerance: FloatProperty(name="Weld UV Tolerance", description="UVs closer than this weld into one vertex (0 = exact)", default=0, min=0, max=1, precision=5)
+
+    workers: IntProperty(name="Worker Processes", description="Extract and encode leaves in this many processes (0 = all cores, 1 = no pool)", default=1, min=0, max=256)
+    use_cache: BoolProperty(name="Leaf Cache", description="Reuse leaves that didn't change since the last export from a cache on disk", default=False)
+    cache_dir: StringProperty(name="Cache Directory", description="Where cached leaves go (empty = <file>.cache next to the exported file)", default="", subtype='DIR_PATH')
+    cache_max_mb: IntProperty(name="Cache Size (MB)", description="Least recently used leaves get dropped past this size", default=cache.CACHE_MAX_BYTES // (1024 * 1024), min=1)
+    use_temp_mesh: BoolProperty(name="Temp Mesh Fallback", description="Build a temporary blender mesh per leaf and extract that instead of slicing the source mesh data (slow)", default=False)
 
     write_mode: EnumProperty(
         items=(
@@ -74,6 +137,57 @@ class LMFExporter(Operator, ExportHelper):
         description="What kind of file output to write",
         default='ascii'
     )
+    format_version: EnumProperty(
+        items=(
+            ('1', "1 (Legacy)", "No version tag, meshes found by walking the block sizes"),
+            ('2', "2 (Mesh Directory)", "Version tag + offset/size of every mesh block after the nodes"),
+            ('3', "3 (Wide Indices)", "Mesh directory + 32 bit counts, u16 or u32 indices per mesh"),
+            ('4', "4 (Packed Vertices)", "Version 3 + packed vertex encodings with per mesh decode params"),
+            ('5', "5 (LODs)", "Version 4 + LOD mesh chains referenced from the node records"),
+            ('6', "6 (Compressed)", "Version 5 + optionally compressed mesh blocks, each on its own"),
+        ),
+        name="Binary Version",
+        description="Binary file format version",
+        default=str(exporter.LMF_VERSION)
+    )
+
+    compression: EnumProperty(items=(
+        ('none', 'None', 'Mesh blocks as they are, straight from the mapped file'),
+        ('zlib', 'zlib', 'Fast to decode, decent ratio'),
+        ('lzma', 'LZMA', 'Best ratio, slower to write and decode'),
+    ), name="Compression", description="Compress every mesh block on its own (binary version 6+), for files loaded over slow drives", default='none')
+    compression_level: IntProperty(name="Compression Level", description="zlib level / lzma preset, higher is smaller and slower to write", default=6, min=0, max=9)
+    compression_filters: BoolProperty(name="Shuffle + Delta", description="Byte shuffle vertices and delta encode indices before compressing, smaller on unique geometry, try without on heavily repeated (instanced) meshes", default=True)
+
+    leaf_max_vertices: IntProperty(name="Leaf Vertex Budget", description="Budget criterion: unique vertices per leaf after welding", default=0xFFFF, min=3)
+    leaf_max_kb: IntProperty(name="Leaf Byte Budget (KB)", description="Budget criterion: encoded mesh block size per leaf, meshlets not counted (0 = no limit)", default=0, min=0)
+    split_oversize: BoolProperty(name="Split Oversize Leaves", description="Keep splitting leaves until they fit 16 bit indices (and 16 bit counts for versions 1 and 2)", default=False)
+
+    optimize_vertex_cache: BoolProperty(name="Optimize Vertex Cache", description="Reorder triangles of every submesh for the GPU post-transform vertex cache (Tipsify)", default=False)
+    vertex_cache_size: IntProperty(name="Vertex Cache Size", description="Post-transform cache size to optimize and measure ACMR/ATVR for", default=optimize.VCACHE_SIZE, min=4, max=64)
+    optimize_vertex_fetch: BoolProperty(name="Optimize Vertex Fetch", description="Renumber vertices in first use order of the index buffer for fetch locality", default=False)
+    build_meshlets: BoolProperty(name="Build Meshlets", description="Cluster every leaf into meshlets with bounding spheres and normal cones (binary version 3+)", default=False)
+    meshlet_max_vertices: IntProperty(name="Meshlet Max Vertices", description="Unique vertices per meshlet", default=meshlet.MESHLET_MAX_VERTICES, min=3, max=255)
+    meshlet_max_triangles: IntProperty(name="Meshlet Max Triangles", description="Triangles per meshlet", default=meshlet.MESHLET_MAX_TRIANGLES, min=1, max=255)
+    build_lods: BoolProperty(name="Build LODs", description="Simplified LOD chain for every node, interior nodes aggregate their subtree (binary version 5+)", default=False)
+    lod_ratios: StringProperty(name="LOD Ratios", description="Comma separated triangle ratio per LOD level, each level simplifies the one below it in the tree again", default="0.5,0.25,0.125")
+
+    selection: EnumProperty(items=(
+        ('active', 'First Selected', 'Only the first selected object, in its local space'),
+        ('selected', 'All Selected', 'Every selected mesh object in world space, merged into one tree'),
+    ), name="Objects", description="Which objects go into the tree", default='active')
+    use_modifiers: BoolProperty(name="Apply Modifiers", description="Export the evaluated meshes (modifiers applied) without touching the objects", default=False)
+
+    log_level: EnumProperty(items=(
+        ('ERROR', 'Error', 'Errors only'),
+        ('WARN', 'Warning', 'Errors + warnings'),
+        ('INFO', 'Info', 'A few lines per export'),
+        ('DEBUG', 'Debug', 'Export settings and tree size too'),
+        ('TRACE', 'Trace', 'Every node and leaf (slow on deep trees)'),
+    ), name="Log Level", description="How much goes to the console", default='INFO')
+    profile: BoolProperty(name="Profile", description="Run the export under cProfile, stats go next to the file (.prof)", default=False)
+    write_stats: BoolProperty(name="Write Stats", description="Stage timings, counters and peak memory as json next to the file (.stats.json), also traces python memory", default=False)
+    use_background: BoolProperty(name="Background Export", description="Build the tree and write the file in a background thread, progress + ETA in the status bar, Esc cancels (blocks anyway with temp meshes or profiling)", default=True)
 
     def execute(self, context):
         # build a vertex format before executing
@@ -87,9 +201,103 @@ class LMFExporter(Operator, ExportHelper):
         if self.vertex_has_bone: format |= exporter.VTF_BONE_DATA
         if self.vertex_has_tween: format |= exporter.VTF_TWEEN
 
+        # packed encodings on top
+        if self.pack_positions: format |= exporter.VTF_PACK_POS16
+        if self.normal_encoding == 'oct16': format |= exporter.VTF_PACK_NORMAL_OCT16
+        if self.normal_encoding == '1010102': format |= exporter.VTF_PACK_NORMAL_1010102
+        if self.pack_tangents: format |= exporter.VTF_PACK_TANGENT
+        if self.uv_encoding == 'half': format |= exporter.VTF_PACK_UV_HALF
+        if self.uv_encoding == 'unorm16': format |= exporter.VTF_PACK_UV_UNORM16
+
+
+        # weld tolerances per attribute
+        tolerances = {
+            exporter.VTF_NORMAL: self.weld_normal_tolerance,
+            exporter.VTF_TANGENT_BITANGENT: self.weld_normal_tolerance,
+            exporter.VTF_UV0: self.weld_uv_tolerance,
+            exporter.VTF_UV1: self.weld_uv_tolerance,
+        }
+
+        cache_size = self.vertex_cache_size if self.optimize_vertex_cache else 0
+        meshlet_limits = None
+        if self.build_meshlets:
+            meshlet_limits = (self.meshlet_max_vertices, self.meshlet_max_triangles)
+
+        lod_ratios = None
+        if self.build_lods:
+            try:
+                lod_ratios = [float(r) for r in self.lod_ratios.split(",") if r.strip()]
+            except ValueError:
+                lod_ratios = []
+            if len(lod_ratios) == 0 or any(r <= 0 or r >= 1 for r in lod_ratios):
+                self.report({'ERROR'}, "LOD ratios must be a comma separated list of numbers between 0 and 1, got '%s'" % self.lod_ratios)
+                return {'CANCELLED'}
+
+        cache_dir = None
+        if self.use_cache:
+            cache_dir = bpy.path.abspath(self.cache_dir) if self.cache_dir else self.filepath + ".cache"
+
+        compression = None
+        if self.compression != 'none':
+            codec = exporter.COMPRESS_ZLIB if self.compression == 'zlib' else exporter.COMPRESS_LZMA
+            compression = (codec, self.compression_level, exporter.FILTER_DEFAULT if self.compression_filters else 0)
+
+        job = None
+        if self.use_background and self.canRunModal(context):
+            job = progress.ExportJob()
 
         # return do_write(context, self.filepath, format, self, self.write_mode)
-        return exporter.do_write_tree(context, self.filepath, format, self, self.max_depth, self.criterion, self.threshold, self.write_mode)
+        result = exporter.do_write_tree(context, self.filepath, format, self, self.max_depth, self.criterion, self.threshold, self.write_mode, tolerances, self.split_strategy, self.sah_node_cost, self.max_duplication, self.use_temp_mesh, self.workers, int(self.format_version), self.split_oversize, self.leaf_max_vertices, self.leaf_max_kb * 1024, cache_size, self.optimize_vertex_fetch, meshlet_limits, lod_ratios, cache_dir, self.cache_max_mb * 1024 * 1024, self.log_level, self.profile, self.write_stats, self.selection, self.use_modifiers, compression, job)
+        if result == {'RUNNING_MODAL'}:
+            self.startModal(context, job)
+        return result
+
+    # the thread needs a window to report to, temp meshes are bpy (not
+    # thread safe) and cProfile only sees the thread that started it
+    def canRunModal(self, context):
+        if bpy.app.background or context.window is None:
+            return False
+        return not (self.use_temp_mesh or self.profile)
+
+    def startModal(self, context, job):
+        self._job = job
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(0.1, window=context.window)
+        wm.progress_begin(0, 100)
+        wm.modal_handler_add(self)
+
+    def endModal(self, context):
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        wm.progress_end()
+        context.workspace.status_text_set(None)
+
+    # the export thread does the work, this just polls it on a timer
+    def modal(self, context, event):
+        job = self._job
+        if event.type == 'ESC' and event.value == 'PRESS':
+            if not job.isCancelled():
+                job.cancel()
+                self.report({'INFO'}, "Cancelling export...")
+            return {'RUNNING_MODAL'}
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+
+        for (kind, msg) in job.takeReports():
+            self.report(kind, msg)
+        if not job.isDone():
+            context.window_manager.progress_update(int(job.progress.fraction() * 100))
+            context.workspace.status_text_set(job.progress.status())
+            return {'PASS_THROUGH'}
+
+        self.endModal(context)
+        for (kind, msg) in job.takeReports():
+            self.report(kind, msg)
+        if job.error is not None:
+            self.report({'ERROR'}, "Export failed: %s" % job.error)
+        elif job.isCancelled() and job.result != {'FINISHED'}:
+            self.report({'INFO'}, "Export cancelled, nothing written to %s" % self.filepath)
+        return job.result
 
 
 # Only needed if you want to add into a dynamic menu
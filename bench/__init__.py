@@ -0,0 +1,13 @@
+"""
+Author: Bowie
+Headless benchmarks for the exporter, outside blender
+
+ - fakebpy.py: numpy stand-in for the bpy mesh API the exporter touches
+ - meshes.py: synthetic meshes (grid, terrain, props) by triangle count
+ - run.py: per stage timings, scaling curves, json results to compare
+   across commits
+
+Run it as a script, importing it through the addon package would pull
+in bpy before the fake one is there:
+    python bench/run.py --sizes 10k,100k,1M --json results.json
+"""
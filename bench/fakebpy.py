@@ -0,0 +1,231 @@
+import sys, types
+import numpy as np
+
+"""
+Author: Bowie
+Minimal numpy stand-in for the bits of bpy/bpy_types the exporter uses
+
+Only what MeshSnapshot, the temp mesh path (builder.createSplitMesh) and
+the addon's module level code touch:
+ - Mesh: vertices, polygons, loops, loop_triangles, uv_layers, materials
+   (foreach_get/foreach_set on all of them), from_pydata, calc_loop_triangles,
+   calc_normals_split, calc_tangents, normals_split_custom_set_from_vertices
+ - bpy.data.meshes.new/remove, bpy.app, bpy.path.abspath, bpy.props,
+   bpy.types.Operator, bpy_extras.io_utils.ExportHelper, bpy_types.Mesh
+
+Everything is vectorized so 10M triangle meshes build in seconds. Normals
+are area weighted vertex normals (smooth), tangents are per loop from the
+first uv layer, orthogonalized against the normal (not mikktspace, but
+the same cost shape).
+
+install() puts the fake modules in sys.modules, call it before importing
+the addon package.
+"""
+
+# a bpy_prop_collection look alike, attributes are numpy getters/setters
+class Collection:
+    def __init__(self, count, getters, setters=None):
+        self.count = count
+        self.getters = getters
+        self.setters = setters or {}
+
+    def __len__(self):
+        return self.count
+
+    def foreach_get(self, attr, buf):
+        buf[:] = np.asarray(self.getters[attr]()).ravel()
+
+    def foreach_set(self, attr, buf):
+        self.setters[attr](np.asarray(buf))
+
+class UVLayer:
+    def __init__(self, name, uv):
+        self.name = name
+        self.uv = uv
+
+    @property
+    def data(self):
+        def set_uv(buf):
+            self.uv = buf.reshape(-1, 2).astype(np.float32)
+        return Collection(len(self.uv), {"uv": lambda: self.uv}, {"uv": set_uv})
+
+class UVLayers(list):
+    def __init__(self, mesh):
+        super().__init__()
+        self.mesh = mesh
+
+    def new(self, name="UVMap"):
+        layer = UVLayer(name, np.zeros((len(self.mesh.loop_vertex), 2), dtype=np.float32))
+        self.append(layer)
+        return layer
+
+class Mesh:
+    def __init__(self, name):
+        self.name = name
+        self.co = np.zeros((0, 3), dtype=np.float32)
+        self.loop_vertex = np.zeros(0, dtype=np.int32)
+        self.loop_start = np.zeros(0, dtype=np.int32)
+        self.loop_total = np.zeros(0, dtype=np.int32)
+        self.face_material = np.zeros(0, dtype=np.int32)
+        self.materials = []
+        self.uv_layers = UVLayers(self)
+        self.use_auto_smooth = False
+
+        self.vertex_normals = None
+        self.loop_normals = None
+        self.loop_tangents = None
+        self.tri_loops = None
+        self.tri_material = None
+
+    # faces is a list of vertex index lists or a [face_count x n] array
+    def from_pydata(self, verts, edges, faces):
+        self.setGeometry(np.asarray(verts, dtype=np.float32).reshape(-1, 3), faces)
+
+    def setGeometry(self, co, faces):
+        self.co = np.ascontiguousarray(co, dtype=np.float32)
+        if isinstance(faces, np.ndarray) and faces.ndim == 2:
+            (count, size) = faces.shape
+            self.loop_vertex = faces.astype(np.int32).ravel()
+            self.loop_total = np.full(count, size, dtype=np.int32)
+        else:
+            self.loop_vertex = np.array([v for f in faces for v in f], dtype=np.int32)
+            self.loop_total = np.array([len(f) for f in faces], dtype=np.int32)
+        self.loop_start = np.zeros(len(self.loop_total), dtype=np.int32)
+        np.cumsum(self.loop_total[:-1], out=self.loop_start[1:])
+        self.face_material = np.zeros(len(self.loop_total), dtype=np.int32)
+        self.vertex_normals = None
+        self.loop_normals = None
+        self.loop_tangents = None
+        self.tri_loops = None
+
+    def normals_split_custom_set_from_vertices(self, normals):
+        self.vertex_normals = np.asarray(normals, dtype=np.float32).reshape(-1, 3)
+
+    @property
+    def vertices(self):
+        def set_co(buf):
+            self.co = buf.reshape(-1, 3).astype(np.float32)
+        return Collection(len(self.co), {"co": lambda: self.co}, {"co": set_co})
+
+    @property
+    def polygons(self):
+        def set_material(buf):
+            self.face_material = buf.astype(np.int32)
+        return Collection(len(self.loop_start), {
+            "material_index": lambda: self.face_material,
+            "loop_start": lambda: self.loop_start,
+            "loop_total": lambda: self.loop_total,
+        }, {"material_index": set_material})
+
+    @property
+    def loops(self):
+        return Collection(len(self.loop_vertex), {
+            "vertex_index": lambda: self.loop_vertex,
+            "normal": lambda: self.loop_normals,
+            "tangent": lambda: self.loop_tangents[0],
+            "bitangent": lambda: self.loop_tangents[1],
+            "bitangent_sign": lambda: self.loop_tangents[2],
+        })
+
+    @property
+    def loop_triangles(self):
+        return Collection(len(self.tri_loops), {
+            "loops": lambda: self.tri_loops,
+            "material_index": lambda: self.tri_material,
+            "vertices": lambda: self.loop_vertex[self.tri_loops],
+        })
+
+    # fan triangulation of every polygon
+    def calc_loop_triangles(self):
+        counts = np.maximum(self.loop_total - 2, 0)
+        poly = np.repeat(np.arange(len(counts)), counts)
+        # k = 1..total-2 within each polygon
+        first = np.repeat(np.cumsum(counts) - counts, counts)
+        k = np.arange(len(poly)) - first + 1
+        start = self.loop_start[poly]
+        self.tri_loops = np.column_stack((start, start + k, start + k + 1)).astype(np.int32)
+        self.tri_material = self.face_material[poly].astype(np.int32)
+
+    def calc_normals_split(self):
+        if self.vertex_normals is not None:
+            self.loop_normals = self.vertex_normals[self.loop_vertex]
+            return
+        if self.tri_loops is None:
+            self.calc_loop_triangles()
+        tris = self.loop_vertex[self.tri_loops]
+        p = self.co[tris].astype(np.float64)
+        n = np.cross(p[:, 1] - p[:, 0], p[:, 2] - p[:, 0])
+        vn = np.zeros((len(self.co), 3))
+        for axis in range(3):
+            for corner in range(3):
+                vn[:, axis] += np.bincount(tris[:, corner], n[:, axis], minlength=len(self.co))
+        vn /= np.maximum(np.linalg.norm(vn, axis=1, keepdims=True), 1e-12)
+        self.loop_normals = vn[self.loop_vertex].astype(np.float32)
+
+    def calc_tangents(self):
+        if len(self.uv_layers) == 0:
+            raise RuntimeError("Tangent space can only be computed on a mesh with uvs")
+        if self.tri_loops is None:
+            self.calc_loop_triangles()
+        self.calc_normals_split()
+        tl = self.tri_loops
+        p = self.co[self.loop_vertex[tl]].astype(np.float64)
+        uv = self.uv_layers[0].uv[tl].astype(np.float64)
+        e1 = p[:, 1] - p[:, 0]
+        e2 = p[:, 2] - p[:, 0]
+        d1 = uv[:, 1] - uv[:, 0]
+        d2 = uv[:, 2] - uv[:, 0]
+        r = d1[:, 0] * d2[:, 1] - d2[:, 0] * d1[:, 1]
+        r = np.where(np.abs(r) < 1e-12, 1.0, r)
+        t = (e1 * d2[:, 1:2] - e2 * d1[:, 1:2]) / r[:, None]
+
+        lcount = len(self.loop_vertex)
+        lt = np.zeros((lcount, 3))
+        for axis in range(3):
+            for corner in range(3):
+                lt[:, axis] += np.bincount(tl[:, corner], t[:, axis], minlength=lcount)
+        n = self.loop_normals.astype(np.float64)
+        lt -= n * (lt * n).sum(axis=1, keepdims=True)
+        lt /= np.maximum(np.linalg.norm(lt, axis=1, keepdims=True), 1e-12)
+        sign = np.ones(lcount, dtype=np.float32)
+        bt = np.cross(n, lt) * sign[:, None]
+        self.loop_tangents = (lt.astype(np.float32), bt.astype(np.float32), sign)
+
+class Meshes(list):
+    def new(self, name):
+        m = Mesh(name)
+        self.append(m)
+        return m
+
+    def remove(self, mesh=None):
+        super().remove(mesh)
+
+# register the fake modules, return the fake bpy
+def install():
+    if "bpy" in sys.modules:
+        return sys.modules["bpy"]
+    bpy = types.ModuleType("bpy")
+    bpy.data = types.SimpleNamespace(meshes=Meshes())
+    bpy.app = types.SimpleNamespace(version=(2, 93, 0), background=True)
+    bpy.path = types.SimpleNamespace(abspath=lambda p: p)
+    bpy.utils = types.SimpleNamespace(register_class=lambda c: None, unregister_class=lambda c: None)
+
+    bpy.props = types.ModuleType("bpy.props")
+    for name in ("StringProperty", "BoolProperty", "EnumProperty", "FloatProperty", "IntProperty"):
+        setattr(bpy.props, name, lambda **kw: None)
+    bpy.types = types.ModuleType("bpy.types")
+    bpy.types.Operator = type("Operator", (), {})
+
+    bpy_extras = types.ModuleType("bpy_extras")
+    bpy_extras.io_utils = types.ModuleType("bpy_extras.io_utils")
+    bpy_extras.io_utils.ExportHelper = type("ExportHelper", (), {})
+
+    bpy_types = types.ModuleType("bpy_types")
+    bpy_types.Mesh = Mesh
+
+    sys.modules.update({
+        "bpy": bpy, "bpy.props": bpy.props, "bpy.types": bpy.types,
+        "bpy_extras": bpy_extras, "bpy_extras.io_utils": bpy_extras.io_utils,
+        "bpy_types": bpy_types,
+    })
+    return bpy
@@ -0,0 +1,129 @@
+import numpy as np
+
+try:
+    from . import fakebpy
+except ImportError:
+    # run as a plain script out of bench/
+    import fakebpy
+
+"""
+Author: Bowie
+Synthetic meshes for the benchmarks, sized by triangle count
+
+ - grid: flat-ish sine wave grid of quads, two materials in halves
+ - terrain: grid displaced by a few octaves of value noise, four
+   materials by height
+ - props: scattered boxes (split normals + uvs per face, like modeled
+   props), random size/rotation/material, over a ground grid
+
+All of them are quads (so loop triangulation runs too) with one uv
+layer, and come out of a seed so every run builds the same mesh.
+"""
+
+GENERATORS = ("grid", "terrain", "props")
+
+# quad grid of (n x n) cells over [0, size]^2, z from height(x, y)
+# return (co, quads, uv)
+def grid_arrays(n, size, height):
+    xs = np.linspace(0, size, n + 1)
+    (x, y) = np.meshgrid(xs, xs)
+    co = np.column_stack((x.ravel(), y.ravel(), height(x, y).ravel()))
+    j = np.arange(n)
+    a = (j[:, None] * (n + 1) + j[None, :]).ravel()
+    quads = np.column_stack((a, a + 1, a + n + 2, a + n + 1))
+    uv = co[:, :2] / size
+    return (co, quads, uv)
+
+def grid_size(tris):
+    return max(1, int(np.sqrt(tris / 2)))
+
+# mesh out of arrays, uvs per vertex get spread to the loops
+def make_mesh(name, co, faces, uv, face_material, material_count):
+    m = fakebpy.Mesh(name)
+    m.setGeometry(co, faces)
+    m.face_material = face_material.astype(np.int32)
+    m.materials = ["%s_mat%d" % (name, i) for i in range(material_count)]
+    layer = m.uv_layers.new("UVMap")
+    layer.uv = uv[m.loop_vertex].astype(np.float32)
+    return m
+
+def grid(tris, seed=0):
+    n = grid_size(tris)
+    (co, quads, uv) = grid_arrays(n, 100.0, lambda x, y: np.sin(x * 0.3) * np.cos(y * 0.3) * 2)
+    mats = (np.arange(len(quads)) * 2 // len(quads))
+    return make_mesh("grid", co, quads, uv, mats, 2)
+
+# value noise, octaves of a random lattice bilinearly interpolated
+def value_noise(x, y, seed, octaves=5):
+    rng = np.random.default_rng(seed)
+    out = np.zeros_like(x)
+    amplitude = 1.0
+    frequency = 1.0 / 32
+    for _ in range(octaves):
+        lattice = rng.random((257, 257))
+        fx = (x * frequency) % 256
+        fy = (y * frequency) % 256
+        (ix, iy) = (fx.astype(np.int64), fy.astype(np.int64))
+        (tx, ty) = (fx - ix, fy - iy)
+        # smoothstep
+        tx = tx * tx * (3 - 2 * tx)
+        ty = ty * ty * (3 - 2 * ty)
+        a = lattice[iy, ix] * (1 - tx) + lattice[iy, ix + 1] * tx
+        b = lattice[iy + 1, ix] * (1 - tx) + lattice[iy + 1, ix + 1] * tx
+        out += (a * (1 - ty) + b * ty) * amplitude
+        amplitude *= 0.5
+        frequency *= 2
+    return out
+
+def terrain(tris, seed=0):
+    n = grid_size(tris)
+    (co, quads, uv) = grid_arrays(n, 1000.0, lambda x, y: value_noise(x, y, seed) * 60)
+    h = co[quads[:, 0], 2]
+    mats = np.clip((h - h.min()) / max(np.ptp(h), 1e-6) * 4, 0, 3).astype(np.int32)
+    return make_mesh("terrain", co, quads, uv, mats, 4)
+
+# unit box, 6 quads with their own 4 corners each (split normals/uvs)
+BOX_CORNERS = np.array([
+    [0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0],
+    [0, 0, 1], [1, 0, 1], [1, 1, 1], [0, 1, 1],
+], dtype=np.float64) - 0.5
+BOX_FACES = np.array([
+    [0, 3, 2, 1], [4, 5, 6, 7], [0, 1, 5, 4],
+    [1, 2, 6, 5], [2, 3, 7, 6], [3, 0, 4, 7],
+])
+BOX_UV = np.array([[0, 0], [1, 0], [1, 1], [0, 1]], dtype=np.float64)
+
+def props(tris, seed=0):
+    rng = np.random.default_rng(seed)
+    # a quarter of the triangles in the ground, the rest in boxes
+    n = grid_size(tris // 4)
+    (gco, gquads, guv) = grid_arrays(n, 500.0, lambda x, y: np.zeros_like(x))
+    count = max(1, (tris - 2 * len(gquads)) // 12)
+
+    # every box face gets its own 4 vertices
+    corners = BOX_CORNERS[BOX_FACES].reshape(-1, 3)
+    scale = rng.uniform(0.5, 8, (count, 3))
+    angle = rng.uniform(0, 2 * np.pi, count)
+    (c, s) = (np.cos(angle), np.sin(angle))
+    rot = np.zeros((count, 3, 3))
+    rot[:, 0, 0] = c
+    rot[:, 0, 1] = -s
+    rot[:, 1, 0] = s
+    rot[:, 1, 1] = c
+    rot[:, 2, 2] = 1
+    offset = np.column_stack((rng.uniform(0, 500, (count, 2)), scale[:, 2] * 0.5))
+    bco = np.einsum('nij,nkj->nki', rot, corners[None, :, :] * scale[:, None, :]) + offset[:, None, :]
+    bquads = np.arange(count * 24).reshape(count * 6, 4) + len(gco)
+    buv = np.tile(BOX_UV, (count * 6, 1))
+
+    co = np.concatenate((gco, bco.reshape(-1, 3)))
+    quads = np.concatenate((gquads, bquads))
+    uv = np.concatenate((guv, buv))
+    mats = np.concatenate((np.zeros(len(gquads), dtype=np.int32), np.repeat(rng.integers(1, 4, count), 6)))
+    return make_mesh("props", co, quads, uv, mats, 4)
+
+# mesh by generator name
+def generate(kind, tris, seed=0):
+    if kind not in GENERATORS:
+        raise Exception("Unknown mesh generator '%s', have %s" % (kind, ", ".join(GENERATORS)))
+    return globals()[kind](tris, seed)
@@ -0,0 +1,346 @@
+import os, sys, io, json, time, math, argparse, platform, tempfile, importlib, contextlib, subprocess
+import numpy as np
+
+try:
+    from . import fakebpy, meshes
+except ImportError:
+    # run as a plain script out of bench/
+    import fakebpy, meshes
+
+"""
+Author: Bowie
+Headless exporter benchmark, no blender needed
+
+    python bench/run.py --meshes grid,terrain --sizes 10k,100k,1M --json before.json
+    python bench/run.py --sizes 10k,100k,1M --compare before.json
+
+Installs the fake bpy (fakebpy.py), imports the addon package from the
+directory above and times every stage on synthetic meshes (meshes.py):
+ - snapshot: MeshSnapshot (loop triangles, normals, tangents, foreach_get)
+ - tangents (tangent formats only): the numpy tangent frames (tangents.py)
+   of the whole snapshot, what meshes calc_tangents refuses go through
+ - tree: KDTreeNode build
+ - split: builder.splitMeshData of every good leaf
+ - temp_mesh (--temp-mesh only): createSplitMesh + delete of every leaf
+ - extract: LeafPipeline extraction (+ optimize/meshlets when asked)
+ - encode: LeafPipeline.encode of every leaf
+ - write: write_binary end to end (extracts again, plus the file I/O,
+   plus compressing the blocks with --compress)
+ - decode: LMFStream over the written file, every block read (and
+   decompressed), printed as MB/s of mesh blocks along with the ratio
+
+--check-tree also rebuilds the tree the way the builder did before it
+went numpy (a stable sort on the split axis per node, centroids in double
+precision) and checks the median tree is still the same, node boxes and
+leaf triangle order included.
+
+Every stage takes the best of --repeat runs. Sizes give scaling curves,
+the exponent between two sizes being log(t2/t1) / log(n2/n1) (1 = linear).
+Results go to --json along with the git commit, --compare prints the
+ratio against an older json per stage (< 1 = faster now).
+"""
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+STAGES = ("snapshot", "tangents", "tree", "split", "temp_mesh", "extract", "encode", "write", "decode")
+
+# import the addon package with the fake bpy in place
+def load_package():
+    fakebpy.install()
+    sys.path.insert(0, os.path.dirname(ROOT))
+    name = os.path.basename(ROOT)
+    pkg = importlib.import_module(name)
+    for sub in ("layout", "extract", "builder", "pipeline", "exporter", "snapshot", "lmf"):
+        setattr(pkg, sub, importlib.import_module(name + "." + sub))
+    return pkg
+
+# "10k" -> 10000, "1M" -> 1000000
+def parse_size(s):
+    s = s.strip()
+    mult = {"k": 1000, "K": 1000, "m": 1000000, "M": 1000000}.get(s[-1:], 1)
+    if mult != 1:
+        s = s[:-1]
+    return int(float(s) * mult)
+
+# "zlib:9" -> (codec, level, filters), "none" -> None
+def parse_compression(pkg, s, filters=True):
+    layout = pkg.layout
+    (name, _, level) = s.partition(":")
+    codecs = dict((v, k) for (k, v) in layout.COMPRESS_NAMES.items())
+    if name not in codecs:
+        raise Exception("Unknown codec '%s' (%s)" % (name, ", ".join(codecs)))
+    if codecs[name] == layout.COMPRESS_NONE:
+        return None
+    return (codecs[name], int(level) if level else 6, layout.FILTER_DEFAULT if filters else 0)
+
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+# collects what the exporter reports instead of a blender operator
+class Reporter:
+    def __init__(self):
+        self.messages = []
+
+    def report(self, kind, msg):
+        self.messages.append((sorted(kind), msg))
+
+# best wall time of fn over repeat runs, return (seconds, last result)
+# exporter print spam goes nowhere unless verbose
+def timed(fn, repeat=1, verbose=False):
+    best = None
+    result = None
+    for _ in range(repeat):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(sys.stdout if verbose else out):
+            t = time.perf_counter()
+            result = fn()
+            dt = time.perf_counter() - t
+        best = dt if best is None else min(best, dt)
+    return (best, result)
+
+def vertex_format(pkg, name):
+    layout = pkg.layout
+    if name == "default":
+        return layout.VTF_DEFAULT
+    if name == "tan":
+        return layout.VTF_DEFAULT | layout.VTF_TANGENT_BITANGENT
+    if name == "pos":
+        return layout.VTF_POS
+    raise Exception("Unknown vertex format '%s' (default, tan, pos)" % name)
+
+# the original median tree out of plain sorts, as nested
+# (aabb_min, aabb_max, children or leaf triangles)
+def reference_tree(snap, max_polys, max_depth, criterion):
+    p = snap.triPositions().astype(np.float64)
+    tmin = p.min(axis=1)
+    tmax = p.max(axis=1)
+    centroid = (p[:, 0] + p[:, 1] + p[:, 2]) / 3.0
+
+    def build(tris, depth):
+        lo = tmin[tris].min(axis=0)
+        hi = tmax[tris].max(axis=0)
+        (w, h, d) = hi - lo
+        axis = 0 if w > h and w > d else (1 if h > w and h > d else 2)
+        tris = tris[np.argsort(centroid[tris, axis], kind='stable')]
+        value = {
+            "volume": w * h * d,
+            "area": 2 * (w * h + h * d + w * d),
+            "extent": max(w, h, d),
+        }.get(criterion, len(tris))
+        if depth >= max_depth or not value > max_polys:
+            return (lo, hi, tris)
+        median = len(tris) // 2
+        return (lo, hi, (build(tris[:median], depth + 1), build(tris[median:], depth + 1)))
+    return build(np.arange(snap.triCount()), 0)
+
+# does the builder's tree match reference_tree? returns mismatch count
+def check_tree(tree, ref):
+    mismatches = 0
+    queue = [(tree, ref)]
+    while len(queue):
+        (n, (lo, hi, rest)) = queue.pop()
+        if not (np.array_equal(n.aabb.min, lo) and np.array_equal(n.aabb.max, hi)):
+            mismatches += 1
+        if isinstance(rest, tuple):
+            if n.isLeaf():
+                mismatches += 1
+                continue
+            queue += list(zip(n.children, rest))
+        elif not n.isLeaf() or not np.array_equal(n.polys, rest):
+            mismatches += 1
+    return mismatches
+
+# time every stage on one mesh, return the run's dict
+def bench_mesh(pkg, kind, target, args):
+    builder = pkg.builder
+    pipeline = pkg.pipeline
+    exporter = pkg.exporter
+    format = vertex_format(pkg, args.format)
+    tangents = (format & pkg.layout.VTF_TANGENT_BITANGENT) != 0
+    meshlet_limits = (64, 124) if args.meshlets else None
+    compression = parse_compression(pkg, args.compress, not args.no_filters)
+    stages = {}
+
+    (stages["generate"], mesh) = timed(lambda: meshes.generate(kind, target, args.seed))
+    (stages["snapshot"], snap) = timed(lambda: pkg.snapshot.MeshSnapshot(mesh, tangents), args.repeat)
+    if tangents:
+        (stages["tangents"], _) = timed(snap.computeTangents, args.repeat)
+    leaf_test = None
+    if args.criterion == "budget":
+        leaf_test = pkg.extract.leaf_budget(snap, format, None, args.version, args.leaf_vertices, args.leaf_kb * 1024)
+    (stages["tree"], tree) = timed(lambda: builder.KDTreeNode(args.threshold, args.depth, args.criterion, snap, True, args.strategy, leaf_fits=leaf_test, max_duplication=args.max_duplication), args.repeat, args.verbose)
+    leaves = builder.collectGoodLeaves(tree)
+    (overlap, duplicated) = builder.treeOverlap(tree, snap.triCount())
+    tree_mismatches = None
+    if args.check_tree:
+        if args.strategy != "median" or args.criterion == "budget":
+            raise Exception("--check-tree only knows the median split and the old criteria")
+        tree_mismatches = check_tree(tree, reference_tree(snap, args.threshold, args.depth, args.criterion))
+
+    (stages["split"], _) = timed(lambda: [builder.splitMeshData(n, snap) for n in leaves], args.repeat)
+    if args.temp_mesh:
+        def temp_meshes():
+            for n in leaves:
+                builder.deleteMeshObject(builder.createSplitMesh(n, snap))
+        (stages["temp_mesh"], _) = timed(temp_meshes, args.repeat, args.verbose)
+
+    def extract():
+        pipe = pipeline.LeafPipeline(snap, format, None, False, False, args.workers, None, args.cache_size, False, meshlet_limits)
+        return (pipe, list(pipe.run(leaves)))
+    (stages["extract"], (pipe, bufs)) = timed(extract, args.repeat, args.verbose)
+
+    def encode():
+        for b in bufs:
+            pipe.encode(b)
+    (stages["encode"], _) = timed(encode, args.repeat)
+
+    me = Reporter()
+    (fd, path) = tempfile.mkstemp(suffix=".lmf")
+    os.close(fd)
+    try:
+        (stages["write"], _) = timed(lambda: exporter.write_binary(path, tree, snap, me, format, None, False, args.workers, args.version, args.cache_size, False, meshlet_limits, compression=compression), args.repeat, args.verbose)
+        file_bytes = os.path.getsize(path)
+
+        def decode():
+            with pkg.lmf.LMFStream(path) as s:
+                return sum(m.block_size for m in s.meshes())
+        (stages["decode"], mesh_bytes) = timed(decode, args.repeat)
+        with pkg.lmf.LMFFile(path) as f:
+            stored_bytes = sum(f.storedSize(i) for i in range(f.mesh_count))
+    finally:
+        # a failed write already removed its partial file
+        if os.path.exists(path):
+            os.remove(path)
+
+    return {
+        "mesh": kind,
+        "target_tris": target,
+        "tris": int(snap.triCount()),
+        "nodes": builder.nodeCount(tree),
+        "leaves": len(leaves),
+        "overlap": overlap,
+        "duplicated": duplicated,
+        "tree_mismatches": tree_mismatches,
+        "file_bytes": file_bytes,
+        "mesh_bytes": mesh_bytes,
+        "stored_bytes": stored_bytes,
+        "stages": stages,
+    }
+
+# scaling exponent per stage between consecutive sizes of a mesh
+def scaling(runs):
+    out = {}
+    by_mesh = {}
+    for r in runs:
+        by_mesh.setdefault(r["mesh"], []).append(r)
+    for (kind, rs) in by_mesh.items():
+        rs = sorted(rs, key=lambda r: r["tris"])
+        curves = {}
+        for (a, b) in zip(rs, rs[1:]):
+            if b["tris"] <= a["tris"]:
+                continue
+            for (stage, t) in b["stages"].items():
+                t0 = a["stages"].get(stage)
+                if t0 and t:
+                    curves.setdefault(stage, []).append(round(math.log(t / t0) / math.log(b["tris"] / a["tris"]), 3))
+        out[kind] = curves
+    return out
+
+def print_run(r):
+    print("%s %d tris: nodes(%d) leaves(%d) overlap(%.3f) duplicated(%d) file(%.2fMB) ratio(%.2f)" % (r["mesh"], r["tris"], r["nodes"], r["leaves"], r["overlap"], r["duplicated"], r["file_bytes"] / (1024 * 1024), r["mesh_bytes"] / max(r["stored_bytes"], 1)))
+    for stage in ("generate",) + STAGES:
+        t = r["stages"].get(stage)
+        if t is None:
+            continue
+        line = "  %-10s %9.3fs %9.2f Mtris/s" % (stage, t, r["tris"] / t / 1e6 if t > 0 else 0)
+        if stage == "decode":
+            line += " %9.1f MB/s" % (r["mesh_bytes"] / (1024 * 1024) / t if t > 0 else 0)
+        print(line)
+    if r.get("tree_mismatches") is not None:
+        print("  tree check: %s" % ("same as the reference" if r["tree_mismatches"] == 0 else "%d nodes differ" % r["tree_mismatches"]))
+
+# new / old time per stage of matching runs
+def compare(results, old):
+    key = lambda r: (r["mesh"], r["target_tris"])
+    old_runs = dict((key(r), r) for r in old["runs"])
+    print("compared to %s (commit %s):" % (old.get("date"), old.get("commit")))
+    for r in results["runs"]:
+        o = old_runs.get(key(r))
+        if o is None:
+            continue
+        parts = []
+        for stage in STAGES:
+            (t, t0) = (r["stages"].get(stage), o["stages"].get(stage))
+            if t and t0:
+                parts.append("%s(%.2fx)" % (stage, t / t0))
+        print("  %s %d: %s" % (r["mesh"], r["target_tris"], " ".join(parts)))
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Headless LMF exporter benchmark")
+    p.add_argument("--meshes", default="grid,terrain,props", help="comma separated: %s" % ", ".join(meshes.GENERATORS))
+    p.add_argument("--sizes", default="10k,100k,1M", help="comma separated triangle counts (k/M suffix ok), up to 10M")
+    p.add_argument("--threshold", type=float, default=1000, help="max triangles per leaf")
+    p.add_argument("--depth", type=int, default=20)
+    p.add_argument("--criterion", default="polycount", help="polycount, volume, area, extent or budget")
+    p.add_argument("--leaf-vertices", type=int, default=0xFFFF, help="budget criterion: unique vertices per leaf")
+    p.add_argument("--leaf-kb", type=int, default=0, help="budget criterion: mesh block KB per leaf (0 = no limit)")
+    p.add_argument("--strategy", default="median", choices=("median", "sah", "spatial"))
+    p.add_argument("--max-duplication", type=float, default=0.3, help="spatial split duplicate budget, fraction of the triangle count")
+    p.add_argument("--format", default="default", help="default, tan or pos")
+    p.add_argument("--version", type=int, default=None, help="binary version (default: latest)")
+    p.add_argument("--workers", type=int, default=1)
+    p.add_argument("--cache-size", type=int, default=0, help="vertex cache optimization size (0 = off)")
+    p.add_argument("--meshlets", action="store_true")
+    p.add_argument("--check-tree", action="store_true", help="check the median tree against a plain sort rebuild of it")
+    p.add_argument("--compress", default="none", help="mesh block codec[:level]: none, zlib, lzma (e.g. zlib:9)")
+    p.add_argument("--no-filters", action="store_true", help="compress without the shuffle + delta filters")
+    p.add_argument("--temp-mesh", action="store_true", help="also time the temp mesh leaf split (slow)")
+    p.add_argument("--repeat", type=int, default=1, help="best of this many runs per stage")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--json", help="write results here")
+    p.add_argument("--compare", help="older results json to compare against")
+    p.add_argument("--verbose", action="store_true", help="keep the exporter's prints")
+    args = p.parse_args(argv)
+
+    pkg = load_package()
+    if args.version is None:
+        args.version = pkg.layout.LMF_VERSION
+
+    runs = []
+    for kind in args.meshes.split(","):
+        for size in args.sizes.split(","):
+            r = bench_mesh(pkg, kind.strip(), parse_size(size), args)
+            print_run(r)
+            runs.append(r)
+
+    results = {
+        "commit": git_commit(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "options": vars(args),
+        "runs": runs,
+        "scaling": scaling(runs),
+    }
+    for (kind, curves) in results["scaling"].items():
+        if curves:
+            print("scaling %s: %s" % (kind, " ".join("%s(%s)" % (s, ",".join(str(e) for e in c)) for (s, c) in curves.items())))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+        print("results written to %s" % args.json)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
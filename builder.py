@@ -1,12 +1,16 @@
 import bpy, math
-import bpy_types
+import numpy as np
+from . import welder
+from . import instrument
+from .instrument import log, DEBUG, TRACE
+from .snapshot import MeshSnapshot, to_blender
 
 class AABB:
     def __init__(self, vectorInit = None):
         self.min = [0,0,0]
         self.max = [0,0,0]
 
-        if vectorInit:
+        if vectorInit is not None:
             self.min = list(vectorInit)
             self.max = list(vectorInit)
 
@@ -73,38 +77,381 @@ class AABB:
         else:
             return 2
 
+# binned SAH settings: bin count per axis, and cost of visiting a
+# node relative to drawing one triangle
+SAH_BINS = 16
+SAH_NODE_COST = 1.0
+
+# spatial splits (SBVH): only tried where the object split children
+# overlap more than alpha x root area, and references may only grow by
+# max_duplication x triangle count over the whole tree
+SPATIAL_ALPHA = 1e-5
+SPATIAL_MAX_DUPLICATION = 0.3
+
+# surface area of [n x 3] boxes
+def boxArea(bmin, bmax):
+    d = bmax - bmin
+    return 2 * (d[:, 0] * d[:, 1] + d[:, 1] * d[:, 2] + d[:, 0] * d[:, 2])
+
+# bounds of every bin out of [n] bin ids and [n x 3] boxes
+# (empty bins stay inf/-inf), return (counts, bin_min, bin_max)
+def binBounds(b, tmin, tmax, bins):
+    counts = np.bincount(b, minlength=bins)
+    order = np.argsort(b, kind='stable')
+    used = np.flatnonzero(counts)
+    starts = np.concatenate(([0], np.cumsum(counts[used])[:-1]))
+    bmin = np.full((bins, 3), np.inf)
+    bmax = np.full((bins, 3), -np.inf)
+    bmin[used] = np.minimum.reduceat(tmin[order], starts, axis=0)
+    bmax[used] = np.maximum.reduceat(tmax[order], starts, axis=0)
+    return (counts, bmin, bmax)
+
+# surface area of the intersection of two aabbs (0 if disjoint)
+def overlapArea(a, b):
+    d = [max(0.0, min(a.max[i], b.max[i]) - max(a.min[i], b.min[i])) for i in range(3)]
+    return 2 * (d[0] * d[1] + d[1] * d[2] + d[0] * d[2])
+
+# per triangle bounds and centroids, computed once for a tree build
+class TriangleBounds:
+    def __init__(self, snapshot):
+        p = snapshot.triPositions()
+        self.min = p.min(axis=1)
+        self.max = p.max(axis=1)
+        # in double, like the per triangle sums it replaced, float32 ties
+        # differently and picks other medians
+        self.centroid = p.sum(axis=1, dtype=np.float64) / 3.0
+
+    # triangle indices of tris (see ReferenceBounds)
+    def triangles(self, tris):
+        return tris
+
+    # aabb of triangles
+    def aabb(self, tris):
+        if len(tris) == 0:
+            return AABB()
+        b = AABB(self.min[tris].min(axis=0).tolist())
+        b.encase(self.max[tris].max(axis=0).tolist())
+        return b
+
+    # aabb of whole triangles (triangle ids, see ReferenceBounds)
+    def triangleAabb(self, tris):
+        return self.aabb(tris)
+
+    # order of tris when stable sorted by midpoint along each axis of
+    # axes in turn (last axis is the primary key, triangle index the
+    # least significant), which is what repeated stable sorts gave
+    def order(self, tris, axes):
+        keys = [tris]
+        for a in axes:
+            keys.append(self.centroid[tris, a])
+        return np.lexsort(keys)
+
+    # reorder tris (a view into the permutation) in place, so the first
+    # kth ones are the ones with smallest midpoint along axes[-1]
+    # O(n) selection, only ties at the pivot are ordered by the other axes
+    def partition(self, tris, axes, kth):
+        if kth <= 0 or kth >= len(tris):
+            return
+        key = self.centroid[tris, axes[-1]]
+        pivot = key[np.argpartition(key, kth)[kth]]
+        less = key < pivot
+        ties = np.flatnonzero(key == pivot)
+        need = kth - np.count_nonzero(less)
+        ties = ties[self.order(tris[ties], axes[:-1])]
+
+        left = np.concatenate((tris[less], tris[ties[:need]]))
+        right = np.concatenate((tris[ties[need:]], tris[key > pivot]))
+        tris[:kth] = left
+        tris[kth:] = right
+
+    # return copy of tris, sorted by midpoint along axes
+    def sorted(self, tris, axes):
+        return tris[self.order(tris, axes)]
+
+    # reorder tris (a view into the permutation) in place, so the ones
+    # marked in left mask come first
+    def split(self, tris, left):
+        l = tris[left]
+        r = tris[~left]
+        tris[:len(l)] = l
+        tris[len(l):] = r
+
+    # binned surface area heuristic over all three axes
+    # cost of a split = node_cost + (area_l * count_l + area_r * count_r) / area
+    # (in units of one triangle), return tuple of (cost, axis, left_mask)
+    # of the cheapest plane, or None if centroids can't be binned at all
+    def sahSplit(self, tris, area, node_cost=SAH_NODE_COST, bins=SAH_BINS):
+        if len(tris) < 2:
+            return None
+        if area <= 0:
+            area = 1.0
+
+        tmin = self.min[tris]
+        tmax = self.max[tris]
+        best = None
+        for axis in range(3):
+            c = self.centroid[tris, axis]
+            cmin = c.min()
+            cmax = c.max()
+            if not (cmax > cmin):
+                continue
+            b = ((c - cmin) * (bins / (cmax - cmin))).astype(np.int32)
+            np.minimum(b, bins - 1, out=b)
+
+            # per bin count and bounds
+            (counts, bmin, bmax) = binBounds(b, tmin, tmax, bins)
+
+            # sweep from both sides, plane k sits between bins k and k + 1,
+            # bins [0, k] go left and [k + 1, bins) right
+            lmin = np.minimum.accumulate(bmin, axis=0)[:-1]
+            lmax = np.maximum.accumulate(bmax, axis=0)[:-1]
+            rmin = np.minimum.accumulate(bmin[::-1], axis=0)[::-1][1:]
+            rmax = np.maximum.accumulate(bmax[::-1], axis=0)[::-1][1:]
+            lcount = np.cumsum(counts)[:-1]
+            rcount = len(tris) - lcount
+
+            with np.errstate(invalid='ignore'):
+                cost = node_cost + (boxArea(lmin, lmax) * lcount + boxArea(rmin, rmax) * rcount) / area
+            cost[(lcount == 0) | (rcount == 0)] = np.inf
+
+            k = int(np.argmin(cost))
+            if best is None or cost[k] < best[0]:
+                best = (float(cost[k]), axis, b < k + 1)
+
+        if best is None or not np.isfinite(best[0]):
+            return None
+        return best
+
+# bounds of triangle references for spatial splits (SBVH)
+# a reference is a triangle, or the part of one on a side of the split
+# planes above it, with its own (clipped) bounds. Nodes hold reference
+# ids instead of triangle ids, a straddling triangle can end up in both
+# children of a spatial split (its references clipped at the plane), so
+# sibling boxes stop overlapping around big triangles. Leaves turn back
+# into triangle ids, a duplicated triangle is written in every leaf it
+# got into. The clipped boxes only steer the build: leaf boxes are refit
+# to their whole triangles and parents to their children once built
+# (KDTreeNode.__makeLeaf), so every written box holds its geometry and
+# siblings overlap again where triangles got duplicated
+class ReferenceBounds(TriangleBounds):
+    def __init__(self, snapshot, max_duplication=SPATIAL_MAX_DUPLICATION, alpha=SPATIAL_ALPHA):
+        self.positions = snapshot.triPositions()
+        count = len(self.positions)
+        # grown by doubling, only [:count] is used
+        self.min = self.positions.min(axis=1).astype(np.float64)
+        self.max = self.positions.max(axis=1).astype(np.float64)
+        self.centroid = self.positions.sum(axis=1, dtype=np.float64) / 3.0
+        self.tri = np.arange(count, dtype=np.int32)
+        self.count = count
+        self.max_count = count + int(count * max_duplication)
+        self.alpha = alpha
+        self.root_area = self.aabb(self.tri).area() if count else 0.0
+
+    def triangles(self, refs):
+        return self.tri[refs]
+
+    def triangleAabb(self, tris):
+        if len(tris) == 0:
+            return AABB()
+        p = self.positions[tris]
+        b = AABB(p.min(axis=(0, 1)).tolist())
+        b.encase(p.max(axis=(0, 1)).tolist())
+        return b
+
+    # new references, return their ids
+    def append(self, tris, bmin, bmax):
+        n = len(tris)
+        if self.count + n > len(self.tri):
+            size = max(self.count + n, 2 * len(self.tri))
+            for name in ("min", "max", "centroid", "tri"):
+                a = getattr(self, name)
+                grown = np.empty((size,) + a.shape[1:], dtype=a.dtype)
+                grown[:self.count] = a[:self.count]
+                setattr(self, name, grown)
+        ids = np.arange(self.count, self.count + n, dtype=np.int32)
+        self.tri[ids] = tris
+        self.setBounds(ids, bmin, bmax)
+        self.count += n
+        return ids
+
+    def setBounds(self, refs, bmin, bmax):
+        self.min[refs] = bmin
+        self.max[refs] = bmax
+        self.centroid[refs] = 0.5 * (bmin + bmax)
+
+    # bounds of the part of refs' triangles between lo and hi along axis
+    # (the corners in there + where the edges cross lo and hi), cut down
+    # to the references' current bounds
+    # return (min, max, valid), valid is False where nothing's left
+    def clip(self, refs, axis, lo, hi):
+        p = self.positions[self.tri[refs]].astype(np.float64)
+        q = np.roll(p, -1, axis=1)
+        lo = np.broadcast_to(lo, len(refs))[:, None]
+        hi = np.broadcast_to(hi, len(refs))[:, None]
+        (c, cq) = (p[:, :, axis], q[:, :, axis])
+        points = [p]
+        masks = [(c >= lo) & (c <= hi)]
+        for v in (lo, hi):
+            # t is junk where the edge doesn't cross, masked below
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = (v - c) / (cq - c)
+                points.append(p + t[:, :, None] * (q - p))
+            masks.append((c - v) * (cq - v) < 0)
+        points = np.concatenate(points, axis=1)
+        mask = np.concatenate(masks, axis=1)[:, :, None]
+        bmin = np.maximum(np.where(mask, points, np.inf).min(axis=1), self.min[refs])
+        bmax = np.minimum(np.where(mask, points, -np.inf).max(axis=1), self.max[refs])
+        valid = np.all(bmin <= bmax, axis=1)
+        return (bmin, bmax, valid)
+
+    # binned spatial split over all three axes: planes at bin borders of
+    # the node box, straddling references go to both sides clipped
+    # cost is the same as sahSplit's, return (cost, axis, plane) if it
+    # beats the object split (cost, axis, left_mask) and fits the budget
+    def spatialSplit(self, refs, aabb, object_split, node_cost=SAH_NODE_COST, bins=SAH_BINS):
+        n = len(refs)
+        if n < 2 or self.count >= self.max_count:
+            return None
+        # no point where the object split children hardly overlap
+        if object_split is not None:
+            left = object_split[2]
+            overlap = overlapArea(self.aabb(refs[left]), self.aabb(refs[~left]))
+            if overlap <= self.alpha * self.root_area:
+                return None
+        area = aabb.area()
+        if area <= 0:
+            area = 1.0
+
+        rmin = self.min[refs]
+        rmax = self.max[refs]
+        best = None
+        for axis in range(3):
+            lo = aabb.min[axis]
+            extent = aabb.max[axis] - lo
+            if not (extent > 0):
+                continue
+            scale = bins / extent
+            first = np.clip(((rmin[:, axis] - lo) * scale).astype(np.int32), 0, bins - 1)
+            last = np.clip(((rmax[:, axis] - lo) * scale).astype(np.int32), 0, bins - 1)
+
+            # one box per (reference, bin it touches), straddlers' boxes
+            # cut at the bin borders (looser than clipping the triangle,
+            # only the split that gets picked clips for real)
+            span = last - first + 1
+            pair = np.repeat(np.arange(n), span)
+            pair_bin = np.arange(span.sum()) - np.repeat(np.cumsum(span) - span, span) + first[pair]
+            cmin = rmin[pair]
+            cmax = rmax[pair]
+            np.maximum(cmin[:, axis], lo + pair_bin / scale, out=cmin[:, axis])
+            np.minimum(cmax[:, axis], lo + (pair_bin + 1) / scale, out=cmax[:, axis])
+            (_, bmin, bmax) = binBounds(pair_bin, cmin, cmax, bins)
+
+            # references entering a bin count left of every plane after
+            # it, the ones leaving count right of every plane before it
+            lmin = np.minimum.accumulate(bmin, axis=0)[:-1]
+            lmax = np.maximum.accumulate(bmax, axis=0)[:-1]
+            rmin_ = np.minimum.accumulate(bmin[::-1], axis=0)[::-1][1:]
+            rmax_ = np.maximum.accumulate(bmax[::-1], axis=0)[::-1][1:]
+            lcount = np.cumsum(np.bincount(first, minlength=bins))[:-1]
+            rcount = n - np.cumsum(np.bincount(last, minlength=bins))[:-1]
+
+            with np.errstate(invalid='ignore'):
+                cost = node_cost + (boxArea(lmin, lmax) * lcount + boxArea(rmin_, rmax_) * rcount) / area
+            cost[(lcount == 0) | (rcount == 0)] = np.inf
+
+            k = int(np.argmin(cost))
+            if best is None or cost[k] < best[0]:
+                best = (float(cost[k]), axis, lo + (k + 1) / scale)
+
+        if best is None or not np.isfinite(best[0]):
+            return None
+        if object_split is not None and best[0] >= object_split[0]:
+            return None
+        (cost, axis, plane) = best
+        straddling = np.count_nonzero((rmin[:, axis] < plane) & (rmax[:, axis] > plane))
+        if self.count + straddling > self.max_count:
+            return None
+        return best
+
+    # references of both sides of a spatial split plane, straddlers keep
+    # their id on the left and get a new one on the right
+    # return (left, right) or None if a side would end up empty
+    def spatialPartition(self, refs, axis, plane):
+        rmin = self.min[refs, axis]
+        rmax = self.max[refs, axis]
+        left_only = rmax <= plane
+        right_only = ~left_only & (rmin >= plane)
+        s = refs[~(left_only | right_only)]
+        (lmin, lmax, lvalid) = self.clip(s, axis, self.min[s, axis], plane)
+        (rmin, rmax, rvalid) = self.clip(s, axis, plane, self.max[s, axis])
+        # lying in the plane, nothing clipped on either side
+        lvalid |= ~(lvalid | rvalid)
+        if np.count_nonzero(left_only) + np.count_nonzero(lvalid) == 0 or np.count_nonzero(right_only) + np.count_nonzero(rvalid) == 0:
+            return None
+
+        self.setBounds(s[lvalid], lmin[lvalid], lmax[lvalid])
+        new = self.append(self.tri[s[rvalid]], rmin[rvalid], rmax[rvalid])
+        instrument.count("spatial_splits")
+        instrument.count("references_duplicated", np.count_nonzero(lvalid & rvalid))
+        left = np.concatenate((refs[left_only], s[lvalid])).astype(np.int32)
+        right = np.concatenate((refs[right_only], new)).astype(np.int32)
+        return (left, right)
+
 # another kdtreenode? heh
-# this just contain the polygons
-# the vertices would be used when rebuilding 
+# this just contain the triangles (indices into snapshot.tri_loops)
+# the snapshot would be used when rebuilding 
 # the split meshes I guess
+# strategy is either "median" (triangle median on longest axis) or
+# "sah" (binned surface area heuristic, see TriangleBounds.sahSplit) or
+# "spatial" (sah + SBVH spatial splits, see ReferenceBounds, triangles
+# may get duplicated into max_duplication x triangle count more leaves)
+# leaf_fits is an optional test of leaf triangles, leaves failing it
+# keep getting split at the median regardless of criterion and depth
+# criterion "budget" splits until leaf_fits passes (see
+# extract.leaf_budget), max_polys isn't used then
 class KDTreeNode:
-    def __init__(self, max_polys=5000, max_depth=10, criterion="polycount", mesh=None, triangulate=False):
+    def __init__(self, max_polys=5000, max_depth=10, criterion="polycount", mesh=None, triangulate=False, strategy="median", node_cost=SAH_NODE_COST, leaf_fits=None, max_duplication=SPATIAL_MAX_DUPLICATION):
         # some default property is inbound, I guess
         self.children = [None, None]
         self._depth = 0
         self._id = 0
         self._maxPolys = max_polys
         self._maxDepth = max_depth
+        self._strategy = strategy
+        self._nodeCost = node_cost
+        self._leafFits = leaf_fits
+        self._maxDuplication = max_duplication
+        self._fits = None
+        # box grew back from clipped references somewhere below
+        self._refit = False
         self.aabb = AABB()
         self.polys = []
-        self.verts = []
+        self.snapshot = None
+        self.bounds = None
         self.axisId = 0
         self.parent = None
+        # build state, only alive while building
+        self._perm = None
+        self._start = 0
+        self._axes = ()
 
-        print("KDTREE: init with max_depth(%d), %s(%.2f)" % (max_depth, criterion, max_polys))
+        log(TRACE, "KDTREE: init with max_depth(%d), %s(%.2f), strategy(%s)", max_depth, criterion, max_polys, strategy)
         
         # step below only valid if mesh was provided
+        # (either a bpy mesh or a MeshSnapshot of it)
+        # the tree is always built on loop triangles now, so
+        # triangulate is only kept for compatibility
+        if criterion == "budget" and leaf_fits is None:
+            raise Exception("The budget criterion needs a leaf test!")
+
         if mesh is not None:
-            # triangulate?
-            if triangulate:
-                mesh.calc_loop_triangles()
+            snap = mesh
+            if not isinstance(snap, MeshSnapshot):
+                snap = MeshSnapshot(mesh)
 
-            mesh.calc_tangents()
             # start here, auto split recursively too
-            base_data = mesh.polygons
-            if triangulate:
-                base_data = mesh.loop_triangles
-            self.buildFromPolys(base_data, mesh.vertices, criterion, triangulate)
+            tris = np.arange(snap.triCount(), dtype=np.int32)
+            self.buildFromPolys(tris, snap, criterion, True)
             # renumber our ids?
             self.__renumber()
 
@@ -128,30 +475,33 @@ class KDTreeNode:
     def isLeaf(self):
         return self.children[0] is None and self.children[1] is None
 
-    # build node from polysoup
-    def buildFromPolys(self, polys, verts, criterion, triangulate):
-        print("Building node from polys(%d), triangulate? %s" % (len(polys), triangulate))
+    # build node from triangle soup (triangle indices of snapshot)
+    def buildFromPolys(self, polys, snapshot, criterion, triangulate=True):
+        # bounds + centroids computed once for the whole build,
+        # children only partition a permutation of the triangles in place
+        if self._strategy == "spatial":
+            bounds = ReferenceBounds(snapshot, self._maxDuplication)
+        else:
+            bounds = TriangleBounds(snapshot)
+        perm = np.array(polys, dtype=np.int32)
+        self.buildFromRange(perm, 0, len(perm), snapshot, bounds, criterion, triangulate)
+
+    # build node from perm[start:end]
+    # axes are the splitting axes of our ancestors (root first)
+    def buildFromRange(self, perm, start, end, snapshot, bounds, criterion, triangulate=True, axes=()):
+        log(TRACE, "Building node from polys(%d), triangulate? %s", end - start, triangulate)
         # save reference?
-        self.verts = verts
+        self.snapshot = snapshot
+        self.bounds = bounds
+        # view, not a copy
+        self.polys = perm[start:end]
+        self._perm = perm
+        self._start = start
         # compute aabb first?
-        for (p_idx, p) in enumerate(polys):
-            if p_idx == 0:
-                if triangulate:
-                    self.aabb = triAABB(p, verts)
-                else:
-                    self.aabb = faceAABB(p, verts)
-            else:
-                if triangulate:
-                    self.aabb.union(triAABB(p, verts))
-                else:
-                    self.aabb.union(faceAABB(p, verts))
+        self.aabb = bounds.aabb(self.polys)
         # save splitting axis
         self.axisId = self.aabb.findSplittingAxis()
-        # copy them sorted order
-        if triangulate:
-            self.polys = getSortedTris(polys, verts, self.axisId)
-        else:
-            self.polys = getSortedPolys(polys, verts, self.axisId)
+        self._axes = axes + (self.axisId,)
         # split
         self.split(criterion, triangulate)
 
@@ -173,19 +523,63 @@ class KDTreeNode:
             # longest extent
             comp_value = self.aabb.longestExtent()
             can_split = self.aabb.longestExtent() > self._maxPolys
+        elif criterion == "budget":
+            # unique vertices + block bytes, the leaf test knows
+            comp_value = len(self.polys)
+            can_split = not self.__fits()
         else:
             # by default use num of polys
             comp_value = len(self.polys)
             can_split = len(self.polys) > self._maxPolys
 
         # should we?
+        forced = False
         if self._depth >= self._maxDepth or not can_split:
-            print("SPLIT_ABORTED: depth(%d), %s(%.2f)" % (self._depth, criterion, comp_value))
-            return
+            if self.__fits():
+                log(TRACE, "SPLIT_ABORTED: depth(%d), %s(%.2f)", self._depth, criterion, comp_value)
+                instrument.count("splits_aborted")
+                self.__makeLeaf()
+                return
+            # too big to be written as one leaf
+            log(TRACE, "SPLIT_FORCED: depth(%d), %s(%.2f), leaf too big", self._depth, criterion, comp_value)
+            instrument.count("splits_forced")
+            forced = True
+
+        # where to cut? by default at the median
+        median = math.trunc(len(self.polys)/2)
+        sah_left = None
+        spatial = None
+        if self._strategy in ("sah", "spatial") and not forced:
+            sah = self.bounds.sahSplit(self.polys, self.aabb.area(), self._nodeCost)
+            if self._strategy == "spatial":
+                spatial = self.bounds.spatialSplit(self.polys, self.aabb, sah, self._nodeCost)
+            if spatial is not None:
+                (cost, axis, plane) = spatial
+            elif sah is not None:
+                (cost, axis, sah_left) = sah
+            if spatial is not None or sah is not None:
+                # leaf cost termination, splitting must beat drawing all of us
+                if cost >= len(self.polys) and self.__fits():
+                    log(TRACE, "SPLIT_ABORTED: depth(%d), sah(%.2f) >= leaf(%d)", self._depth, cost, len(self.polys))
+                    instrument.count("splits_aborted")
+                    self.__makeLeaf()
+                    return
+                self.axisId = axis
+                self._axes = self._axes[:-1] + (axis,)
+
+        # straddlers go both ways, children get their own reference arrays
+        sides = None
+        if spatial is not None:
+            sides = self.bounds.spatialPartition(self.polys, axis, plane)
+            if sides is None and sah is not None:
+                (cost, axis, sah_left) = sah
+                self.axisId = axis
+                self._axes = self._axes[:-1] + (axis,)
+
         # welp, we could go further. go on!
         # make two children?
-        self.children[0] = KDTreeNode(self._maxPolys, self._maxDepth, criterion)
-        self.children[1] = KDTreeNode(self._maxPolys, self._maxDepth, criterion)
+        self.children[0] = KDTreeNode(self._maxPolys, self._maxDepth, criterion, strategy=self._strategy, node_cost=self._nodeCost, leaf_fits=self._leafFits, max_duplication=self._maxDuplication)
+        self.children[1] = KDTreeNode(self._maxPolys, self._maxDepth, criterion, strategy=self._strategy, node_cost=self._nodeCost, leaf_fits=self._leafFits, max_duplication=self._maxDuplication)
 
         # set relation and id and depth
         self.children[0].parent = self
@@ -196,31 +590,76 @@ class KDTreeNode:
         # self.children[1]._id = self._id * 2 + 2
         self.children[1]._depth = self._depth + 1
 
-        # split polys (already sorted)
-        median = math.trunc(len(self.polys)/2)
-        lpolys = self.polys[:median]
-        rpolys = self.polys[median:]
-
-        # build children
-        self.children[0].buildFromPolys(lpolys, self.verts, criterion, triangulate)
-        self.children[1].buildFromPolys(rpolys, self.verts, criterion, triangulate)
+        # split polys in place, either at the sah plane or at the
+        # median (O(n) selection)
+        if sides is not None:
+            (left, right) = sides
+            self.children[0].buildFromRange(left, 0, len(left), self.snapshot, self.bounds, criterion, triangulate, self._axes)
+            self.children[1].buildFromRange(right, 0, len(right), self.snapshot, self.bounds, criterion, triangulate, self._axes)
+        else:
+            if sah_left is not None:
+                median = int(np.count_nonzero(sah_left))
+                self.bounds.split(self.polys, sah_left)
+            else:
+                self.bounds.partition(self.polys, self._axes, median)
+            start = self._start
+            end = start + len(self.polys)
+
+            # build children
+            self.children[0].buildFromRange(self._perm, start, start + median, self.snapshot, self.bounds, criterion, triangulate, self._axes)
+            self.children[1].buildFromRange(self._perm, start + median, end, self.snapshot, self.bounds, criterion, triangulate, self._axes)
+
+        # hold whatever the leaves below grew back to, only when spatial
+        # splits clipped something (empty leaves have no box to hold)
+        if self.children[0]._refit or self.children[1]._refit:
+            boxes = [c.aabb for c in self.children if not (c.isLeaf() and len(c.polys) == 0)]
+            self.aabb = AABB(boxes[0].min)
+            self.aabb.encase(boxes[0].max)
+            for b in boxes[1:]:
+                self.aabb.union(b)
+            self._refit = True
 
         # remove our data
         self.polys = []
-        self.verts = []
-
-    # print something?
+        self.snapshot = None
+        self.bounds = None
+        self._perm = None
+
+    # can we stay a leaf? single triangles always can
+    # (asked up to three times per node, counting vertices isn't free)
+    def __fits(self):
+        if self._leafFits is None or len(self.polys) < 2:
+            return True
+        if self._fits is None:
+            self._fits = self._leafFits(self.bounds.triangles(self.polys))
+        return self._fits
+
+    # done splitting, leaves keep their triangles sorted by midpoint
+    # and get the box of the whole triangles (not of clipped references)
+    def __makeLeaf(self):
+        if self.bounds is not None:
+            self.polys = self.bounds.triangles(self.bounds.sorted(self.polys, self._axes))
+            if len(self.polys):
+                box = self.bounds.triangleAabb(self.polys)
+                self._refit = box.min != self.aabb.min or box.max != self.aabb.max
+                self.aabb = box
+        self.bounds = None
+        self._perm = None
+
+    # print something? (TRACE level only, it's a line per node)
     def print(self):
+        if not instrument.enabled(TRACE):
+            return
         tr = self
         # print some info?
         parent_id = -1
         if tr.parent is not None:
             parent_id = tr.parent._id
-        print("(%s)node[%d]: parent(%d) depth(%d) aabb(%.2f %.2f %.2f | %.2f %.2f %.2f) poly(%d)" % (
+        log(TRACE, "(%s)node[%d]: parent(%d) depth(%d) aabb(%.2f %.2f %.2f | %.2f %.2f %.2f) poly(%d)",
             ("BRANCH", "LEAF")[tr.isLeaf()],
             tr._id, parent_id, tr._depth, tr.aabb.min[0], tr.aabb.min[1], tr.aabb.min[2],
             tr.aabb.max[0], tr.aabb.max[1], tr.aabb.max[2], len(tr.polys)
-        ))
+        )
 
         # add children if we're not leaf
         if not tr.isLeaf():
@@ -254,8 +693,7 @@ def createMeshObject(name, verts, faces, edges=None, norms=None, mats=None, face
     
     # set face mats
     if face_mats is not None:
-        for (p_id, p) in enumerate(mesh.polygons):
-            p.material_index = face_mats[p_id]
+        mesh.polygons.foreach_set("material_index", np.asarray(face_mats, dtype=np.int32))
 
     # if we got normals, set normals from it too
     if norms is not None:
@@ -264,13 +702,12 @@ def createMeshObject(name, verts, faces, edges=None, norms=None, mats=None, face
     # copy uvs too
     if uvs is not None:
         for (id, uvd) in enumerate(uvs):
-            print("Copying uv[%d] loops: generated(%d) vs source(%d)" % (
+            log(TRACE, "Copying uv[%d] loops: generated(%d) vs source(%d)",
                 id, len(mesh.loops), len(uvd)
-            ))
+            )
             mesh.uv_layers.new(name="uv%d" % id)
             # set uv
-            for (v_id, coord) in enumerate(uvd):
-                mesh.uv_layers[id].data[v_id].uv = coord
+            mesh.uv_layers[id].data.foreach_set("uv", np.asarray(uvd, dtype=np.float32).ravel())
 
     return mesh
 
@@ -291,8 +728,7 @@ def addMeshObject(name, verts, faces, edges=None, col="Collection", norms=None,
     
     # set face mats
     if face_mats is not None:
-        for (p_id, p) in enumerate(mesh.polygons):
-            p.material_index = face_mats[p_id]
+        mesh.polygons.foreach_set("material_index", np.asarray(face_mats, dtype=np.int32))
 
     # if we got normals, set normals from it too
     if norms is not None:
@@ -301,13 +737,12 @@ def addMeshObject(name, verts, faces, edges=None, col="Collection", norms=None,
     # copy uvs too
     if uvs is not None:
         for (id, uvd) in enumerate(uvs):
-            print("Setting uv[%d] loops: generated(%d) vs source(%d)" % (
+            log(TRACE, "Setting uv[%d] loops: generated(%d) vs source(%d)",
                 id, len(mesh.loops), len(uvd)
-            ))
+            )
             mesh.uv_layers.new(name="uv%d" % id)
             # set uv
-            for (v_id, coord) in enumerate(uvd):
-                mesh.uv_layers[id].data[v_id].uv = coord
+            mesh.uv_layers[id].data.foreach_set("uv", np.asarray(uvd, dtype=np.float32).ravel())
 
 # output aabb from face data
 def faceAABB(polygon, vertices):
@@ -323,15 +758,12 @@ def faceAABB(polygon, vertices):
             b.encase(v)
     return b
 
-# output aabb from triangle
-def triAABB(tri, vertices):
-    b = None
-    for v_idx in tri.vertices:
-        v = list(vertices[v_idx].co)
-        if b is None:
-            b = AABB(v)
-        else:
-            b.encase(v)
+# output aabb from triangle (index into snapshot triangles)
+def triAABB(tri, snapshot):
+    p = snapshot.triPositions(tri)
+    b = AABB(p[0])
+    b.encase(p[1])
+    b.encase(p[2])
     return b
 
 # output aabb from mesh
@@ -348,29 +780,13 @@ def meshAABB(mesh):
     return b
 
 # return triangles, sorted by midpoint
-def getSortedTris(tris, verts, axisId):
-    # copy list
-    ps = list(tris)
-
-    def sortByAxis(t):
-        b = triAABB(t, verts)
-        return b.center()[axisId]
-
-    def sortByCenter(t):
-        v = [0, 0, 0]
-        for v_id in t.vertices:
-            p = list(verts[v_id].co)
-            v[0] += p[0]
-            v[1] += p[1]
-            v[2] += p[2]
-        v[0] = v[0] / 3.0
-        v[1] = v[1] / 3.0
-        v[2] = v[2] / 3.0
-        return v[axisId]
-
-    
-    ps.sort(key=sortByCenter)
-    return ps
+def getSortedTris(tris, snapshot, axisId):
+    tris = np.asarray(tris)
+    if len(tris) == 0:
+        return tris
+    # centroid along axis
+    c = snapshot.triPositions(tris)[:, :, axisId].sum(axis=1) / 3.0
+    return tris[np.argsort(c, kind='stable')]
 
 # return polygons, sorted by aabb and split axis
 def getSortedPolys(polys, verts, axisId):
@@ -437,139 +853,86 @@ def collectGoodLeaves(node):
             stack.append(tr.children[1])
     return leaves
 
-def createSplitMesh(node, mesh):
-    m = mesh #bpy.data.meshes[0]
+# nodes with at least one good leaf below (or being one), breadth first
+# like the node records
+def collectLodNodes(node):
+    queue = [node]
+    nodes = []
+    while len(queue):
+        n = queue.pop(0)
+        nodes.append(n)
+        if not n.isLeaf():
+            queue.append(n.children[0])
+            queue.append(n.children[1])
+    # children come after their parent, so go backwards
+    has_geometry = {}
+    for n in reversed(nodes):
+        if n.isLeaf():
+            has_geometry[n] = len(n.polys) > 0
+        else:
+            has_geometry[n] = has_geometry[n.children[0]] or has_geometry[n.children[1]]
+    return [n for n in nodes if has_geometry[n]]
+
+# gather split mesh data of a node from snapshot
+# return tuple of (vertices, faces, norms, face_mats, uvs), all numpy
+# arrays in blender space, ready for from_pydata
+def splitMeshData(node, snapshot, tolerances=None):
+    n = node
+    snap = snapshot
+
+    # loops of every triangle, in triangle order
+    loops = snap.tri_loops[n.polys].ravel()
+    pos = snap.positions[snap.loop_vertex[loops]]
+    norm = snap.normals[loops]
+
+    # construct unique vertices
+    (first, remap) = welder.weldArrays([pos, norm], tolerances)
+    vertices = to_blender(pos[first])
+    norms = to_blender(norm[first])
+    faces = remap.reshape(-1, 3)
+    face_mats = snap.tri_material[n.polys]
+
+    # loop uvs
+    uvs = [uv[loops] for uv in snap.uvs]
+
+    return (vertices, faces, norms, face_mats, uvs)
+
+def createSplitMesh(node, snapshot, tolerances=None):
     n = node #KDTreeNode()
 
-    # references?
-    verts = m.vertices
-    loops = m.loops
-    mats = m.materials
-    uv_layers = m.uv_layers
-
-    # collect vertices?
-    u_verts = []
-    vertices = []
-    norms = []
-    faces = []
-    face_mats = []
-    uvs = []
-    for l in uv_layers:
-        uvs.append([])
-
-    tri_mode = type(n.polys[0]) == bpy_types.MeshLoopTriangle
-
-    print("MESH_BUILDER: CREATING NODE[%d] MESH IN TRIANGLE? %s" % (n._id, tri_mode))
-
-    for p in n.polys:
-        # save face_mats
-        face_mats.append(p.material_index)
-        # p.vertices are indices
-        f = []
-
-        index_data = []
-        if tri_mode:
-            index_data = p.loops
-        else:
-            index_data = p.loop_indices
-        # for l_id in p.loop_indices:
-        for l_id in index_data:
-            # grab loop data
-            l = loops[l_id]
-            
-            v_id = l.vertex_index
-            
-            # store loop uv
-            for (u_id, uvdata) in enumerate(uvs):
-                uv = tuple(uv_layers[u_id].data[l_id].uv)
-                uvdata.append(uv)
-
-            # grab unique vertex indices?
-            pos = tuple(verts[v_id].co)
-            norm = tuple(l.normal)
-            # construct unique vertices
-            u_vert = [pos, norm]
-                
-            if u_vert not in u_verts:
-                u_verts.append(u_vert)
-                vertices.append(pos)
-                norms.append(norm)
-            # if pos not in vertices:
-            #     vertices.append(pos)
-            new_v_id = u_verts.index(u_vert)
-            f.append(new_v_id)
-        # add new face
-        faces.append(f)
+    log(TRACE, "MESH_BUILDER: CREATING NODE[%d] MESH", n._id)
+
+    (vertices, faces, norms, face_mats, uvs) = splitMeshData(n, snapshot, tolerances)
     # spawn the mesh
-    # addMeshObject("SPLIT_%d" % (n._id), vertices, faces, None, colName, norms, mats, face_mats, uvs)
-    return createMeshObject("SPLIT_%d" % (n._id), vertices, faces, None, norms, mats, face_mats, uvs)
+    return createMeshObject("SPLIT_%d" % (n._id), vertices.tolist(), faces.tolist(), None, norms.tolist(), snapshot.materials, face_mats, uvs)
 
 # spawn split mesh?
-def spawnSplitMesh(node, mesh, colName):
-    m = mesh #bpy.data.meshes[0]
+def spawnSplitMesh(node, snapshot, colName, tolerances=None):
     n = node #KDTreeNode()
 
-    # references?
-    verts = m.vertices
-    loops = m.loops
-    mats = m.materials
-    uv_layers = m.uv_layers
-
-    # collect vertices?
-    u_verts = []
-    vertices = []
-    norms = []
-    faces = []
-    face_mats = []
-    uvs = []
-    for l in uv_layers:
-        uvs.append([])
-
-    tri_mode = type(n.polys[0]) == bpy_types.MeshLoopTriangle
-
-    print("SPAWNING NODE[%d] MESH IN TRIANGLE? %s" % (n._id, tri_mode))
-
-    for p in n.polys:
-        # save face_mats
-        face_mats.append(p.material_index)
-        # p.vertices are indices
-        f = []
-
-        index_data = []
-        if tri_mode:
-            index_data = p.loops
-        else:
-            index_data = p.loop_indices
-        # for l_id in p.loop_indices:
-        for l_id in index_data:
-            # grab loop data
-            l = loops[l_id]
-            
-            v_id = l.vertex_index
-            
-            # store loop uv
-            for (u_id, uvdata) in enumerate(uvs):
-                uv = tuple(uv_layers[u_id].data[l_id].uv)
-                uvdata.append(uv)
-
-            # grab unique vertex indices?
-            pos = tuple(verts[v_id].co)
-            norm = tuple(l.normal)
-            # construct unique vertices
-            u_vert = [pos, norm]
-                
-            if u_vert not in u_verts:
-                u_verts.append(u_vert)
-                vertices.append(pos)
-                norms.append(norm)
-            # if pos not in vertices:
-            #     vertices.append(pos)
-            new_v_id = u_verts.index(u_vert)
-            f.append(new_v_id)
-        # add new face
-        faces.append(f)
+    log(DEBUG, "SPAWNING NODE[%d] MESH", n._id)
+
+    (vertices, faces, norms, face_mats, uvs) = splitMeshData(n, snapshot, tolerances)
     # spawn the mesh
-    addMeshObject("SPLIT_%d" % (n._id), vertices, faces, None, colName, norms, mats, face_mats, uvs)
+    addMeshObject("SPLIT_%d" % (n._id), vertices.tolist(), faces.tolist(), None, colName, norms.tolist(), snapshot.materials, face_mats, uvs)
+
+# sibling overlap + triangle duplication of a tree, return tuple of
+# (summed intersection area of every split's children / root area,
+# triangles in leaves - triangles in the mesh)
+def treeOverlap(tree, tri_count):
+    root = tree.aabb.area()
+    overlap = 0.0
+    refs = 0
+    queue = [tree]
+    while len(queue):
+        n = queue.pop(0)
+        if n.isLeaf():
+            refs += len(n.polys)
+        else:
+            overlap += overlapArea(n.children[0].aabb, n.children[1].aabb)
+            queue.append(n.children[0])
+            queue.append(n.children[1])
+    return (overlap / root if root > 0 else 0.0, refs - tri_count)
 
 # count nodes
 def nodeCount(tree):
@@ -587,7 +950,7 @@ def nodeCount(tree):
 
 # test
 
-# mesh = bpy.context.selected_objects[0].data
+# mesh = MeshSnapshot(bpy.context.selected_objects[0].data)
 
 # print("Building KDTree...")
 # node = KDTreeNode(100, 16, "polycount", mesh)
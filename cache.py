@@ -0,0 +1,157 @@
+import os, pickle, hashlib
+import numpy as np
+from .extract import loop_attributes
+from .instrument import log, WARN
+
+"""
+Author: Bowie
+Persistent per-leaf cache for re-exports, no bpy in here
+
+Re-exporting after a small edit mostly produces the same leaves again.
+Every leaf is keyed on a hash of everything its buffers come out of:
+ - the loop attributes of its triangles (in vertex format order, so
+   only what gets exported), in triangle order
+ - the material of every triangle + the material count
+ - vertex format, weld tolerances and the pipeline options
+   (see LeafPipeline.cacheOptions)
+and its processed LeafBuffer fields (vb, ib, optimize stats, meshlets,
+encoded bytes, leaf LOD chain) get pickled under that key. The blocks
+themselves are assembled at write time, so one entry serves every
+binary version and the ascii writer too.
+
+Entries live in <directory>/<2 hex>/<key>.leaf, the file mtime is the
+last use. After an export trim() drops the least recently used entries
+until the cache fits max_bytes.
+
+Bump CACHE_VERSION whenever what a leaf turns into changes.
+"""
+
+CACHE_VERSION = 1
+CACHE_MAX_BYTES = 1024 * 1024 * 1024
+CACHE_EXT = ".leaf"
+
+# content hash of a leaf's inputs
+# options is anything hashable by repr (tolerances, pipeline options...)
+def leaf_key(snapshot, tris, format, options=()):
+    h = hashlib.blake2b(digest_size=20)
+    h.update(repr((CACHE_VERSION, format, len(snapshot.materials), options)).encode('utf-8'))
+    tris = np.asarray(tris)
+    loops = snapshot.tri_loops[tris].ravel()
+    for col in loop_attributes(snapshot, loops, format):
+        h.update(np.ascontiguousarray(col).tobytes())
+    h.update(np.ascontiguousarray(snapshot.tri_material[tris]).tobytes())
+    return h.hexdigest()
+
+class LeafCache:
+    def __init__(self, directory, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "stored": 0,
+            "evicted": 0,
+            "broken": 0,
+        }
+        # bytes read + written this export
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + CACHE_EXT)
+
+    def has(self, key):
+        return os.path.isfile(self.path(key))
+
+    # which keys have an entry, the others count as misses
+    def lookup(self, keys):
+        hits = [self.has(k) for k in keys]
+        self.counters["misses"] += hits.count(False)
+        return hits
+
+    # cached leaf result dict, None (a miss) if gone or unreadable
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            r = pickle.loads(data)
+        except FileNotFoundError:
+            self.counters["misses"] += 1
+            return None
+        except Exception as e:
+            log(WARN, "CACHE: dropping broken entry %s (%s)", path, e)
+            self.counters["broken"] += 1
+            self.counters["misses"] += 1
+            self.remove(path)
+            return None
+        # mark as recently used
+        os.utime(path)
+        self.counters["hits"] += 1
+        self.bytes_read += len(data)
+        return r
+
+    # store a leaf result dict, written next to it first so a crash
+    # never leaves half an entry behind
+    def put(self, key, result):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        self.counters["stored"] += 1
+        self.bytes_written += len(data)
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    # list of (mtime, size, path) of every entry
+    def entries(self):
+        out = []
+        for sub in os.listdir(self.directory):
+            subdir = os.path.join(self.directory, sub)
+            if not os.path.isdir(subdir):
+                continue
+            for name in os.listdir(subdir):
+                if not name.endswith(CACHE_EXT):
+                    continue
+                path = os.path.join(subdir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                out.append((st.st_mtime, st.st_size, path))
+        return out
+
+    def size(self):
+        return sum(size for (_, size, _) in self.entries())
+
+    # drop least recently used entries until under max_bytes
+    def trim(self):
+        entries = sorted(self.entries())
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, path) in entries:
+            if total <= self.max_bytes:
+                break
+            self.remove(path)
+            total -= size
+            self.counters["evicted"] += 1
+        return total
+
+    def hitRate(self):
+        looked_up = self.counters["hits"] + self.counters["misses"]
+        return self.counters["hits"] / looked_up if looked_up else 0.0
+
+    def summary(self):
+        return "hits(%d) misses(%d) hit_rate(%.1f%%) stored(%d) evicted(%d) read(%.2fMB) written(%.2fMB)" % (
+            self.counters["hits"], self.counters["misses"], self.hitRate() * 100,
+            self.counters["stored"], self.counters["evicted"],
+            self.bytes_read / (1024 * 1024), self.bytes_written / (1024 * 1024)
+        )
@@ -1,244 +1,263 @@
+import os, itertools
 import bpy
 import bpy_types
-import sys, array
+import numpy as np
 from . import builder
+from . import pipeline
+from . import meshlet
+from .cache import LeafCache, CACHE_MAX_BYTES
+from . import instrument
+from .instrument import log, stage, INFO, DEBUG
+from .snapshot import MeshSnapshot, merge_snapshots
+from .layout import (
+    VTF_POS, VTF_NORMAL, VTF_UV0, VTF_TANGENT_BITANGENT, VTF_UV1,
+    VTF_COLOR, VTF_BONE_DATA, VTF_TWEEN, VTF_DEFAULT,
+    LMF_MAGIC, LMF_VERSION_LEGACY, LMF_VERSION_DIRECTORY, LMF_VERSION_WIDE, LMF_VERSION,
+    LMF_VERSION_PACKED, LMF_VERSION_LOD, LMF_VERSION_COMPRESSED, DECODE_DTYPE, LOD_DTYPE,
+    COMPRESS_NONE, COMPRESS_ZLIB, COMPRESS_LZMA, COMPRESS_NAMES, FILTER_DEFAULT,
+    directory_dtype, compress_block, vertex_dtype,
+    MESH_INDEX32, MESH_MESHLETS, fits_legacy,
+    VTF_PACK_POS16, VTF_PACK_NORMAL_OCT16, VTF_PACK_NORMAL_1010102, VTF_PACK_TANGENT,
+    VTF_PACK_UV_HALF, VTF_PACK_UV_UNORM16, VTF_PACK_MASK, check_packing, vertex_decode,
+    make_buffer, bytesPerVertex, encode_vertices, encode_indices,
+)
+from .extract import (
+    weld_tolerances, split_tolerances, loop_attributes, extract_arrays,
+    split_vertex_count, leaf_fits, leaf_budget,
+)
 
 """
 Author: Bowie
 This exporter defines a pretty basic export for
 OGL compatible vertex buffer
 
-Vertex Format (using bit position to toggle availability):
-(1 << 0) : POSITION
-(1 << 1) : NORMAL
-(1 << 2) : UV0
-(1 << 3) : TANGENT + BITANGENT
-(1 << 4) : UV1 (NOT IMPLEMENTED YET)
-(1 << 5) : COLOR (NOT IMPLEMENTED YET)
-(1 << 6) : BONE_WEIGHTS + IDS (NOT IMPLEMENTED YET)
-(1 << 7) : TWEEN (NOT IMPLEMENTED YET)
+The vertex format flags and the binary layout live in layout.py
 """
-VTF_POS     = (1<<0)
-VTF_NORMAL  = (1<<1)
-VTF_UV0     = (1<<2)
-VTF_TANGENT_BITANGENT      = (1<<3)
-VTF_UV1     = (1<<4)
-VTF_COLOR   = (1<<5)
-VTF_BONE_DATA   = (1<<6)
-VTF_TWEEN   = (1<<7)
-
-VTF_DEFAULT = VTF_POS | VTF_NORMAL | VTF_UV0
-
-
-# helper to make binary buffer
-def make_buffer(format, data):
-    buf = array.array(format, data)
-    if sys.byteorder != 'little':
-        buf.byteswap()
-    return buf
-
-# compute bytes per vertex
-def bytesPerVertex(vtx_format):
-    totalSize = 0
-    if vtx_format & VTF_POS: totalSize += 12
-    if vtx_format & VTF_NORMAL: totalSize += 12
-    if vtx_format & VTF_UV0: totalSize += 8
-    if vtx_format & VTF_TANGENT_BITANGENT: totalSize += 24
-    if vtx_format & VTF_UV1: totalSize += 8
-    if vtx_format & VTF_COLOR: totalSize += 12
-    if vtx_format & VTF_BONE_DATA: totalSize += 20
-
-    return totalSize
-##
-
-def extract_buffers(mesh, format):
+# source + loops (source loop of every loop of mesh) take the tangents
+# out of the source snapshot instead of computing them on this mesh again
+def extract_buffers(mesh, format, tolerances=None, source=None, loops=None):
     m = mesh #bpy.data.meshes.new("Shit")
 
-    # compute tangent first?
-    m.calc_tangents()
-    # loop data + vertices
-    loops = m.loops
-    verts = m.vertices
-    uvs = m.uv_layers
-
-    # check format
-    if format & VTF_UV0:
-        if len(uvs) < 1:
-            raise Exception("Requested uv0, but no uv map at all!")
-
-    if format & VTF_UV1:
-        if len(uvs) < 2:
-            raise Exception("Requested uv1, but no second uv layer!")
-
-    # unique vertices
-    u_verts = []
-
-    # indices per materials
-    indices = []
-    for mat in m.materials:
-        indices.append([])
-
-    # loop over polys (already triangulated)
-    for p in m.polygons:
-        # our triangle index
-        tri = []
-        for l_id in p.loop_indices:
-            l = loops[l_id]
-            # compute vertex data
-            u_vert = []
-
-            if format & VTF_POS:
-                v = verts[l.vertex_index].co
-                u_vert.append([v.x, v.z, -v.y])
-
-            if format & VTF_NORMAL:
-                n = l.normal
-                u_vert.append([n.x, n.z, -n.y])
-
-            if format & VTF_UV0:
-                uv = uvs[0].data[l_id].uv
-                u_vert.append([uv.x, uv.y])
-
-            if format & VTF_TANGENT_BITANGENT:
-                tgt = l.tangent
-                btg = l.bitangent
-                u_vert.append([tgt.x, tgt.z, -tgt.y, btg.x, btg.z, -btg.y])
-            
-            if format & VTF_UV1:
-                uv = uvs[1].data[l_id].uv
-                u_vert.append([uv.x, uv.y])
-
-            # get its index
-            if u_vert not in u_verts:
-                u_verts.append(u_vert)
-            
-            v_idx = u_verts.index(u_vert)
-            tri.append(v_idx)
-        # add to appropriate mat_id?
-        indices[p.material_index].append(tri)
-    
-    # return tuple of vb, ib
-    return (u_verts, indices)
+    # compute tangent first? (only when needed)
+    tangents = (format & VTF_TANGENT_BITANGENT) != 0
+    snap = MeshSnapshot(m, tangents and source is None)
+    if tangents and source is not None:
+        snap.sliceTangents(source, loops)
+    # polys are already triangulated, so loop triangles are in polygon order
+    return extract_arrays(snap, np.arange(snap.triCount()), format, tolerances)
+
+# extract buffers of a leaf
+# by default it's sliced straight out of the source snapshot (tangents
+# computed once on the whole mesh), use_temp_mesh falls back to the old
+# way of building a temporary split mesh and extracting that (its loops
+# are the leaf triangles' loops in order, so tangents still get sliced)
+def extract_leaf(node, snapshot, format, tolerances=None, use_temp_mesh=False):
+    if not use_temp_mesh:
+        return extract_arrays(snapshot, node.polys, format, tolerances)
+
+    mo = builder.createSplitMesh(node, snapshot, split_tolerances(tolerances))
+    (vb, ib) = extract_buffers(mo, format, tolerances, snapshot, snapshot.tri_loops[node.polys].ravel())
+    builder.deleteMeshObject(mo)
+    return (vb, ib)
+
+# snapshot of an object's mesh, with modifiers applied through the
+# depsgraph if asked (the evaluated mesh is temporary, nothing gets
+# created in bpy.data)
+def snapshot_object(context, obj, tangents=False, use_modifiers=False):
+    if not use_modifiers:
+        return MeshSnapshot(obj.data, tangents)
+    eo = obj.evaluated_get(context.evaluated_depsgraph_get())
+    m = eo.to_mesh()
+    try:
+        snap = MeshSnapshot(m, tangents)
+        snap.name = obj.data.name
+    finally:
+        eo.to_mesh_clear()
+    return snap
+
+# one snapshot out of mesh objects, no joined mesh needed
+# world applies every object's world matrix, materials get merged by
+# material slot so the same material is one submesh for all objects
+def snapshot_objects(context, objects, tangents=False, world=False, use_modifiers=False):
+    # the old single mesh export, untouched
+    if len(objects) == 1 and not world:
+        return snapshot_object(context, objects[0], tangents, use_modifiers)
+
+    parts = []
+    for o in objects:
+        snap = snapshot_object(context, o, tangents, use_modifiers)
+        matrix = np.array(o.matrix_world) if world else None
+        parts.append((snap, matrix, [slot.material for slot in o.material_slots]))
+        instrument.count("objects")
+
+    name = objects[0].name
+    if len(objects) > 1:
+        name = "%s+%d" % (name, len(objects) - 1)
+    return merge_snapshots(parts, name, tangents)
+
+# python binary for worker processes (before 2.91 sys.executable is blender)
+def worker_executable():
+    return getattr(bpy.app, "binary_path_python", None)
+
+# map leaf node -> mesh id
+def leaf_mesh_ids(leaves):
+    return dict((n, mesh_id) for (mesh_id, n) in enumerate(leaves))
+
+# map node -> first LOD mesh id, LOD meshes come after the leaf meshes,
+# lod_count of them per node, in lod_nodes order
+def lod_mesh_ids(leaves, lod_nodes, lod_count):
+    first = len(leaves)
+    return dict((n, first + i * lod_count) for (i, n) in enumerate(lod_nodes))
 
 # return tuple of vertexbuffer, indexbuffer
 def write_node_ascii(file, node, mesh_id):
     parent_id = -1
     if node.parent:
         parent_id = node.parent._id
-    bmin = (
-        min(node.aabb.min[0], node.aabb.max[0]),
-        min(node.aabb.min[2], node.aabb.max[2]),
-        min(-node.aabb.min[1], -node.aabb.max[1]),
-    )
-
-    bmax = (
-        max(node.aabb.min[0], node.aabb.max[0]),
-        max(node.aabb.min[2], node.aabb.max[2]),
-        max(-node.aabb.min[1], -node.aabb.max[1]),
-    )
+    # tree is built on snapshot, already in Y-up space
+    bmin = node.aabb.min
+    bmax = node.aabb.max
     txt = "node[%d]: parent(%d), aabb(%.2f %.2f %.2f | %.2f %.2f %.2f) mesh_id(%d)\n" % (
         node._id, parent_id, bmin[0], bmin[1], bmin[2],
         bmax[0], bmax[1], bmax[2], mesh_id
     )
     file.write(txt)
 
-def write_ascii(filepath, tree, mesh, me, format=VTF_DEFAULT):
+def write_ascii(filepath, tree, mesh, me, format=VTF_DEFAULT, tolerances=None, use_temp_mesh=False, workers=1, cache_size=0, reorder_fetch=False, cache=None, progress=None):
     f = open(filepath, "w")
-
-    goodNodes = builder.collectGoodLeaves(tree)
-
-    me.report({'INFO'}, "writing headers...")
-
-    f.write("name: %s\n" % (mesh.name))
-    f.write("node_count: %d\n" % (builder.nodeCount(tree)))
-    f.write("mesh_objects: %d\n" % (len(goodNodes)))
-    f.write("submesh_per_object: %d\n" % (len(mesh.materials)))
-
-    # write node data
-    queue = [tree]
-
-    while len(queue):
-        n = queue.pop(0)
-        # do something
-        mesh_id = -1
-        if n in goodNodes:
-            mesh_id = goodNodes.index(n)
-
-        write_node_ascii(f, n, mesh_id)
-
-        if not n.isLeaf():
-            queue.append(n.children[0])
-            queue.append(n.children[1])
-
-    # write mesh data
-    for (id, n) in enumerate(goodNodes):
-        mo = builder.createSplitMesh(n, mesh)
-        # do something
-        (vb, ib) = extract_buffers(mo, format)
-        f.write("mesh[%d]: name(%s) vertex_count(%d) unique_verts(%d) poly_count(%d)\n" % (id, mo.name, len(mo.vertices), len(vb), len(mo.polygons)))
-
-        # write vb?
-        for (id, v) in enumerate(vb):
-            str = "v[%d]:" % id
-            # depending on format
-            c = 0
-            if format & VTF_POS:
-                d = v[c]
-                str += " pos(%.2f %.2f %.2f)" % (d[0], d[1], d[2])
-                c+=1
-            if format & VTF_NORMAL:
-                d = v[c]
-                str += " norm(%.2f %.2f %.2f)" % (d[0], d[1], d[2])
-                c+=1
-            if format & VTF_UV0:
-                d = v[c]
-                str += " uv0(%.2f %.2f)" % (d[0], d[1])
-                c+=1
-            if format & VTF_TANGENT_BITANGENT:
-                d = v[c]
-                str += " tgt(%.2f %.2f %.2f | %.2f %.2f %.2f)" % (d[0], d[1], d[2], d[3], d[4], d[5])
-                c+=1
-            if format & VTF_UV1:
-                d = v[c]
-                str += " uv1(%.2f %.2f)" % (d[0], d[1])
-                c+=1
-            str += "\n"
-            f.write(str)
-        
-        # write ib
-        for (id, ids) in enumerate(ib):
-            f.write("submesh[%d]: tris(%d)\n" % (id, len(ids)))
-            # write all of em
-            for (t_id, t) in enumerate(ids):
-                str = "t[%d]:" % t_id
-                for v_idx in t:
-                    str += " %d" % v_idx
+    try:
+        goodNodes = builder.collectGoodLeaves(tree)
+
+        me.report({'INFO'}, "writing headers...")
+
+        f.write("name: %s\n" % (mesh.name))
+        f.write("node_count: %d\n" % (builder.nodeCount(tree)))
+        f.write("mesh_objects: %d\n" % (len(goodNodes)))
+        f.write("submesh_per_object: %d\n" % (len(mesh.materials)))
+
+        # write node data
+        queue = [tree]
+        mesh_ids = leaf_mesh_ids(goodNodes)
+
+        while len(queue):
+            n = queue.pop(0)
+            # do something
+            mesh_id = mesh_ids.get(n, -1)
+
+            write_node_ascii(f, n, mesh_id)
+
+            if not n.isLeaf():
+                queue.append(n.children[0])
+                queue.append(n.children[1])
+
+        # write mesh data (no need to encode for ascii)
+        pipe = pipeline.LeafPipeline(mesh, format, tolerances, use_temp_mesh, False, workers, worker_executable(), cache_size, reorder_fetch, cache=cache)
+        if progress is not None:
+            progress.setPhase("meshes", len(goodNodes))
+        for (id, leaf) in enumerate(pipe.run(goodNodes)):
+            n = leaf.node
+            vb = leaf.vb
+            ib = leaf.ib
+            f.write("mesh[%d]: name(%s) vertex_count(%d) unique_verts(%d) poly_count(%d)\n" % (id, "SPLIT_%d" % n._id, split_vertex_count(mesh, n.polys, tolerances), len(vb[0]) if len(vb) else 0, len(n.polys)))
+
+            # write vb?
+            vcols = [c.tolist() for c in vb]
+            vcount = len(vb[0]) if len(vb) else 0
+            for id in range(vcount):
+                str = "v[%d]:" % id
+                # depending on format
+                c = 0
+                if format & VTF_POS:
+                    d = vcols[c][id]
+                    str += " pos(%.2f %.2f %.2f)" % (d[0], d[1], d[2])
+                    c+=1
+                if format & VTF_NORMAL:
+                    d = vcols[c][id]
+                    str += " norm(%.2f %.2f %.2f)" % (d[0], d[1], d[2])
+                    c+=1
+                if format & VTF_UV0:
+                    d = vcols[c][id]
+                    str += " uv0(%.2f %.2f)" % (d[0], d[1])
+                    c+=1
+                if format & VTF_TANGENT_BITANGENT:
+                    d = vcols[c][id]
+                    str += " tgt(%.2f %.2f %.2f | %.2f %.2f %.2f)" % (d[0], d[1], d[2], d[3], d[4], d[5])
+                    c+=1
+                if format & VTF_UV1:
+                    d = vcols[c][id]
+                    str += " uv1(%.2f %.2f)" % (d[0], d[1])
+                    c+=1
                 str += "\n"
                 f.write(str)
-        # discard
-        builder.deleteMeshObject(mo)
-    
+        
+            # write ib
+            for (id, ids) in enumerate(ib):
+                f.write("submesh[%d]: tris(%d)\n" % (id, len(ids)))
+                # write all of em
+                for (t_id, t) in enumerate(ids.tolist()):
+                    str = "t[%d]:" % t_id
+                    for v_idx in t:
+                        str += " %d" % v_idx
+                    str += "\n"
+                    f.write(str)
+            if progress is not None:
+                progress.step()
+    except BaseException:
+        # cancelled or blew up, don't leave half a file behind
+        f.close()
+        os.remove(filepath)
+        raise
+
     # close
     f.close()
 
+    pipe.check()
+    me.report({'INFO'}, "leaf pipeline: %s" % pipe.summary())
+
 
 # write the tree, but in binary file
+# (version 2+ only) 4b: "LMF" + 1b version
 # 1b: vertex_format
 # 1b: bytes_per_vertex
 # 2b: node_count
 # 2b: mesh_obj_count
 # 2b: material_count (submeshes per mesh)
 # 32b: object_name
+# (version 4+ only) 4b: vertex_packing
+# (version 6+ only) 4b: compression
+# {
+#  - 1b: codec (COMPRESS_NONE, COMPRESS_ZLIB, COMPRESS_LZMA)
+#  - 1b: level
+#  - 1b: filters (FILTER_SHUFFLE, FILTER_DELTA)
+#  - 1b: padding
+# }
 # [node_count x 36b](nodes), which has: 
 # {
 #  - 4b: id
 #  - 4b: parent_id (-1 if no parent)
 #  - 24b: 6 float (aabb min - max)
 #  - 4b: mesh_object_id (-1 if no mesh_object)
+#  - (version 5+ only) 4b: lod_mesh_id (-1 if no LODs), LOD i is mesh lod_mesh_id + i
+#  - (version 5+ only) 4b: lod_count
 # }
+# (version 2+ only) [mesh_obj_count x 12b (16b version 6+)](mesh directory), which has:
+# {
+#  - 8b: absolute file offset of the mesh block
+#  - 4b: mesh_data_block_size
+#  - (version 6+ only) 4b: stored size of the block in the file
+# }
+# (version 5+ only) [sum of node lod_count x 12b](LOD table), one per LOD
+# mesh in mesh order, which has:
+# {
+#  - 4b: node_id
+#  - 4b: level (0 = finest)
+#  - 4b: error (object space distance, see simplify.py)
+# }
+# mesh_obj_count counts the LOD meshes too, they're regular mesh blocks
+# after the leaf meshes
 # [mesh_obj_count x (4b + material_count x 4b + bytes_per_vertex x vertex_count + triangle_count x 6b)](meshes), which has:
 # {
-#  - 4b: mesh_data_block_size (how many bytes until the end of this mesh, after this 4b here)
+#  - 4b: mesh_data_block_size (how many bytes until the end of this mesh, counting this 4b too)
 #  - 2b: vertex_count
 #  - 2b: triangle_count
 #  - [material_count x 4b](submesh_data)
@@ -249,41 +268,172 @@ def write_ascii(filepath, tree, mesh, me, format=VTF_DEFAULT):
 #  - { vertex_buffers }
 #  - [triangle_count x 3 x 2b]{ index_buffers }
 # }
-def write_binary(filepath, tree, mesh, me, format=VTF_DEFAULT):
-    print("BINARY_WRITE: %s" % filepath)
-
-    f = open(filepath, "wb")
+# version 3+ mesh blocks instead have:
+# {
+#  - 4b: mesh_data_block_size
+#  - 4b: vertex_count
+#  - 4b: triangle_count
+#  - 1b: flags (MESH_INDEX32: indices are 4b)
+#  - 3b: padding
+#  - (version 4+ only) 56b: decode params, value = offset + q * scale
+#  - {
+#     - 12b: pos_offset, 12b: pos_scale
+#     - 16b: uv_offset (uv0, uv1), 16b: uv_scale (uv0, uv1)
+#  - }
+#  - [material_count x 8b](submesh_data)
+#  - {
+#     - 4b: start_idx (byte offset)
+#     - 4b: num_elems -> triangle_count x 3
+#  - }
+#  - { vertex_buffers }
+#  - [triangle_count x 3 x (2b or 4b)]{ index_buffers }
+#  - (MESH_MESHLETS flag only) padding to 4b, then the meshlet section:
+#  - {
+#     - 4b: meshlet_count
+#     - 4b: meshlet_vertex_count
+#     - 4b: meshlet_triangle_count
+#     - [meshlet_count x 56b](meshlets)
+#     - {
+#        - 4b: vertex_offset (into meshlet vertices)
+#        - 4b: triangle_offset (into meshlet triangles)
+#        - 1b: vertex_count
+#        - 1b: triangle_count
+#        - 2b: submesh
+#        - 16b: bounding sphere (center xyz, radius)
+#        - 28b: normal cone (apex xyz, axis xyz, cutoff)
+#     - }
+#     - [meshlet_vertex_count x (2b or 4b, same as the indices)](meshlet vertices, padded to 4b)
+#     - [meshlet_triangle_count x 3 x 1b](meshlet triangles, padded to 4b)
+#  - }
+# }
+# version 6+ with a codec: every block is the above, filtered (see
+# layout.filter_block) and compressed on its own, stored_size bytes long
+def write_binary(filepath, tree, mesh, me, format=VTF_DEFAULT, tolerances=None, use_temp_mesh=False, workers=1, version=LMF_VERSION, cache_size=0, reorder_fetch=False, meshlet_limits=None, lod_ratios=None, cache=None, progress=None, compression=None):
+    # packed vertices only exist from version 4
+    if format & VTF_PACK_MASK:
+        check_packing(format)
+        if version < LMF_VERSION_PACKED:
+            me.report({'INFO'}, "Packed vertex format needs version %d, writing that instead of %d" % (LMF_VERSION_PACKED, version))
+            version = LMF_VERSION_PACKED
+
+    # meshlets need the mesh header flags of version 3
+    if meshlet_limits is not None and version < LMF_VERSION_WIDE:
+        me.report({'INFO'}, "Meshlets need version %d, writing that instead of %d" % (LMF_VERSION_WIDE, version))
+        version = LMF_VERSION_WIDE
+
+    # LOD meshes are referenced from the version 5 node records
+    if lod_ratios and version < LMF_VERSION_LOD:
+        me.report({'INFO'}, "LODs need version %d, writing that instead of %d" % (LMF_VERSION_LOD, version))
+        version = LMF_VERSION_LOD
+
+    # compression is (codec, level, filters), blocks only get compressed
+    # from version 6
+    if compression is not None and compression[0] == COMPRESS_NONE:
+        compression = None
+    if compression is not None and version < LMF_VERSION_COMPRESSED:
+        me.report({'INFO'}, "Compression needs version %d, writing that instead of %d" % (LMF_VERSION_COMPRESSED, version))
+        version = LMF_VERSION_COMPRESSED
+
+    log(INFO, "BINARY_WRITE: %s (version %d)", filepath, version)
 
     # collect good leaves
     goodLeaves = builder.collectGoodLeaves(tree)
 
-    # write header
-    wb_header(f, format, bytesPerVertex(format), builder.nodeCount(tree), len(goodLeaves), len(mesh.materials), mesh.name)
-
-    # write node data
-    queue = [tree]
-    while len(queue):
-        n = queue.pop(0)
-        mesh_id = -1
-        if n in goodLeaves:
-            mesh_id = goodLeaves.index(n)
-
-        wb_node(f, n, mesh_id)
+    # and the nodes getting LOD chains
+    lod_count = len(lod_ratios) if lod_ratios else 0
+    lod_nodes = builder.collectLodNodes(tree) if lod_count else []
+    mesh_count = len(goodLeaves) + len(lod_nodes) * lod_count
+    if mesh_count > 0xFFFF:
+        raise Exception("%d leaf + LOD meshes, the header only counts up to %d! Use fewer LOD levels or a shallower tree" % (mesh_count, 0xFFFF))
 
-        if not n.isLeaf():
-            queue.append(n.children[0])
-            queue.append(n.children[1])
+    f = open(filepath, "wb")
+    try:
+        # write header
+        if version >= LMF_VERSION_DIRECTORY:
+            wb_version(f, version)
+        wb_header(f, format, bytesPerVertex(format), builder.nodeCount(tree), mesh_count, len(mesh.materials), mesh.name)
+        if version >= LMF_VERSION_PACKED:
+            wb_packing(f, format)
+        if version >= LMF_VERSION_COMPRESSED:
+            wb_compression(f, compression)
+        instrument.count("bytes.header", f.tell())
+
+        # write node data
+        section = f.tell()
+        queue = [tree]
+        mesh_ids = leaf_mesh_ids(goodLeaves)
+        lod_ids = lod_mesh_ids(goodLeaves, lod_nodes, lod_count)
+        while len(queue):
+            n = queue.pop(0)
+            mesh_id = mesh_ids.get(n, -1)
+
+            wb_node(f, n, mesh_id, version, lod_ids.get(n, -1), lod_count if n in lod_ids else 0)
+
+            if not n.isLeaf():
+                queue.append(n.children[0])
+                queue.append(n.children[1])
+        instrument.count("bytes.nodes", f.tell() - section)
+
+        # reserve the directory, filled once the block sizes are known
+        directory = None
+        if version >= LMF_VERSION_DIRECTORY:
+            directory = np.zeros(mesh_count, dtype=directory_dtype(version))
+            directory_offset = f.tell()
+            f.write(directory.tobytes())
+            instrument.count("bytes.directory", directory.nbytes)
+
+        # same for the LOD table, errors are known once the LODs are built
+        lods = None
+        if version >= LMF_VERSION_LOD:
+            lods = np.zeros(mesh_count - len(goodLeaves), dtype=LOD_DTYPE)
+            lods_offset = f.tell()
+            f.write(lods.tobytes())
+            instrument.count("bytes.lod_table", lods.nbytes)
+
+        # write mesh, every leaf is extracted + encoded once, LOD meshes after
+        pipe = pipeline.LeafPipeline(mesh, format, tolerances, use_temp_mesh, True, workers, worker_executable(), cache_size, reorder_fetch, meshlet_limits, lod_ratios, cache)
+        meshes = itertools.chain(pipe.run(goodLeaves), pipe.lodLeaves(lod_nodes))
+        if progress is not None:
+            progress.setPhase("meshes", mesh_count)
+        for (mesh_id, leaf) in enumerate(meshes):
+            offset = f.tell()
+            with stage("write"):
+                block_size = wb_mesh_data(f, leaf, format, version, compression)
+            if directory is not None:
+                directory[mesh_id]['offset'] = offset
+                directory[mesh_id]['block_size'] = block_size
+                if version >= LMF_VERSION_COMPRESSED:
+                    directory[mesh_id]['stored_size'] = f.tell() - offset
+            if leaf.lod is not None:
+                (level, error) = leaf.lod
+                lods[mesh_id - len(goodLeaves)] = (leaf.node._id, level, error)
+            if progress is not None:
+                progress.step()
+
+        if directory is not None:
+            wb_directory(f, directory_offset, directory)
+        if lods is not None:
+            wb_lod_table(f, lods_offset, lods)
+    except BaseException:
+        # cancelled or blew up, don't leave half a file behind
+        f.close()
+        os.remove(filepath)
+        raise
 
-    # write mesh
-    for n in goodLeaves:
-        mo = builder.createSplitMesh(n, mesh)
+    f.close()
 
-        (vb, ib) = extract_buffers(mo, format)
-        wb_mesh_data(f, mo, format)
+    pipe.check()
+    me.report({'INFO'}, "leaf pipeline: %s" % pipe.summary())
+    if compression is not None and directory is not None:
+        raw = int(directory['block_size'].sum())
+        stored = int(directory['stored_size'].sum())
+        me.report({'INFO'}, "compression: %s level %d, meshes %.2fMB -> %.2fMB (ratio %.2f)" % (
+            COMPRESS_NAMES[compression[0]], compression[1], raw / (1024 * 1024), stored / (1024 * 1024), raw / max(stored, 1)))
 
-        builder.deleteMeshObject(mo)
-
-    f.close()
+# 3b: "LMF"
+# 1b: version
+def wb_version(file, version):
+    file.write(LMF_MAGIC + make_buffer('B', [version]).tobytes())
 
 # 1b: vertex_format
 # 1b: bytes_per_vertex
@@ -293,45 +443,51 @@ def write_binary(filepath, tree, mesh, me, format=VTF_DEFAULT):
 # 32b: object_name
 def wb_header(file, format, bpv, node_count, mesh_count, submesh_count, name):
     f = file
-    f.write(make_buffer('B', [format, bpv]))
+    # packing flags don't fit, they go in wb_packing
+    f.write(make_buffer('B', [format & 0xFF, bpv]))
     f.write(make_buffer('H', [node_count, mesh_count, submesh_count]))
     b = bytearray(name, 'utf-8')
     pb = b.ljust(32, b'\0')
     f.write(pb)
 
+# 4b: vertex_packing (VTF_PACK_xxx flags of the vertex format)
+def wb_packing(file, format):
+    file.write(make_buffer('I', [format & VTF_PACK_MASK]))
+
+# 1b: codec, 1b: level, 1b: filters, 1b: padding
+def wb_compression(file, compression):
+    (codec, level, filters) = compression if compression is not None else (COMPRESS_NONE, 0, 0)
+    file.write(make_buffer('B', [codec, level, filters, 0]))
+
 # [node_count x 36b](nodes), which has: 
 # {
 #  - 4b: id
 #  - 4b: parent_id (-1 if no parent)
 #  - 24b: 6 float (aabb min - max)
 #  - 4b: mesh_object_id (-1 if no mesh_object)
+#  - (version 5+ only) 4b: lod_mesh_id (-1 if no LODs)
+#  - (version 5+ only) 4b: lod_count
 # }
-def wb_node(file, node, mesh_id=1):
+def wb_node(file, node, mesh_id=1, version=LMF_VERSION, lod_mesh_id=-1, lod_count=0):
     f = file
     parent_id = -1
     if node.parent:
         parent_id = node.parent._id
     
-    f.write(make_buffer('l', [node._id, parent_id]))
-    # recompute bbox (rotation)
-    bmin = (
-        min(node.aabb.min[0], node.aabb.max[0]),
-        min(node.aabb.min[2], node.aabb.max[2]),
-        min(-node.aabb.min[1], -node.aabb.max[1]),
-    )
-
-    bmax = (
-        max(node.aabb.min[0], node.aabb.max[0]),
-        max(node.aabb.min[2], node.aabb.max[2]),
-        max(-node.aabb.min[1], -node.aabb.max[1]),
-    )
+    f.write(make_buffer('i', [node._id, parent_id]))
+    # tree is built on snapshot, already in Y-up space
+    bmin = node.aabb.min
+    bmax = node.aabb.max
     f.write(make_buffer('f', [bmin[0], bmin[1], bmin[2], bmax[0], bmax[1], bmax[2]]))
-    f.write(make_buffer('l', [mesh_id]))
+    f.write(make_buffer('i', [mesh_id]))
+    if version >= LMF_VERSION_LOD:
+        f.write(make_buffer('i', [lod_mesh_id, lod_count]))
 
-# write mesh data
+# write mesh data, return its block size (uncompressed)
+# (version 3+ header is different, see write_binary)
 # [mesh_obj_count x (4b + material_count x 4b + bytes_per_vertex x vertex_count + triangle_count x 6b)](meshes), which has:
 # {
-#  - 4b: mesh_data_block_size (how many bytes until the end of this mesh, after this 4b here)
+#  - 4b: mesh_data_block_size (how many bytes until the end of this mesh, counting this 4b too)
 #  - 2b: vertex_count
 #  - 2b: triangle_count
 #  - [material_count x 4b](submesh_data)
@@ -342,81 +498,190 @@ def wb_node(file, node, mesh_id=1):
 #  - { vertex_buffers }
 #  - [triangle_count x 3 x 2b]{ index_buffers }
 # }
-def wb_mesh_data(file, mesh, format):
+def wb_mesh_data(file, leaf, format, version=LMF_VERSION, compression=None):
     f = file
-    (vb, ib) = extract_buffers(mesh, format)
-    vsize = bytesPerVertex(format)
-    vcount = len(vb)
-    pcount = len(mesh.polygons)
-    smcount = len(mesh.materials)
-    block_size = 4 + 4 + smcount * 4 + vcount * vsize + pcount * 6
-
-    # write mesh header
-    f.write(make_buffer('L', [block_size]))
-    f.write(make_buffer('H', [vcount, pcount]))
-    # write start and end?
-    offset = 0
-    for ids in ib:
-        start = offset
-        elem_count = len(ids) * 3
-        f.write(make_buffer('H', [start, elem_count]))
-        offset += elem_count * 2
-    # write vbuffer?
-    for v in vb:
-        d = 0
-        if format & VTF_POS:
-            data = v[d]
-            f.write(make_buffer('f', data))
-            d+=1
-        if format & VTF_NORMAL:
-            data = v[d]
-            f.write(make_buffer('f', data))
-            d+=1
-        if format & VTF_UV0:
-            data = v[d]
-            f.write(make_buffer('f', data))
-            d+=1
-        if format & VTF_TANGENT_BITANGENT:
-            data = v[d]
-            f.write(make_buffer('f', data))
-            d+=1
-        if format & VTF_UV1:
-            data = v[d]
-            f.write(make_buffer('f', data))
-            d+=1
-    # write id buffer
-    for ids in ib:
-        for t in ids:
-            f.write(make_buffer('H', t))
-
-
-
-def do_write_tree(context, filepath, format, me, max_depth, criterion, max_threshold, write_mode):
-    print("Should have written the tree in format(%d), max_depth(%d), max_%s(%.2f) in %s" % (
-        format, max_depth, criterion, max_threshold, write_mode
-    ))
+    vcount = leaf.vertex_count
+    pcount = leaf.triangle_count
+    smcount = len(leaf.submeshes)
+
+    # older versions are u16 all the way
+    if version < LMF_VERSION_WIDE and not fits_legacy(vcount, pcount):
+        raise Exception("Leaf[%d] has %d vertices, %d triangles, too big for version %d! Use version %d or split oversize leaves" % (
+            leaf.node._id, vcount, pcount, version, LMF_VERSION_WIDE
+        ))
+
+    # encode now if the pipeline didn't
+    if not leaf.isEncoded():
+        leaf.vertex_bytes = encode_vertices(leaf.vb, format)
+        leaf.index_bytes = encode_indices(leaf.ib, leaf.index_size)
+        if leaf.meshlets is not None:
+            leaf.meshlet_bytes = meshlet.encode_meshlets(leaf.meshlets, leaf.index_size)
+
+    # optional sections after the index buffer, 4b aligned
+    tail = []
+    if leaf.meshlet_bytes is not None and version >= LMF_VERSION_WIDE:
+        tail.append(b'\0' * (-len(leaf.index_bytes) % 4))
+        tail.append(leaf.meshlet_bytes)
+    tail_size = sum(len(t) for t in tail)
+
+    # mesh header + start and end of submeshes
+    if version >= LMF_VERSION_WIDE:
+        flags = MESH_INDEX32 if leaf.index_size == 4 else 0
+        if leaf.meshlet_bytes is not None:
+            flags |= MESH_MESHLETS
+        block_size = 16 + smcount * 8 + len(leaf.vertex_bytes) + len(leaf.index_bytes) + tail_size
+        header = [make_buffer('I', [block_size, vcount, pcount]), make_buffer('B', [flags, 0, 0, 0])]
+        # dequantization params, same as the encoder used
+        if version >= LMF_VERSION_PACKED:
+            block_size += DECODE_DTYPE.itemsize
+            header[0] = make_buffer('I', [block_size, vcount, pcount])
+            header.append(vertex_decode(leaf.vb, format))
+        for (start, elem_count) in leaf.submeshes:
+            header.append(make_buffer('I', [start, elem_count]))
+    else:
+        block_size = 4 + 4 + smcount * 4 + len(leaf.vertex_bytes) + len(leaf.index_bytes)
+        header = [make_buffer('I', [block_size]), make_buffer('H', [vcount, pcount])]
+        for (start, elem_count) in leaf.submeshes:
+            header.append(make_buffer('H', [start, elem_count]))
+
+    # whole block in one write
+    block = b''.join([h.tobytes() for h in header] + [leaf.vertex_bytes, leaf.index_bytes] + tail)
+    if compression is not None:
+        (codec, level, filters) = compression
+        # shuffle stride of the vertices actually written, same as the reader
+        # (bytesPerVertex counts the unimplemented attributes too)
+        with stage("compress"):
+            block = compress_block(block, codec, level, filters, smcount, vertex_dtype(format).itemsize)
+        instrument.count("bytes.stored", len(block))
+    f.write(block)
+    instrument.count("bytes.meshes", block_size)
+    instrument.count("bytes.vertices", len(leaf.vertex_bytes))
+    instrument.count("bytes.indices", len(leaf.index_bytes))
+    if tail_size:
+        instrument.count("bytes.meshlets", tail_size)
+    return block_size
+
+# [mesh_obj_count x 12b (16b version 6+)](mesh directory), written over
+# the reserved space after the nodes, file position is left at the end
+def wb_directory(file, directory_offset, directory):
+    f = file
+    end = f.tell()
+    f.seek(directory_offset)
+    f.write(directory.tobytes())
+    f.seek(end)
+
+# [lod_mesh_count x 12b](LOD table), same deal as the directory
+def wb_lod_table(file, lods_offset, lods):
+    f = file
+    end = f.tell()
+    f.seek(lods_offset)
+    f.write(lods.astype(LOD_DTYPE).tobytes())
+    f.seek(end)
+
+
+
+def do_write_tree(context, filepath, format, me, max_depth, criterion, max_threshold, write_mode, tolerances=None, strategy="median", node_cost=builder.SAH_NODE_COST, max_duplication=builder.SPATIAL_MAX_DUPLICATION, use_temp_mesh=False, workers=1, version=LMF_VERSION, split_oversize=False, leaf_max_vertices=0xFFFF, leaf_max_bytes=0, cache_size=0, reorder_fetch=False, meshlet_limits=None, lod_ratios=None, cache_dir=None, cache_max_bytes=CACHE_MAX_BYTES, log_level="INFO", profile=False, write_stats=False, selection="active", use_modifiers=False, compression=None, job=None):
+    # fresh timers + counters for this export
+    inst = instrument.begin(log_level, profile, write_stats)
+    log(DEBUG, "Should have written the tree in format(%d), max_depth(%d), max_%s(%.2f), split(%s) in %s",
+        format, max_depth, criterion, max_threshold, strategy, write_mode
+    )
     
     # check if there's a mesh object
     o = context.selected_objects
     if len(o) == 0:
+        instrument.end()
         me.report({'ERROR'}, 'No object selected!')
         return {'CANCELLED'}
-    m = o[0].data
-    if type(m) != bpy_types.Mesh:
-        me.report({'ERROR'}, 'Selected object was not a mesh, doofus!')
-        return {'CANCELLED'}
-
-    # we can go on
-    tree = builder.KDTreeNode(max_threshold, max_depth, criterion, m, True)
-    print("\nDEBUG PRINT: tree contain (%d) nodes\n" % (builder.nodeCount(tree)))
-    tree.print()
-
-    # depending on something
-    if write_mode == "ascii":
-        write_ascii(filepath, tree, m, me, format)
+    if selection == "selected":
+        # every selected mesh, in world space
+        objects = [ob for ob in o if type(ob.data) == bpy_types.Mesh]
+        if len(objects) == 0:
+            instrument.end()
+            me.report({'ERROR'}, 'None of the selected objects is a mesh, doofus!')
+            return {'CANCELLED'}
+        if len(objects) < len(o):
+            me.report({'INFO'}, "Skipping %d selected objects that aren't meshes" % (len(o) - len(objects)))
     else:
-        write_binary(filepath, tree, m, me, format)
+        m = o[0].data
+        if type(m) != bpy_types.Mesh:
+            instrument.end()
+            me.report({'ERROR'}, 'Selected object was not a mesh, doofus!')
+            return {'CANCELLED'}
+        objects = [o[0]]
+
+    try:
+        # snapshot the mesh(es) once, everything below works on its arrays
+        # (tangents too, leaves just slice them)
+        with stage("snapshot"):
+            snap = snapshot_objects(context, objects, (format & VTF_TANGENT_BITANGENT) != 0, selection == "selected", use_modifiers)
+    except BaseException:
+        instrument.end()
+        raise
+
+    # no bpy past this point, so the modal export runs it in the job's thread
+    export = lambda me, progress: write_tree(inst, snap, filepath, format, me, max_depth, criterion, max_threshold, write_mode, tolerances, strategy, node_cost, max_duplication, use_temp_mesh, workers, version, split_oversize, leaf_max_vertices, leaf_max_bytes, cache_size, reorder_fetch, meshlet_limits, lod_ratios, cache_dir, cache_max_bytes, profile, write_stats, progress, compression)
+    if job is not None:
+        job.start(lambda: export(job, job.progress))
+        return {'RUNNING_MODAL'}
+    return export(me, None)
+
+# tree + leaves + file out of the snapshot, progress (see progress.py)
+# gets stepped per mesh written and cancels the export
+def write_tree(inst, snap, filepath, format, me, max_depth, criterion, max_threshold, write_mode, tolerances=None, strategy="median", node_cost=builder.SAH_NODE_COST, max_duplication=builder.SPATIAL_MAX_DUPLICATION, use_temp_mesh=False, workers=1, version=LMF_VERSION, split_oversize=False, leaf_max_vertices=0xFFFF, leaf_max_bytes=0, cache_size=0, reorder_fetch=False, meshlet_limits=None, lod_ratios=None, cache_dir=None, cache_max_bytes=CACHE_MAX_BYTES, profile=False, write_stats=False, progress=None, compression=None):
+    try:
+        # we can go on
+        # keep splitting leaves that wouldn't fit u16 indices
+        leaf_test = None
+        if split_oversize and write_mode != "ascii":
+            leaf_test = leaf_fits(snap, format, tolerances, version)
+        # and the budget criterion until they fit the vertex + byte budget
+        if criterion == "budget":
+            budget = leaf_budget(snap, format, tolerances, version, leaf_max_vertices, leaf_max_bytes)
+            if leaf_test is None:
+                leaf_test = budget
+            else:
+                oversize = leaf_test
+                leaf_test = lambda tris: budget(tris) and oversize(tris)
+
+        if progress is not None:
+            progress.setPhase("tree")
+        with stage("tree"):
+            tree = builder.KDTreeNode(max_threshold, max_depth, criterion, snap, True, strategy, node_cost, leaf_test, max_duplication)
+        log(DEBUG, "tree contain (%d) nodes", builder.nodeCount(tree))
+        (overlap, duplicated) = builder.treeOverlap(tree, snap.triCount())
+        me.report({'INFO'}, "tree: nodes(%d) overlap(%.3f) duplicated(%d, %.1f%%)" % (
+            builder.nodeCount(tree), overlap, duplicated, 100.0 * duplicated / max(snap.triCount(), 1)))
+        tree.print()
+        # the build itself can't stop halfway, but don't touch the file
+        if progress is not None:
+            progress.check()
+
+        # leaves that didn't change since the last export come from here
+        cache = None
+        if cache_dir:
+            cache = LeafCache(cache_dir, cache_max_bytes)
+
+        # depending on something
+        if write_mode == "ascii":
+            write_ascii(filepath, tree, snap, me, format, tolerances, use_temp_mesh, workers, cache_size, reorder_fetch, cache, progress)
+        else:
+            write_binary(filepath, tree, snap, me, format, tolerances, use_temp_mesh, workers, version, cache_size, reorder_fetch, meshlet_limits, lod_ratios, cache, progress, compression)
+
+        if cache is not None:
+            size = cache.trim()
+            me.report({'INFO'}, "leaf cache: %s size(%.2fMB) in %s" % (cache.summary(), size / (1024 * 1024), cache_dir))
+    finally:
+        # profiler + memory tracing off, even if the export blew up
+        instrument.end()
+
+    me.report({'INFO'}, "stats: %s" % inst.summary())
+    if write_stats:
+        inst.writeJson(filepath + ".stats.json", {"file": filepath, "write_mode": write_mode, "format": format})
+        me.report({'INFO'}, "Stats written to %s.stats.json" % filepath)
+    if profile:
+        inst.dumpProfile(filepath + ".prof")
+        me.report({'INFO'}, "Profile written to %s.prof" % filepath)
 
     me.report({'INFO'}, "File written to %s" % filepath)
     return {'FINISHED'}
-
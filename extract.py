@@ -0,0 +1,159 @@
+import numpy as np
+from . import welder
+from .layout import VTF_POS, VTF_NORMAL, VTF_UV0, VTF_TANGENT_BITANGENT, VTF_UV1
+from .layout import LMF_VERSION, LMF_VERSION_WIDE, LMF_VERSION_PACKED, DECODE_DTYPE
+from .layout import index_size, fits_legacy, vertex_dtype
+
+"""
+Author: Bowie
+Leaf extraction out of snapshot arrays, no bpy in here
+
+Works on anything that looks like a MeshSnapshot (positions, loop_vertex,
+normals, tangents, bitangents, uvs, tri_loops, tri_material, materials),
+so worker processes can run it on shared memory views too.
+"""
+
+# build per attribute weld tolerances, in vertex format order
+# tolerances is dict of { VTF_xxx: tolerance }
+def weld_tolerances(format, tolerances=None):
+    if not tolerances:
+        return None
+    tols = []
+    for attr in (VTF_POS, VTF_NORMAL, VTF_UV0, VTF_TANGENT_BITANGENT, VTF_UV1):
+        if format & attr:
+            tols.append(tolerances.get(attr))
+    return tols
+
+# split meshes only weld on [pos, norm]
+def split_tolerances(tolerances=None):
+    if not tolerances:
+        return None
+    return [tolerances.get(VTF_POS), tolerances.get(VTF_NORMAL)]
+
+# gather vertex attributes of loops as columns, in vertex format order
+def loop_attributes(snapshot, loops, format):
+    snap = snapshot
+    uvs = snap.uvs
+
+    # check format
+    if format & VTF_UV0:
+        if len(uvs) < 1:
+            raise Exception("Requested uv0, but no uv map at all!")
+
+    if format & VTF_UV1:
+        if len(uvs) < 2:
+            raise Exception("Requested uv1, but no second uv layer!")
+
+    if format & VTF_TANGENT_BITANGENT:
+        if snap.tangents is None:
+            raise Exception("Requested tangents, but they were not computed!")
+
+    cols = []
+    if format & VTF_POS:
+        cols.append(snap.positions[snap.loop_vertex[loops]])
+    if format & VTF_NORMAL:
+        cols.append(snap.normals[loops])
+    if format & VTF_UV0:
+        cols.append(uvs[0][loops])
+    if format & VTF_TANGENT_BITANGENT:
+        cols.append(np.hstack((snap.tangents[loops], snap.bitangents[loops])))
+    if format & VTF_UV1:
+        cols.append(uvs[1][loops])
+    return cols
+
+# extract vertex + index buffer of triangles (indices into snapshot triangles)
+# vb is list of attribute arrays [unique_count x width] in vertex format order
+# ib is list (one per material) of [tri_count x 3] index arrays
+def extract_arrays(snapshot, tris, format, tolerances=None):
+    snap = snapshot
+    if len(snap.materials) == 0:
+        raise Exception("Mesh has no material, need at least one!")
+
+    # loops of every triangle, in triangle order
+    loops = snap.tri_loops[tris].ravel()
+    cols = loop_attributes(snap, loops, format)
+
+    # unique vertices
+    (first, remap) = welder.weldArrays(cols, weld_tolerances(format, tolerances))
+    vb = [c[first] for c in cols]
+
+    # indices per materials
+    tri_ids = remap.reshape(-1, 3)
+    mat_ids = snap.tri_material[tris]
+    ib = []
+    for mat_id in range(len(snap.materials)):
+        ib.append(tri_ids[mat_ids == mat_id])
+
+    # return tuple of vb, ib
+    return (vb, ib)
+
+# vertex count of a leaf's split mesh (unique position + normal)
+def split_vertex_count(snapshot, tris, tolerances=None):
+    snap = snapshot
+    loops = snap.tri_loops[tris].ravel()
+    pos = snap.positions[snap.loop_vertex[loops]]
+    norm = snap.normals[loops]
+    (first, _) = welder.weldArrays([pos, norm], split_tolerances(tolerances))
+    return len(first)
+
+# vertex count of a leaf's exported vertex buffer
+def leaf_vertex_count(snapshot, tris, format, tolerances=None):
+    loops = snapshot.tri_loops[tris].ravel()
+    cols = loop_attributes(snapshot, loops, format)
+    (first, _) = welder.weldArrays(cols, weld_tolerances(format, tolerances))
+    return len(first)
+
+# make a leaf test for the tree builder: does a leaf of these triangles
+# get written with u16 indices (and u16 everything else for versions
+# before LMF_VERSION_WIDE)?
+def leaf_fits(snapshot, format, tolerances=None, version=LMF_VERSION):
+    def fits(tris):
+        tri_count = len(tris)
+        if version < LMF_VERSION_WIDE:
+            # the index buffer limit hits way before the vertex one
+            return fits_legacy(tri_count * 3, tri_count)
+        # every corner its own vertex is the worst case, no need to weld
+        if index_size(tri_count * 3) == 2:
+            return True
+        return index_size(leaf_vertex_count(snapshot, tris, format, tolerances)) == 2
+    return fits
+
+# mesh block size of a leaf, same as exporter.wb_mesh_data writes it
+# (minus the meshlet section, that one isn't known before building them)
+def leaf_block_size(vertex_count, tri_count, format, material_count, version=LMF_VERSION):
+    # the stride that gets written (bytesPerVertex counts the attributes
+    # that aren't implemented too)
+    vertex_bytes = vertex_count * vertex_dtype(format).itemsize
+    if version < LMF_VERSION_WIDE:
+        return 8 + material_count * 4 + vertex_bytes + tri_count * 6
+    size = 16 + material_count * 8 + vertex_bytes + tri_count * 3 * index_size(vertex_count)
+    if version >= LMF_VERSION_PACKED:
+        size += DECODE_DTYPE.itemsize
+    return size
+
+# welded vertex id of every loop, welding the whole mesh at once, so the
+# unique vertex count of a leaf is how many different ids its loops have
+# (exact without tolerances, close with them, leaves weld on their own)
+def loop_vertex_ids(snapshot, format, tolerances=None):
+    loops = np.arange(len(snapshot.loop_vertex))
+    cols = loop_attributes(snapshot, loops, format)
+    (_, remap) = welder.weldArrays(cols, weld_tolerances(format, tolerances))
+    return remap
+
+# make a leaf test for the "budget" criterion: does a leaf of these
+# triangles stay within max_vertices unique vertices and max_bytes of
+# mesh block (0 = no limit)?
+def leaf_budget(snapshot, format, tolerances=None, version=LMF_VERSION, max_vertices=0xFFFF, max_bytes=0):
+    ids = loop_vertex_ids(snapshot, format, tolerances)
+    material_count = len(snapshot.materials)
+    def within(vertex_count, tri_count):
+        if max_vertices and vertex_count > max_vertices:
+            return False
+        return not max_bytes or leaf_block_size(vertex_count, tri_count, format, material_count, version) <= max_bytes
+    def fits(tris):
+        tri_count = len(tris)
+        # every corner its own vertex is the worst case, no need to count
+        if within(tri_count * 3, tri_count):
+            return True
+        return within(len(np.unique(ids[snapshot.tri_loops[tris]])), tri_count)
+    return fits
@@ -0,0 +1,196 @@
+import sys, time, json, io, cProfile, pstats, tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # windows, peak rss comes from tracemalloc only
+    resource = None
+
+"""
+Author: Bowie
+Logging, stage timers and counters for the export, no bpy in here
+
+ - log(level, fmt, args...) only formats + prints when the level is on
+   (ERROR, WARN, INFO, DEBUG, TRACE). Per node spam (split decisions,
+   tree dump, temp meshes, per leaf optimize stats) is TRACE, so the
+   default INFO export stays quiet on deep trees
+ - with stage("name"): wall + cpu time of a stage, summed over calls
+ - count("name", n): counters (triangles, vertices, bytes.<section>...)
+ - peak memory: max rss of the process (not on windows), plus the
+   tracemalloc peak when memory tracing is on (numpy included)
+ - optional cProfile of the whole export, top functions in the summary
+   json and the raw stats next to the file (.prof)
+
+There's one current Instrument (module level, like the log level), an
+export does begin() ... end() around it, so deep code like the tree
+builder can count without threading it through every call. Stages run
+in worker processes come back with the leaf results and get added as
+summed worker time.
+"""
+
+ERROR = 0
+WARN = 1
+INFO = 2
+DEBUG = 3
+TRACE = 4
+LEVELS = ("ERROR", "WARN", "INFO", "DEBUG", "TRACE")
+
+# how many functions the profile summary keeps
+PROFILE_TOP = 25
+
+class Instrument:
+    def __init__(self, level=INFO, profile=False, trace_memory=False):
+        self.level = level
+        # name -> [calls, wall, cpu]
+        self.stages = {}
+        self.stage_order = []
+        self.counters = {}
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.wall = None
+        self.cpu = None
+
+        self.profiler = None
+        if profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+        self.trace_memory = trace_memory and not tracemalloc.is_tracing()
+        if self.trace_memory:
+            tracemalloc.start()
+        self.traced_peak = None
+
+    def enabled(self, level):
+        return level <= self.level
+
+    def log(self, level, fmt, *args):
+        if level <= self.level:
+            print(fmt % args if args else fmt)
+
+    @contextmanager
+    def stage(self, name):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.addTime(name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    def addTime(self, name, wall, cpu, calls=1):
+        s = self.stages.get(name)
+        if s is None:
+            s = self.stages[name] = [0, 0.0, 0.0]
+            self.stage_order.append(name)
+        s[0] += calls
+        s[1] += wall
+        s[2] += cpu
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    # max rss of this process in bytes, None if unknown
+    def peakRss(self):
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on linux, bytes on mac
+        return peak if sys.platform == "darwin" else peak * 1024
+
+    # stop the clocks, profiler and memory tracing
+    def finish(self):
+        if self.wall is not None:
+            return
+        self.wall = time.perf_counter() - self.start_wall
+        self.cpu = time.process_time() - self.start_cpu
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.trace_memory:
+            self.traced_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    # top functions by cumulative time, list of (function, calls, total, cumulative)
+    def profileTop(self, count=PROFILE_TOP):
+        if self.profiler is None:
+            return []
+        st = pstats.Stats(self.profiler, stream=io.StringIO())
+        rows = []
+        for ((filename, line, func), (cc, nc, tt, ct, callers)) in st.stats.items():
+            rows.append(("%s:%d(%s)" % (filename, line, func), nc, tt, ct))
+        rows.sort(key=lambda r: r[3], reverse=True)
+        return rows[:count]
+
+    def dumpProfile(self, path):
+        if self.profiler is not None:
+            self.profiler.dump_stats(path)
+
+    def summary(self):
+        self.finish()
+        parts = ["total(%.2fs wall, %.2fs cpu)" % (self.wall, self.cpu)]
+        for name in self.stage_order:
+            (calls, wall, cpu) = self.stages[name]
+            parts.append("%s(%.2fs/%.2fs)" % (name, wall, cpu))
+        for (name, n) in sorted(self.counters.items()):
+            if name.startswith("bytes."):
+                parts.append("%s(%.2fMB)" % (name, n / (1024 * 1024)))
+            else:
+                parts.append("%s(%d)" % (name, n))
+        peak = self.peakRss()
+        if peak is not None:
+            parts.append("peak_rss(%.1fMB)" % (peak / (1024 * 1024)))
+        if self.traced_peak is not None:
+            parts.append("peak_traced(%.1fMB)" % (self.traced_peak / (1024 * 1024)))
+        return " ".join(parts)
+
+    def toJson(self):
+        self.finish()
+        return {
+            "wall": self.wall,
+            "cpu": self.cpu,
+            "stages": dict((name, {"calls": s[0], "wall": s[1], "cpu": s[2]}) for (name, s) in self.stages.items()),
+            "counters": dict(self.counters),
+            "peak_rss": self.peakRss(),
+            "peak_traced": self.traced_peak,
+            "profile": [{"function": f, "calls": n, "total": tt, "cumulative": ct} for (f, n, tt, ct) in self.profileTop()],
+        }
+
+    def writeJson(self, path, extra=None):
+        data = self.toJson()
+        if extra:
+            data.update(extra)
+        with open(path, "w") as f:
+            json.dump(data, f, indent=1)
+
+# the current one, replaced by begin()
+_current = Instrument()
+
+def current():
+    return _current
+
+def level_of(name):
+    return LEVELS.index(name.upper())
+
+# fresh instrument for an export, level by name or number
+def begin(level=INFO, profile=False, trace_memory=False):
+    global _current
+    if isinstance(level, str):
+        level = level_of(level)
+    _current = Instrument(level, profile, trace_memory)
+    return _current
+
+# stop the current one, logging stays at its level
+def end():
+    _current.finish()
+    return _current
+
+def log(level, fmt, *args):
+    _current.log(level, fmt, *args)
+
+def enabled(level):
+    return _current.enabled(level)
+
+def stage(name):
+    return _current.stage(name)
+
+def count(name, n=1):
+    _current.count(name, n)
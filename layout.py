@@ -0,0 +1,510 @@
+import sys, array, zlib, lzma
+import numpy as np
+
+"""
+Author: Bowie
+Binary layout of the exported vertex data, no bpy in here
+
+Vertex Format (using bit position to toggle availability):
+(1 << 0) : POSITION
+(1 << 1) : NORMAL
+(1 << 2) : UV0
+(1 << 3) : TANGENT + BITANGENT
+(1 << 4) : UV1 (NOT IMPLEMENTED YET)
+(1 << 5) : COLOR (NOT IMPLEMENTED YET)
+(1 << 6) : BONE_WEIGHTS + IDS (NOT IMPLEMENTED YET)
+(1 << 7) : TWEEN (NOT IMPLEMENTED YET)
+
+Packed encodings (bits above the first byte, version 4+ only):
+(1 << 8) : POSITION as 3x unorm16 (+2b pad) over the mesh's position range
+(1 << 9) : NORMAL as octahedral 2x snorm16
+(1 << 10): NORMAL as snorm 10:10:10:2
+(1 << 11): TANGENT + BITANGENT as snorm 10:10:10:2 tangent, w holding the
+           bitangent sign (bitangent = w * cross(normal, tangent)),
+           needs NORMAL
+(1 << 12): UVs as 2x half float
+(1 << 13): UVs as 2x unorm16 over the mesh's uv range
+Positions and unorm16 uvs dequantize as offset + value * scale, with
+offset/scale stored per mesh (DECODE_DTYPE). The position range is the
+min/max of the mesh's own vertices, which is at most its node's AABB
+(and usually tighter, so finer steps).
+"""
+VTF_POS     = (1<<0)
+VTF_NORMAL  = (1<<1)
+VTF_UV0     = (1<<2)
+VTF_TANGENT_BITANGENT      = (1<<3)
+VTF_UV1     = (1<<4)
+VTF_COLOR   = (1<<5)
+VTF_BONE_DATA   = (1<<6)
+VTF_TWEEN   = (1<<7)
+
+VTF_DEFAULT = VTF_POS | VTF_NORMAL | VTF_UV0
+
+VTF_PACK_POS16  = (1<<8)
+VTF_PACK_NORMAL_OCT16   = (1<<9)
+VTF_PACK_NORMAL_1010102 = (1<<10)
+VTF_PACK_TANGENT    = (1<<11)
+VTF_PACK_UV_HALF    = (1<<12)
+VTF_PACK_UV_UNORM16 = (1<<13)
+
+VTF_PACK_MASK = VTF_PACK_POS16 | VTF_PACK_NORMAL_OCT16 | VTF_PACK_NORMAL_1010102 | VTF_PACK_TANGENT | VTF_PACK_UV_HALF | VTF_PACK_UV_UNORM16
+
+# attributes that actually get written, in vertex format order
+# (flag, field name, float count)
+VTF_ATTRIBUTES = (
+    (VTF_POS, 'pos', 3),
+    (VTF_NORMAL, 'normal', 3),
+    (VTF_UV0, 'uv0', 2),
+    (VTF_TANGENT_BITANGENT, 'tangent', 6),
+    (VTF_UV1, 'uv1', 2),
+)
+
+
+# binary file versions
+# 1: legacy, header + nodes + mesh blocks, nothing in front
+# 2: "LMF" + version byte in front of the header, mesh directory after
+#    the nodes (legacy files never start with 'L', it's not a valid
+#    implemented vertex format)
+# 3: 32 bit counts + submesh ranges in the mesh header, indices are
+#    u16 or u32 per mesh (MESH_INDEX32 flag)
+# 4: packed vertex encoding flags after the header, decode params after
+#    every mesh header
+# 5: LOD mesh range in the node records, LOD table after the directory
+# 6: compression record after the packing field, mesh blocks may be
+#    compressed (each one on its own, so still one lookup away), the
+#    directory also holds the stored size of every block
+LMF_MAGIC = b'LMF'
+LMF_VERSION_LEGACY = 1
+LMF_VERSION_DIRECTORY = 2
+LMF_VERSION_WIDE = 3
+LMF_VERSION_PACKED = 4
+LMF_VERSION_LOD = 5
+LMF_VERSION_COMPRESSED = 6
+LMF_VERSION = LMF_VERSION_COMPRESSED
+
+# mesh block codecs (version 6+), stdlib only
+COMPRESS_NONE = 0
+COMPRESS_ZLIB = 1
+COMPRESS_LZMA = 2
+COMPRESS_NAMES = {COMPRESS_NONE: "none", COMPRESS_ZLIB: "zlib", COMPRESS_LZMA: "lzma"}
+
+# filters run over a block before compressing it, undone after
+# vertex + index buffers as byte planes (byte 0 of every vertex, then
+# byte 1...), neighbouring vertices mostly share their high bytes
+FILTER_SHUFFLE = (1<<0)
+# indices as the difference to the previous index (wrapping), done before
+# the shuffle, optimized index buffers walk the vertices in order
+FILTER_DELTA = (1<<1)
+FILTER_DEFAULT = FILTER_SHUFFLE | FILTER_DELTA
+
+# mesh header flags (version 3+)
+MESH_INDEX32 = (1<<0)
+# meshlet section at the end of the block (counted in its block size)
+MESH_MESHLETS = (1<<1)
+
+# binary file records, see exporter.write_binary for the layout
+VERSION_DTYPE = np.dtype([
+    ('magic', 'S3'),
+    ('version', 'u1'),
+])
+
+HEADER_DTYPE = np.dtype([
+    ('vertex_format', 'u1'),
+    ('bytes_per_vertex', 'u1'),
+    ('node_count', '<u2'),
+    ('mesh_count', '<u2'),
+    ('submesh_count', '<u2'),
+    ('name', 'S32'),
+])
+
+# version 4+, right after HEADER_DTYPE
+PACKING_DTYPE = np.dtype([
+    ('vertex_packing', '<u4'),
+])
+
+# version 6+, right after PACKING_DTYPE, level is informational
+COMPRESSION_DTYPE = np.dtype([
+    ('codec', 'u1'),
+    ('level', 'u1'),
+    ('filters', 'u1'),
+    ('pad', 'u1'),
+])
+
+NODE_DTYPE = np.dtype([
+    ('id', '<i4'),
+    ('parent_id', '<i4'),
+    ('aabb_min', '<f4', (3,)),
+    ('aabb_max', '<f4', (3,)),
+    ('mesh_id', '<i4'),
+])
+
+# version 5+, LOD i of a node is mesh lod_mesh_id + i
+NODE_LOD_DTYPE = np.dtype(NODE_DTYPE.descr + [
+    ('lod_mesh_id', '<i4'),
+    ('lod_count', '<i4'),
+])
+
+def node_dtype(version):
+    if version >= LMF_VERSION_LOD:
+        return NODE_LOD_DTYPE
+    return NODE_DTYPE
+
+# one per LOD mesh, in LOD mesh order (version 5+)
+LOD_DTYPE = np.dtype([
+    ('node_id', '<i4'),
+    ('level', '<i4'),
+    ('error', '<f4'),
+])
+
+MESH_HEADER_DTYPE = np.dtype([
+    ('block_size', '<u4'),
+    ('vertex_count', '<u2'),
+    ('triangle_count', '<u2'),
+])
+
+# version 3+, flags padded to keep the rest 4 byte aligned
+MESH_HEADER_WIDE_DTYPE = np.dtype([
+    ('block_size', '<u4'),
+    ('vertex_count', '<u4'),
+    ('triangle_count', '<u4'),
+    ('flags', 'u1'),
+    ('pad', 'u1', (3,)),
+])
+
+# dequantization params of a mesh (version 4+), value = offset + q * scale
+DECODE_DTYPE = np.dtype([
+    ('pos_offset', '<f4', (3,)),
+    ('pos_scale', '<f4', (3,)),
+    ('uv_offset', '<f4', (2, 2)),
+    ('uv_scale', '<f4', (2, 2)),
+])
+
+# one meshlet, see meshlet.py
+MESHLET_DTYPE = np.dtype([
+    ('vertex_offset', '<u4'),
+    ('triangle_offset', '<u4'),
+    ('vertex_count', 'u1'),
+    ('triangle_count', 'u1'),
+    ('submesh', '<u2'),
+    ('center', '<f4', (3,)),
+    ('radius', '<f4'),
+    ('cone_apex', '<f4', (3,)),
+    ('cone_axis', '<f4', (3,)),
+    ('cone_cutoff', '<f4'),
+])
+
+# absolute file offset + size of every mesh block (version 2+)
+DIRECTORY_DTYPE = np.dtype([
+    ('offset', '<u8'),
+    ('block_size', '<u4'),
+])
+
+# version 6+, stored_size is the block's size in the file (compressed),
+# block_size the size it decompresses to
+DIRECTORY_STORED_DTYPE = np.dtype(DIRECTORY_DTYPE.descr + [
+    ('stored_size', '<u4'),
+])
+
+def directory_dtype(version):
+    if version >= LMF_VERSION_COMPRESSED:
+        return DIRECTORY_STORED_DTYPE
+    return DIRECTORY_DTYPE
+
+# start is a byte offset into the index buffer, count is in indices
+SUBMESH_DTYPE = np.dtype([
+    ('start', '<u2'),
+    ('count', '<u2'),
+])
+
+SUBMESH_WIDE_DTYPE = np.dtype([
+    ('start', '<u4'),
+    ('count', '<u4'),
+])
+
+def mesh_header_dtype(version):
+    if version >= LMF_VERSION_WIDE:
+        return MESH_HEADER_WIDE_DTYPE
+    return MESH_HEADER_DTYPE
+
+def submesh_dtype(version):
+    if version >= LMF_VERSION_WIDE:
+        return SUBMESH_WIDE_DTYPE
+    return SUBMESH_DTYPE
+
+# bytes per index for a mesh of vertex_count vertices
+def index_size(vertex_count):
+    if vertex_count > 0x10000:
+        return 4
+    return 2
+
+# does a mesh fit the u16 everything of versions 1 and 2?
+# (the last submesh start is a byte offset, so keep the whole index
+# buffer under 64k bytes)
+def fits_legacy(vertex_count, triangle_count):
+    return vertex_count <= 0xFFFF and triangle_count * 6 <= 0xFFFF
+
+# helper to make binary buffer
+def make_buffer(format, data):
+    buf = array.array(format, data)
+    if sys.byteorder != 'little':
+        buf.byteswap()
+    return buf
+
+# compute bytes per vertex
+def bytesPerVertex(vtx_format):
+    totalSize = 0
+    if vtx_format & VTF_POS: totalSize += 8 if vtx_format & VTF_PACK_POS16 else 12
+    if vtx_format & VTF_NORMAL: totalSize += 4 if vtx_format & (VTF_PACK_NORMAL_OCT16 | VTF_PACK_NORMAL_1010102) else 12
+    if vtx_format & VTF_UV0: totalSize += 4 if vtx_format & (VTF_PACK_UV_HALF | VTF_PACK_UV_UNORM16) else 8
+    if vtx_format & VTF_TANGENT_BITANGENT: totalSize += 4 if vtx_format & VTF_PACK_TANGENT else 24
+    if vtx_format & VTF_UV1: totalSize += 4 if vtx_format & (VTF_PACK_UV_HALF | VTF_PACK_UV_UNORM16) else 8
+    if vtx_format & VTF_COLOR: totalSize += 12
+    if vtx_format & VTF_BONE_DATA: totalSize += 20
+
+    return totalSize
+##
+
+# check packing flags make sense
+def check_packing(format):
+    if (format & VTF_PACK_NORMAL_OCT16) and (format & VTF_PACK_NORMAL_1010102):
+        raise Exception("Pick one normal encoding, not both!")
+    if (format & VTF_PACK_UV_HALF) and (format & VTF_PACK_UV_UNORM16):
+        raise Exception("Pick one uv encoding, not both!")
+    if (format & VTF_PACK_TANGENT) and (format & VTF_TANGENT_BITANGENT) and not (format & VTF_NORMAL):
+        raise Exception("Packed tangents need normals for the bitangent!")
+
+# numpy field dtype of an attribute, packed or not
+def attribute_dtype(format, flag, width):
+    if flag == VTF_POS and format & VTF_PACK_POS16:
+        return ('<u2', (4,))
+    if flag == VTF_NORMAL and format & VTF_PACK_NORMAL_OCT16:
+        return ('<i2', (2,))
+    if flag == VTF_NORMAL and format & VTF_PACK_NORMAL_1010102:
+        return ('<u4', ())
+    if flag == VTF_TANGENT_BITANGENT and format & VTF_PACK_TANGENT:
+        return ('<u4', ())
+    if flag in (VTF_UV0, VTF_UV1) and format & VTF_PACK_UV_HALF:
+        return ('<f2', (2,))
+    if flag in (VTF_UV0, VTF_UV1) and format & VTF_PACK_UV_UNORM16:
+        return ('<u2', (2,))
+    return ('<f4', (width,))
+
+# interleaved (little endian) vertex dtype of a vertex format
+def vertex_dtype(format):
+    fields = []
+    for (flag, name, width) in VTF_ATTRIBUTES:
+        if format & flag:
+            (base, shape) = attribute_dtype(format, flag, width)
+            fields.append((name, base, shape))
+    dt = np.dtype(fields)
+
+    # only the implemented attributes are in there
+    implemented = VTF_PACK_MASK
+    for (flag, name, width) in VTF_ATTRIBUTES:
+        implemented |= flag
+    assert dt.itemsize == bytesPerVertex(format & implemented)
+    return dt
+
+# octahedral encoding of unit vectors [n x 3] into [n x 2] in [-1, 1]
+def oct_encode(v):
+    v = np.asarray(v, dtype=np.float64)
+    l1 = np.abs(v).sum(axis=1, keepdims=True)
+    l1[l1 == 0] = 1
+    p = v[:, :2] / l1
+    # fold the lower hemisphere over
+    neg = v[:, 2] < 0
+    sign = np.where(p[neg] >= 0, 1.0, -1.0)
+    p[neg] = (1 - np.abs(p[neg][:, ::-1])) * sign
+    return p
+
+def oct_decode(p):
+    p = np.asarray(p, dtype=np.float64)
+    z = 1 - np.abs(p[:, 0]) - np.abs(p[:, 1])
+    v = np.column_stack((p[:, 0], p[:, 1], z))
+    neg = z < 0
+    sign = np.where(v[neg, :2] >= 0, 1.0, -1.0)
+    v[neg, :2] = (1 - np.abs(v[neg][:, 1::-1])) * sign
+    l = np.linalg.norm(v, axis=1, keepdims=True)
+    l[l == 0] = 1
+    return v / l
+
+def snorm(v, bits):
+    m = (1 << (bits - 1)) - 1
+    return np.round(np.clip(v, -1, 1) * m).astype(np.int64)
+
+# snorm 10:10:10:2 (x in the low bits, like GL_INT_2_10_10_10_REV)
+def pack_1010102(xyz, w=None):
+    q = snorm(xyz, 10) & 0x3FF
+    packed = q[:, 0] | (q[:, 1] << 10) | (q[:, 2] << 20)
+    if w is not None:
+        packed |= (snorm(w, 2) & 0x3) << 30
+    return packed.astype('<u4')
+
+def unpack_1010102(packed):
+    packed = np.asarray(packed, dtype=np.int64)
+    out = []
+    for (shift, bits) in ((0, 10), (10, 10), (20, 10), (30, 2)):
+        q = (packed >> shift) & ((1 << bits) - 1)
+        q = np.where(q >= (1 << (bits - 1)), q - (1 << bits), q)
+        out.append(np.maximum(q / ((1 << (bits - 1)) - 1), -1.0))
+    return (np.column_stack(out[:3]), out[3])
+
+# value range of an attribute column as (offset, scale) for unorm16
+def unorm16_range(col):
+    if len(col) == 0:
+        return (np.zeros(col.shape[1]), np.zeros(col.shape[1]))
+    lo = col.min(axis=0).astype(np.float64)
+    hi = col.max(axis=0).astype(np.float64)
+    return (lo, (hi - lo) / 0xFFFF)
+
+def unorm16(col, offset, scale):
+    safe = np.where(scale > 0, scale, 1)
+    q = np.where(scale > 0, (col - offset) / safe, 0)
+    return np.round(np.clip(q, 0, 0xFFFF)).astype('<u2')
+
+# dequantization params of a vertex buffer (attribute arrays, format order)
+def vertex_decode(vb, format):
+    decode = np.zeros((), dtype=DECODE_DTYPE)
+    decode['pos_scale'] = 1
+    decode['uv_scale'] = 1
+    cols = dict(zip([name for (flag, name, width) in VTF_ATTRIBUTES if format & flag], vb))
+    if format & VTF_PACK_POS16 and 'pos' in cols:
+        (decode['pos_offset'], decode['pos_scale']) = unorm16_range(cols['pos'])
+    if format & VTF_PACK_UV_UNORM16:
+        for (i, name) in enumerate(('uv0', 'uv1')):
+            if name in cols:
+                (decode['uv_offset'][i], decode['uv_scale'][i]) = unorm16_range(cols[name])
+    return decode
+
+# encode vertex buffer (attribute arrays, in format order) into bytes
+# as one interleaved structured array
+def encode_vertices(vb, format, decode=None):
+    dt = vertex_dtype(format)
+    vcount = len(vb[0]) if len(vb) else 0
+    out = np.zeros(vcount, dtype=dt)
+    if not (format & VTF_PACK_MASK):
+        for (name, col) in zip(dt.names, vb):
+            out[name] = col
+        return out.tobytes()
+
+    check_packing(format)
+    if decode is None:
+        decode = vertex_decode(vb, format)
+    # quantize against the stored (float32) params, like the shader does
+    pos_offset = decode['pos_offset'].astype(np.float64)
+    pos_scale = decode['pos_scale'].astype(np.float64)
+    cols = dict(zip(dt.names, vb))
+    for name in dt.names:
+        col = cols[name]
+        if name == 'pos' and format & VTF_PACK_POS16:
+            out[name][:, :3] = unorm16(col, pos_offset, pos_scale)
+        elif name == 'normal' and format & VTF_PACK_NORMAL_OCT16:
+            out[name] = snorm(oct_encode(col), 16)
+        elif name == 'normal' and format & VTF_PACK_NORMAL_1010102:
+            out[name] = pack_1010102(col)
+        elif name == 'tangent' and format & VTF_PACK_TANGENT:
+            t = col[:, :3]
+            sign = np.where(np.einsum('ij,ij->i', np.cross(cols['normal'], t), col[:, 3:]) < 0, -1.0, 1.0)
+            out[name] = pack_1010102(t, sign)
+        elif name in ('uv0', 'uv1') and format & VTF_PACK_UV_UNORM16:
+            i = 0 if name == 'uv0' else 1
+            out[name] = unorm16(col, decode['uv_offset'][i].astype(np.float64), decode['uv_scale'][i].astype(np.float64))
+        else:
+            out[name] = col
+    return out.tobytes()
+
+# decode a (possibly packed) structured vertex array back to float
+# attribute arrays, returns dict of name -> array
+def decode_vertices(vertices, format, decode=None):
+    out = {}
+    for name in vertices.dtype.names:
+        q = vertices[name]
+        if name == 'pos' and format & VTF_PACK_POS16:
+            out[name] = decode['pos_offset'] + q[:, :3] * decode['pos_scale']
+        elif name == 'normal' and format & VTF_PACK_NORMAL_OCT16:
+            out[name] = oct_decode(np.maximum(q / 32767.0, -1.0))
+        elif name == 'normal' and format & VTF_PACK_NORMAL_1010102:
+            out[name] = unpack_1010102(q)[0]
+        elif name == 'tangent' and format & VTF_PACK_TANGENT:
+            (t, w) = unpack_1010102(q)
+            out[name] = t
+            out['bitangent_sign'] = w
+        elif name in ('uv0', 'uv1') and format & VTF_PACK_UV_UNORM16:
+            i = 0 if name == 'uv0' else 1
+            out[name] = decode['uv_offset'][i] + q * decode['uv_scale'][i]
+        else:
+            out[name] = q.astype(np.float32)
+    return out
+
+# encode index buffers (one per material) into one contiguous u16
+# (or u32, index_size 4) array
+def encode_indices(ib, index_size=2):
+    if len(ib) == 0:
+        return b''
+    ids = np.concatenate([t.ravel() for t in ib])
+    if index_size == 4:
+        return ids.astype('<u4').tobytes()
+    if len(ids) and ids.max() > 0xFFFF:
+        raise Exception("Index %d doesn't fit in 16 bits!" % ids.max())
+    return ids.astype('<u2').tobytes()
+
+# vertex + index byte ranges of a version 4+ mesh block, as
+# (vertex_start, index_start, index_end, index_size)
+def block_sections(block, submesh_count, bytes_per_vertex):
+    h = np.frombuffer(block, MESH_HEADER_WIDE_DTYPE, 1)[0]
+    isize = 4 if int(h['flags']) & MESH_INDEX32 else 2
+    vstart = MESH_HEADER_WIDE_DTYPE.itemsize + DECODE_DTYPE.itemsize + submesh_count * SUBMESH_WIDE_DTYPE.itemsize
+    istart = vstart + int(h['vertex_count']) * bytes_per_vertex
+    return (vstart, istart, istart + int(h['triangle_count']) * 3 * isize, isize)
+
+# FILTER_xxx flags over a copy of a mesh block, headers + meshlets stay
+def filter_block(block, filters, submesh_count, bytes_per_vertex):
+    out = np.frombuffer(block, np.uint8).copy()
+    (vstart, istart, iend, isize) = block_sections(out, submesh_count, bytes_per_vertex)
+    if filters & FILTER_DELTA:
+        ids = out[istart:iend].view('<u%d' % isize)
+        ids[1:] = np.diff(ids)
+    if filters & FILTER_SHUFFLE:
+        out[vstart:istart] = out[vstart:istart].reshape(-1, bytes_per_vertex).T.ravel()
+        out[istart:iend] = out[istart:iend].reshape(-1, isize).T.ravel()
+    return out
+
+# and back, in place on a writable uint8 array
+def unfilter_block(out, filters, submesh_count, bytes_per_vertex):
+    (vstart, istart, iend, isize) = block_sections(out, submesh_count, bytes_per_vertex)
+    if filters & FILTER_SHUFFLE:
+        out[vstart:istart] = out[vstart:istart].reshape(bytes_per_vertex, -1).T.ravel()
+        out[istart:iend] = out[istart:iend].reshape(isize, -1).T.ravel()
+    if filters & FILTER_DELTA:
+        ids = out[istart:iend].view('<u%d' % isize)
+        np.cumsum(ids, dtype=ids.dtype, out=ids)
+    return out
+
+# filtered + compressed bytes of a mesh block
+def compress_block(block, codec, level, filters, submesh_count, bytes_per_vertex):
+    data = filter_block(block, filters, submesh_count, bytes_per_vertex) if filters else block
+    if codec == COMPRESS_ZLIB:
+        return zlib.compress(data, level)
+    if codec == COMPRESS_LZMA:
+        return lzma.compress(data, check=lzma.CHECK_CRC32, preset=level)
+    raise Exception("Unknown block codec %d!" % codec)
+
+# decompress a block handed over in pieces (as it comes off the disk),
+# still filtered
+def decompress_chunks(chunks, codec):
+    if codec == COMPRESS_ZLIB:
+        d = zlib.decompressobj()
+    elif codec == COMPRESS_LZMA:
+        d = lzma.LZMADecompressor()
+    else:
+        raise Exception("Unknown block codec %d!" % codec)
+    out = [d.decompress(c) for c in chunks]
+    if not d.eof:
+        raise Exception("Compressed block is truncated!")
+    return np.frombuffer(bytearray().join(out), np.uint8)
+
+def decompress_block(data, codec, filters, submesh_count, bytes_per_vertex):
+    out = decompress_chunks([data], codec)
+    if filters:
+        unfilter_block(out, filters, submesh_count, bytes_per_vertex)
+    return out
@@ -0,0 +1,451 @@
+import sys, mmap, time
+import numpy as np
+
+try:
+    from . import layout
+except ImportError:
+    # used as a plain script / top level module by tooling
+    import layout
+
+"""
+Author: Bowie
+Reader for the binary LMF files written by exporter.write_binary
+
+No bpy in here. The file is mmap'd, the header and node table are parsed
+into structured arrays and every mesh block is only touched when asked
+for, so opening a huge file costs nothing. Vertex buffers, index buffers
+and submesh ranges are numpy views straight into the mapping (no copies),
+the vertex buffer decoded with the dtype of the stored vertex_format.
+Version 2 files carry a mesh directory, so any mesh is one lookup away,
+legacy files get walked block by block up to the requested mesh.
+Version 3 meshes have u16 or u32 indices, m.indices has the right dtype.
+Version 4 vertices may be packed, m.attributes() dequantizes them.
+Version 3+ meshes may carry meshlets (m.meshlets, m.meshletTriangles(i)).
+Version 5 nodes may have a LOD chain (f.nodeLods(node_id), f.lods).
+Version 6 blocks may be compressed, f.mesh() then decompresses that one
+block (every call, hang on to the mesh) and the views are into that copy.
+
+LMFStream reads a file front to back without seeking or mapping it, one
+block in memory at a time, compressed blocks decompressed as their bytes
+come in, for network drives and pipes.
+
+usage:
+    with lmf.LMFFile("level.lmf") as f:
+        m = f.mesh(f.nodes[5]['mesh_id'])
+        m.vertices['pos'], m.indices, m.submeshIndices(0), m.attributes()
+
+    with lmf.LMFStream("level.lmf") as s:
+        for m in s.meshes():
+            ...
+
+or from a shell (summary + validation, non zero exit when invalid,
+--bench also times decoding every block):
+    python lmf.py [--bench] level.lmf
+"""
+
+# bytes per read of LMFStream
+STREAM_CHUNK = 1 << 20
+
+# header, nodes, directory and LOD table into f's fields, read(dtype,
+# count) hands out the next records in file order, peek(n) the first n
+# bytes of the file
+def parse_prefix(f, read, peek):
+    # version 2+ files are tagged, legacy ones start with the header
+    f.version = layout.LMF_VERSION_LEGACY
+    if peek(len(layout.LMF_MAGIC)) == layout.LMF_MAGIC:
+        v = read(layout.VERSION_DTYPE, 1)[0]
+        f.version = int(v['version'])
+        if f.version > layout.LMF_VERSION:
+            raise Exception("%s: unknown LMF version %d" % (f.filepath, f.version))
+
+    h = read(layout.HEADER_DTYPE, 1)[0]
+    f.vertex_format = int(h['vertex_format'])
+    f.bytes_per_vertex = int(h['bytes_per_vertex'])
+    f.node_count = int(h['node_count'])
+    f.mesh_count = int(h['mesh_count'])
+    f.submesh_count = int(h['submesh_count'])
+    f.name = h['name'].rstrip(b'\0').decode('utf-8', 'replace')
+
+    if f.version >= layout.LMF_VERSION_PACKED:
+        p = read(layout.PACKING_DTYPE, 1)[0]
+        f.vertex_format |= int(p['vertex_packing'])
+    f.vertex_dtype = layout.vertex_dtype(f.vertex_format)
+
+    f.codec = layout.COMPRESS_NONE
+    f.level = 0
+    f.filters = 0
+    if f.version >= layout.LMF_VERSION_COMPRESSED:
+        c = read(layout.COMPRESSION_DTYPE, 1)[0]
+        (f.codec, f.level, f.filters) = (int(c['codec']), int(c['level']), int(c['filters']))
+        if f.codec not in layout.COMPRESS_NAMES:
+            raise Exception("%s: unknown block codec %d" % (f.filepath, f.codec))
+
+    f.nodes = read(layout.node_dtype(f.version), f.node_count)
+
+    # mesh directory gives every block offset right away, legacy files
+    # get them lazily by hopping over block sizes
+    f.directory = None
+    if f.version >= layout.LMF_VERSION_DIRECTORY:
+        f.directory = read(layout.directory_dtype(f.version), f.mesh_count)
+
+    # one record per LOD mesh, in mesh order
+    f.lods = None
+    if f.version >= layout.LMF_VERSION_LOD:
+        f.lods = read(layout.LOD_DTYPE, int(f.nodes['lod_count'].sum()))
+
+# block is the (decompressed) block on its own when it isn't in
+# lmf.buffer at offset, stored_size its size in the file
+class LMFMesh:
+    def __init__(self, lmf, mesh_id, offset, block=None, stored_size=None):
+        self.id = mesh_id
+        self.offset = offset
+
+        buf = lmf.buffer if block is None else block
+        start = offset if block is None else 0
+        header_dtype = layout.mesh_header_dtype(lmf.version)
+        h = np.frombuffer(buf, header_dtype, 1, start)[0]
+        self.block_size = int(h['block_size'])
+        self.vertex_count = int(h['vertex_count'])
+        self.triangle_count = int(h['triangle_count'])
+        self.flags = int(h['flags']) if 'flags' in header_dtype.names else 0
+        self.stored_size = self.block_size if stored_size is None else stored_size
+        index_dtype = '<u4' if self.flags & layout.MESH_INDEX32 else '<u2'
+
+        pos = start + header_dtype.itemsize
+        self.decode = None
+        if lmf.version >= layout.LMF_VERSION_PACKED:
+            self.decode = np.frombuffer(buf, layout.DECODE_DTYPE, 1, pos)[0]
+            pos += layout.DECODE_DTYPE.itemsize
+        self.vertex_format = lmf.vertex_format
+        self.submeshes = np.frombuffer(buf, layout.submesh_dtype(lmf.version), lmf.submesh_count, pos)
+        pos += self.submeshes.nbytes
+
+        self.vertices = np.frombuffer(buf, lmf.vertex_dtype, self.vertex_count, pos)
+        pos += self.vertices.nbytes
+
+        self.indices = np.frombuffer(buf, index_dtype, self.triangle_count * 3, pos)
+        pos += self.indices.nbytes
+
+        # optional meshlet section, 4b aligned
+        self.meshlets = None
+        self.meshlet_vertices = None
+        self.meshlet_triangles = None
+        if self.flags & layout.MESH_MESHLETS:
+            pos += -pos % 4
+            (count, vcount, tcount) = np.frombuffer(buf, '<u4', 3, pos).tolist()
+            pos += 12
+            self.meshlets = np.frombuffer(buf, layout.MESHLET_DTYPE, count, pos)
+            pos += self.meshlets.nbytes
+            self.meshlet_vertices = np.frombuffer(buf, index_dtype, vcount, pos)
+            pos += self.meshlet_vertices.nbytes
+            pos += -pos % 4
+            self.meshlet_triangles = np.frombuffer(buf, 'u1', tcount * 3, pos).reshape(-1, 3)
+            pos += self.meshlet_triangles.nbytes
+            pos += -pos % 4
+
+        if pos - start != self.block_size:
+            raise Exception("mesh[%d]: block size says %d bytes, got %d" % (mesh_id, self.block_size, pos - start))
+
+    # index view of a submesh (start is stored as a byte offset)
+    def submeshIndices(self, submesh_id):
+        sm = self.submeshes[submesh_id]
+        start = int(sm['start']) // self.indices.itemsize
+        return self.indices[start:start + int(sm['count'])]
+
+    # float copies of the vertex attributes, dequantized if packed
+    def attributes(self):
+        return layout.decode_vertices(self.vertices, self.vertex_format, self.decode)
+
+    # leaf vertex indices of a meshlet's triangles [n x 3]
+    def meshletTriangles(self, meshlet_id):
+        m = self.meshlets[meshlet_id]
+        verts = self.meshlet_vertices[int(m['vertex_offset']):int(m['vertex_offset']) + int(m['vertex_count'])]
+        start = int(m['triangle_offset'])
+        return verts[self.meshlet_triangles[start:start + int(m['triangle_count'])]]
+
+    # [triangle_count x 3] view of the index buffer
+    def triangles(self):
+        return self.indices.reshape(-1, 3)
+
+class LMFFile:
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.file = open(filepath, "rb")
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # records are views into the mapping
+        self._pos = 0
+        parse_prefix(self, self.readRecords, lambda n: self.buffer[:n])
+        self._mesh_offsets = [self._pos]
+        self._meshes = {}
+
+    def readRecords(self, dtype, count):
+        records = np.frombuffer(self.buffer, dtype, count, self._pos)
+        self._pos += records.nbytes
+        return records
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # views handed out keep the mapping alive, so only close what we can
+    def close(self):
+        self._meshes = {}
+        self.nodes = None
+        self.directory = None
+        self.lods = None
+        try:
+            self.buffer.close()
+        except BufferError:
+            pass
+        self.file.close()
+
+    def meshOffset(self, mesh_id):
+        if mesh_id < 0 or mesh_id >= self.mesh_count:
+            raise IndexError("mesh[%d] out of range (%d meshes)" % (mesh_id, self.mesh_count))
+        if self.directory is not None:
+            return int(self.directory[mesh_id]['offset'])
+        offsets = self._mesh_offsets
+        while len(offsets) <= mesh_id:
+            last = offsets[-1]
+            size = int(np.frombuffer(self.buffer, '<u4', 1, last)[0])
+            offsets.append(last + size)
+        return offsets[mesh_id]
+
+    def mesh(self, mesh_id):
+        m = self._meshes.get(mesh_id)
+        if m is not None:
+            return m
+        offset = self.meshOffset(mesh_id)
+        if self.codec == layout.COMPRESS_NONE:
+            m = LMFMesh(self, mesh_id, offset)
+            self._meshes[mesh_id] = m
+            return m
+        # not cached, all of a huge file's blocks decompressed won't fit
+        stored = int(self.directory[mesh_id]['stored_size'])
+        block = layout.decompress_block(self.buffer[offset:offset + stored], self.codec, self.filters, self.submesh_count, self.vertex_dtype.itemsize)
+        return LMFMesh(self, mesh_id, offset, block, stored)
+
+    def meshes(self):
+        for mesh_id in range(self.mesh_count):
+            yield self.mesh(mesh_id)
+
+    # LOD chain of a node, list of (mesh, error), finest first
+    def nodeLods(self, node_id):
+        if self.lods is None:
+            return []
+        n = self.nodes[node_id]
+        first = int(n['lod_mesh_id'])
+        if first < 0:
+            return []
+        leaf_count = self.mesh_count - len(self.lods)
+        return [(self.mesh(first + i), float(self.lods[first - leaf_count + i]['error'])) for i in range(int(n['lod_count']))]
+
+    # sanity check everything, return list of problems (empty = fine)
+    def validate(self):
+        problems = []
+        ids = self.nodes['id']
+        if not np.array_equal(ids, np.arange(self.node_count)):
+            problems.append("node ids are not 0..%d in order" % (self.node_count - 1))
+        parents = self.nodes['parent_id']
+        if np.any((parents < -1) | (parents >= self.node_count)):
+            problems.append("node parent ids out of range")
+        mesh_ids = self.nodes['mesh_id']
+        used = mesh_ids[mesh_ids >= 0]
+        if np.any(used >= self.mesh_count):
+            problems.append("node mesh ids out of range")
+        if len(np.unique(used)) != len(used):
+            problems.append("a mesh is referenced by more than one node")
+        if np.any(self.nodes['aabb_min'] > self.nodes['aabb_max']):
+            problems.append("node aabb min > max")
+        if self.lods is not None:
+            problems += self.validateLods()
+
+        blocks = []
+        for mesh_id in range(self.mesh_count):
+            try:
+                m = self.mesh(mesh_id)
+            except Exception as e:
+                problems.append("mesh[%d]: %s" % (mesh_id, e))
+                return problems
+            blocks.append((m.id, m.offset, m.stored_size))
+            if self.directory is not None and m.block_size != int(self.directory[mesh_id]['block_size']):
+                problems.append("mesh[%d]: directory block size doesn't match the block" % mesh_id)
+            if self.codec == layout.COMPRESS_NONE and m.stored_size != self.storedSize(mesh_id):
+                problems.append("mesh[%d]: directory stored size doesn't match the block" % mesh_id)
+            if m.triangle_count and int(m.indices.max()) >= m.vertex_count:
+                problems.append("mesh[%d]: index out of range" % mesh_id)
+            if int(m.submeshes['count'].sum()) != m.triangle_count * 3:
+                problems.append("mesh[%d]: submeshes don't cover the index buffer" % mesh_id)
+            if m.meshlets is not None:
+                if int(m.meshlets['triangle_count'].sum()) != m.triangle_count:
+                    problems.append("mesh[%d]: meshlets don't cover the triangles" % mesh_id)
+                if len(m.meshlet_vertices) and int(m.meshlet_vertices.max()) >= m.vertex_count:
+                    problems.append("mesh[%d]: meshlet vertex out of range" % mesh_id)
+                if np.any(np.isnan(m.meshlets['cone_cutoff'])):
+                    problems.append("mesh[%d]: meshlet cone cutoff is NaN" % mesh_id)
+
+        # blocks are back to back, directory or not
+        end = self._mesh_offsets[0]
+        for (mesh_id, offset, stored_size) in blocks:
+            if offset != end:
+                problems.append("mesh[%d]: block at %d, expected %d" % (mesh_id, offset, end))
+                break
+            end += stored_size
+        if end != len(self.buffer):
+            problems.append("file has %d bytes, meshes end at %d" % (len(self.buffer), end))
+        return problems
+
+    # LOD ranges of the nodes against the LOD table
+    def validateLods(self):
+        problems = []
+        leaf_count = self.mesh_count - len(self.lods)
+        if leaf_count < 0:
+            return ["more LOD records than meshes"]
+        covered = np.zeros(len(self.lods), dtype=np.int64)
+        for n in self.nodes:
+            (first, count) = (int(n['lod_mesh_id']), int(n['lod_count']))
+            if first < 0:
+                if count != 0:
+                    problems.append("node[%d]: LOD count without LOD meshes" % n['id'])
+                continue
+            if first < leaf_count or first + count > self.mesh_count:
+                problems.append("node[%d]: LOD meshes out of range" % n['id'])
+                continue
+            rows = self.lods[first - leaf_count:first - leaf_count + count]
+            covered[first - leaf_count:first - leaf_count + count] += 1
+            if np.any(rows['node_id'] != n['id']) or not np.array_equal(rows['level'], np.arange(count)):
+                problems.append("node[%d]: LOD table doesn't match the node" % n['id'])
+            if np.any(np.diff(rows['error']) < 0):
+                problems.append("node[%d]: LOD error shrinks going coarser" % n['id'])
+        if np.any(covered != 1):
+            problems.append("LOD meshes not referenced by exactly one node")
+        return problems
+
+    # size of a block in the file (compressed or not)
+    def storedSize(self, mesh_id):
+        if self.directory is not None and 'stored_size' in self.directory.dtype.names:
+            return int(self.directory[mesh_id]['stored_size'])
+        return self.mesh(mesh_id).block_size
+
+    def summary(self):
+        return "%s: version(%d) name(%s) vertex_format(%d) bytes_per_vertex(%d) nodes(%d) meshes(%d) submeshes(%d)" % (
+            self.filepath, self.version, self.name, self.vertex_format, self.bytes_per_vertex,
+            self.node_count, self.mesh_count, self.submesh_count
+        ) + ("" if self.lods is None else " lods(%d)" % len(self.lods)) + (
+            "" if self.codec == layout.COMPRESS_NONE else " compression(%s %d)" % (layout.COMPRESS_NAMES[self.codec], self.level))
+
+# front to back reader of a file path or anything with read(), same fields
+# as LMFFile, meshes only in file order
+class LMFStream:
+    def __init__(self, file, chunk_size=STREAM_CHUNK):
+        self.own = isinstance(file, str)
+        self.file = open(file, "rb") if self.own else file
+        self.filepath = file if self.own else getattr(file, 'name', "<stream>")
+        self.chunk_size = chunk_size
+        # bytes peeked at but not consumed yet
+        self.pending = b''
+        self.pos = 0
+        self.buffer = None
+        parse_prefix(self, self.readRecords, self.peek)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.own:
+            self.file.close()
+
+    def peek(self, n):
+        if len(self.pending) < n:
+            self.pending += self.file.read(n - len(self.pending))
+        return self.pending[:n]
+
+    def read(self, n):
+        data = self.peek(n)
+        if len(data) != n:
+            raise Exception("%s: file ends at %d, wanted %d more bytes" % (self.filepath, self.pos + len(data), n))
+        self.pending = self.pending[n:]
+        self.pos += n
+        return data
+
+    # a size in pieces of at most chunk_size
+    def chunks(self, size):
+        while size > 0:
+            n = min(size, self.chunk_size)
+            yield self.read(n)
+            size -= n
+
+    def readRecords(self, dtype, count):
+        return np.frombuffer(self.read(dtype.itemsize * count), dtype, count)
+
+    def meshes(self):
+        for mesh_id in range(self.mesh_count):
+            if self.directory is not None:
+                offset = int(self.directory[mesh_id]['offset'])
+                if offset < self.pos:
+                    raise Exception("mesh[%d]: block at %d, already streamed past %d" % (mesh_id, offset, self.pos))
+                for _ in self.chunks(offset - self.pos):
+                    pass
+            # uncompressed blocks start with their size (legacy files have
+            # nothing else to go on)
+            offset = self.pos
+            if self.codec == layout.COMPRESS_NONE:
+                size = int(np.frombuffer(self.peek(4), '<u4')[0])
+                yield LMFMesh(self, mesh_id, offset, self.read(size))
+                continue
+            stored = int(self.directory[mesh_id]['stored_size'])
+            block = layout.decompress_chunks(self.chunks(stored), self.codec)
+            if self.filters:
+                layout.unfilter_block(block, self.filters, self.submesh_count, self.vertex_dtype.itemsize)
+            yield LMFMesh(self, mesh_id, offset, block, stored)
+
+# compression ratio + decode speed of a file, decoding every block with
+# LMFStream (sequential) and LMFFile (mmap, random access)
+def measure(filepath):
+    with LMFFile(filepath) as f:
+        stored = len(f.buffer) - f._mesh_offsets[0]
+        t = time.perf_counter()
+        raw = sum(f.mesh(mesh_id).block_size for mesh_id in range(f.mesh_count))
+        mmap_time = time.perf_counter() - t
+    with LMFStream(filepath) as s:
+        t = time.perf_counter()
+        for m in s.meshes():
+            pass
+        stream_time = time.perf_counter() - t
+    mb = raw / (1024 * 1024)
+    return {
+        "raw_bytes": raw,
+        "stored_bytes": stored,
+        "ratio": raw / max(stored, 1),
+        "stream_mbs": mb / max(stream_time, 1e-9),
+        "mmap_mbs": mb / max(mmap_time, 1e-9),
+    }
+
+def main(argv):
+    bench = "--bench" in argv[1:]
+    filepaths = [a for a in argv[1:] if a != "--bench"]
+    if len(filepaths) == 0:
+        print("usage: python lmf.py [--bench] file.lmf [file.lmf ...]")
+        return 2
+    failed = False
+    for filepath in filepaths:
+        with LMFFile(filepath) as f:
+            print(f.summary())
+            problems = f.validate()
+            for p in problems:
+                print("  INVALID: %s" % p)
+            failed = failed or len(problems) > 0
+        if bench and not problems:
+            r = measure(filepath)
+            print("  decode: meshes(%.2fMB) stored(%.2fMB) ratio(%.2f) stream(%.1fMB/s) mmap(%.1fMB/s)" % (
+                r["raw_bytes"] / (1024 * 1024), r["stored_bytes"] / (1024 * 1024), r["ratio"], r["stream_mbs"], r["mmap_mbs"]))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
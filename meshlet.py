@@ -0,0 +1,149 @@
+import numpy as np
+from .layout import VTF_POS, MESHLET_DTYPE, make_buffer
+
+"""
+Author: Bowie
+Meshlet (cluster) generation per leaf, no bpy in here
+
+Triangles of every submesh are packed greedily, in index buffer order,
+into meshlets of at most max_vertices unique vertices and max_triangles
+triangles (run the vertex cache optimization first, it keeps the
+meshlets tight). Each meshlet gets:
+ - a bounding sphere (center of its AABB, radius to the farthest vertex)
+ - a normal cone (apex, axis, cutoff), cull the whole meshlet when
+   dot(normalize(apex - camera), axis) >= cutoff. Meshlets with normals
+   spread too wide get cutoff 1, so they never cull
+
+Meshlet vertices are indices into the leaf vertex buffer, meshlet
+triangles are u8 indices into the meshlet vertices.
+"""
+
+MESHLET_MAX_VERTICES = 64
+MESHLET_MAX_TRIANGLES = 124
+
+# meshlets of one leaf
+class Meshlets:
+    def __init__(self, records, vertices, triangles):
+        # MESHLET_DTYPE array
+        self.records = records
+        # leaf vertex index per meshlet vertex
+        self.vertices = vertices
+        # [n x 3] u8 local indices
+        self.triangles = triangles
+
+    def __len__(self):
+        return len(self.records)
+
+# greedy meshlets of index buffers (list of [tri_count x 3], one per
+# submesh), positions [vertex_count x 3] for the bounds
+def build_meshlets(ib, positions, max_vertices=MESHLET_MAX_VERTICES, max_triangles=MESHLET_MAX_TRIANGLES):
+    if max_vertices < 3 or max_vertices > 255 or max_triangles < 1 or max_triangles > 255:
+        raise Exception("Meshlet limits must be 3..255 vertices, 1..255 triangles, got %d/%d" % (max_vertices, max_triangles))
+
+    records = []
+    all_vertices = []
+    all_triangles = []
+
+    for (submesh, tris) in enumerate(ib):
+        local = {}
+        verts = []
+        ltris = []
+
+        def flush():
+            if len(ltris) == 0:
+                return
+            records.append((len(all_vertices), len(all_triangles), len(verts), len(ltris), submesh))
+            all_vertices.extend(verts)
+            all_triangles.extend(ltris)
+
+        for tri in tris.tolist():
+            new = len([v for v in set(tri) if v not in local])
+            if len(ltris) == max_triangles or len(verts) + new > max_vertices:
+                flush()
+                local = {}
+                verts = []
+                ltris = []
+            for v in tri:
+                if v not in local:
+                    local[v] = len(verts)
+                    verts.append(v)
+            ltris.append([local[v] for v in tri])
+        flush()
+
+    out = np.zeros(len(records), dtype=MESHLET_DTYPE)
+    vertices = np.array(all_vertices, dtype=np.int64)
+    triangles = np.array(all_triangles, dtype=np.uint8).reshape(-1, 3)
+    positions = np.asarray(positions, dtype=np.float64)
+    for (i, (voff, toff, vcount, tcount, submesh)) in enumerate(records):
+        r = out[i]
+        r['vertex_offset'] = voff
+        r['triangle_offset'] = toff
+        r['vertex_count'] = vcount
+        r['triangle_count'] = tcount
+        r['submesh'] = submesh
+        mverts = vertices[voff:voff + vcount]
+        mtris = mverts[triangles[toff:toff + tcount]]
+        meshlet_bounds(r, positions, mverts, mtris)
+    return Meshlets(out, vertices, triangles)
+
+# fill bounding sphere + normal cone of one meshlet record
+def meshlet_bounds(r, positions, verts, tris):
+    p = positions[verts]
+    center = (p.min(axis=0) + p.max(axis=0)) * 0.5
+    r['center'] = center
+    r['radius'] = np.sqrt(((p - center) ** 2).sum(axis=1).max())
+
+    # no cone by default
+    r['cone_apex'] = center
+    r['cone_axis'] = 0
+    r['cone_cutoff'] = 1
+
+    c = positions[tris]
+    n = np.cross(c[:, 1] - c[:, 0], c[:, 2] - c[:, 0])
+    l = np.linalg.norm(n, axis=1)
+    keep = l > 0
+    if not np.any(keep):
+        return
+    n = n[keep] / l[keep][:, None]
+    corner = c[keep, 0]
+
+    axis = n.sum(axis=0)
+    al = np.linalg.norm(axis)
+    if al == 0:
+        return
+    axis /= al
+    # rounding can land a hair over 1 on flat meshlets, sqrt below hates that
+    dn = np.clip(n @ axis, -1.0, 1.0)
+    mindp = dn.min()
+    # normals spread too wide, a cone wouldn't ever cull
+    if mindp <= 0.1:
+        return
+
+    # apex behind every triangle plane along the axis
+    t = ((center - corner) * n).sum(axis=1) / dn
+    apex = center - axis * max(t.max(), 0.0)
+    r['cone_apex'] = apex
+    r['cone_axis'] = axis
+    r['cone_cutoff'] = np.sqrt(1 - mindp * mindp)
+
+# meshlets of a leaf's extracted buffers, limits is (max vertices, max triangles)
+def leaf_meshlets(vb, ib, format, limits):
+    if not (format & VTF_POS):
+        raise Exception("Meshlets need positions in the vertex format!")
+    # position is always the first attribute
+    return build_meshlets(ib, vb[0], limits[0], limits[1])
+
+# meshlet section bytes, see exporter.write_binary for the layout
+# meshlet vertices use the mesh's index size
+def encode_meshlets(meshlets, index_size=2):
+    m = meshlets
+    vtype = '<u4' if index_size == 4 else '<u2'
+    vbytes = m.vertices.astype(vtype).tobytes()
+    tbytes = m.triangles.astype(np.uint8).tobytes()
+    parts = [
+        make_buffer('I', [len(m.records), len(m.vertices), len(m.triangles)]).tobytes(),
+        m.records.tobytes(),
+        vbytes, b'\0' * (-len(vbytes) % 4),
+        tbytes, b'\0' * (-len(tbytes) % 4),
+    ]
+    return b''.join(parts)
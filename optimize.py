@@ -0,0 +1,204 @@
+import numpy as np
+
+"""
+Author: Bowie
+Post-transform vertex cache optimization, no bpy in here
+
+Triangles of each submesh get reordered with Tipsify (Sander, Nehab,
+Barczak 2007): fan out around a vertex, then continue with the
+neighbour that stays in cache while fanning, falling back to recently
+emitted vertices, then to the next vertex with live triangles. Linear
+time, one cache size parameter.
+
+Stats are measured with a FIFO cache of the same size:
+ - ACMR: vertex transforms per triangle (0.5 best, 3 worst)
+ - ATVR: vertex transforms per vertex (1 best)
+
+Vertex fetch optimization renumbers the vertices in first use order of
+the final index stream (all submeshes), so fetches walk the vertex
+buffer forward. Measured as overfetch: bytes of cache lines pulled in
+by a small FIFO line cache over the size of the vertex buffer (1 best).
+"""
+
+VCACHE_SIZE = 16
+
+# vertex fetch model
+FETCH_LINE_SIZE = 64
+FETCH_CACHE_LINES = 32
+
+# vertex -> triangles adjacency, CSR style (offsets, triangle ids)
+def vertex_triangles(tris, vertex_count):
+    flat = tris.ravel()
+    order = np.argsort(flat, kind='stable')
+    counts = np.bincount(flat, minlength=vertex_count)
+    offsets = np.zeros(vertex_count + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return (offsets, order // 3, counts)
+
+# tipsify triangle order of [tri_count x 3] tris
+# return the new order (indices into tris)
+def tipsify(tris, vertex_count, cache_size=VCACHE_SIZE):
+    tri_count = len(tris)
+    if tri_count == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    (offsets, adj, live) = vertex_triangles(tris, vertex_count)
+    offsets = offsets.tolist()
+    adj = adj.tolist()
+    live = live.tolist()
+    corners = tris.tolist()
+    stamp = [0] * vertex_count
+    emitted = [False] * tri_count
+    dead_end = []
+    out = []
+
+    k = cache_size
+    s = k + 1
+    cursor = 0
+    f = int(tris[0][0])
+    while f >= 0:
+        candidates = []
+        # fan around f
+        for t in adj[offsets[f]:offsets[f + 1]]:
+            if emitted[t]:
+                continue
+            emitted[t] = True
+            out.append(t)
+            for v in corners[t]:
+                dead_end.append(v)
+                candidates.append(v)
+                live[v] -= 1
+                # not in cache anymore? it gets loaded now
+                if s - stamp[v] > k:
+                    stamp[v] = s
+                    s += 1
+
+        # next fanning vertex, one that stays in cache while fanning
+        # (oldest such entry wins), else the dead end stack decides
+        f = -1
+        best = 0
+        for v in candidates:
+            if live[v] > 0:
+                p = 0
+                if s - stamp[v] + 2 * live[v] <= k:
+                    p = s - stamp[v]
+                if p > best:
+                    best = p
+                    f = v
+        if f >= 0:
+            continue
+
+        # dead end, try recently emitted vertices
+        while len(dead_end):
+            v = dead_end.pop()
+            if live[v] > 0:
+                f = v
+                break
+        if f >= 0:
+            continue
+
+        # anything left at all?
+        while cursor < vertex_count and live[cursor] == 0:
+            cursor += 1
+        if cursor < vertex_count:
+            f = cursor
+
+    return np.array(out, dtype=np.int64)
+
+# vertex transforms of an index stream through a FIFO cache
+def fifo_misses(indices, cache_size=VCACHE_SIZE):
+    indices = np.asarray(indices).ravel().tolist()
+    if len(indices) == 0:
+        return 0
+    # miss count at the time each vertex entered the cache
+    entered = {}
+    misses = 0
+    for v in indices:
+        t = entered.get(v)
+        if t is None or misses - t >= cache_size:
+            entered[v] = misses
+            misses += 1
+    return misses
+
+# (acmr, atvr) of index buffers (list of [tri_count x 3])
+def cache_stats(ib, vertex_count, cache_size=VCACHE_SIZE):
+    tri_count = sum(len(t) for t in ib)
+    if tri_count == 0 or vertex_count == 0:
+        return (0.0, 0.0)
+    misses = fifo_misses(np.concatenate([t.ravel() for t in ib]), cache_size)
+    return (misses / tri_count, misses / vertex_count)
+
+# reorder triangles of every submesh
+# return (new ib, stats dict)
+def optimize_vertex_cache(ib, vertex_count, cache_size=VCACHE_SIZE):
+    (acmr_before, atvr_before) = cache_stats(ib, vertex_count, cache_size)
+    out = []
+    for tris in ib:
+        out.append(tris[tipsify(tris, vertex_count, cache_size)])
+    (acmr, atvr) = cache_stats(out, vertex_count, cache_size)
+    stats = {
+        "acmr_before": acmr_before,
+        "acmr": acmr,
+        "atvr_before": atvr_before,
+        "atvr": atvr,
+    }
+    return (out, stats)
+
+# cache lines fetched for an index stream over vertices of stride bytes
+def fetch_lines(indices, stride, line_size=FETCH_LINE_SIZE, cache_lines=FETCH_CACHE_LINES):
+    indices = np.asarray(indices, dtype=np.int64).ravel()
+    if len(indices) == 0:
+        return 0
+    # every line each vertex touches, in stream order
+    first = (indices * stride) // line_size
+    last = (indices * stride + stride - 1) // line_size
+    span = last - first + 1
+    lines = np.repeat(first, span) + (np.arange(span.sum()) - np.repeat(np.cumsum(span) - span, span))
+    return fifo_misses(lines, cache_lines)
+
+# overfetch of index buffers (list of [tri_count x 3]), 1 is best
+def overfetch(ib, vertex_count, stride, line_size=FETCH_LINE_SIZE, cache_lines=FETCH_CACHE_LINES):
+    if vertex_count == 0 or stride == 0 or len(ib) == 0:
+        return 0.0
+    lines = fetch_lines(np.concatenate([t.ravel() for t in ib]), stride, line_size, cache_lines)
+    return lines * line_size / (vertex_count * stride)
+
+# vertex order by first use in the index stream
+# return (order, remap): order[new] = old, remap[old] = new
+def fetch_order(ib, vertex_count):
+    stream = np.concatenate([t.ravel() for t in ib]) if len(ib) else np.zeros(0, dtype=np.int64)
+    (used, first) = np.unique(stream, return_index=True)
+    order = used[np.argsort(first, kind='stable')]
+    # unreferenced vertices (shouldn't be any) keep going at the end
+    if len(order) < vertex_count:
+        unused = np.setdiff1d(np.arange(vertex_count), used)
+        order = np.concatenate((order, unused))
+    remap = np.empty(vertex_count, dtype=np.int64)
+    remap[order] = np.arange(vertex_count)
+    return (order, remap)
+
+# renumber vertices in first use order, rewrite indices
+# vb is list of attribute arrays, stride the encoded vertex size
+# return (new vb, new ib, stats dict)
+def optimize_vertex_fetch(vb, ib, vertex_count, stride):
+    before = overfetch(ib, vertex_count, stride)
+    (order, remap) = fetch_order(ib, vertex_count)
+    vb = [col[order] for col in vb]
+    ib = [remap[tris] for tris in ib]
+    stats = {
+        "overfetch_before": before,
+        "overfetch": overfetch(ib, vertex_count, stride),
+    }
+    return (vb, ib, stats)
+
+# every optimization asked for, in order (cache first, fetch after)
+# return (vb, ib, stats dict)
+def optimize_leaf(vb, ib, vertex_count, stride, cache_size=0, reorder_fetch=False):
+    stats = {}
+    if cache_size > 0:
+        (ib, cache_stats) = optimize_vertex_cache(ib, vertex_count, cache_size)
+        stats.update(cache_stats)
+    if reorder_fetch:
+        (vb, ib, fetch_stats) = optimize_vertex_fetch(vb, ib, vertex_count, stride)
+        stats.update(fetch_stats)
+    return (vb, ib, stats)
@@ -0,0 +1,189 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from . import extract
+from . import layout
+from . import optimize
+from . import meshlet
+from . import simplify
+from . import instrument
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # python < 3.8 (blender < 2.93), no parallel export then
+    shared_memory = None
+
+"""
+Author: Bowie
+Process pool for leaf extraction + encoding
+
+The source snapshot arrays are copied once into shared memory blocks,
+workers map them back as numpy views and run extract + encode on the
+leaf triangles they're handed. No bpy in the workers at all, they only
+ever import extract/layout/welder/optimize/meshlet/simplify/instrument/parallel.
+
+Importing a submodule normally runs the package __init__ first, which
+pulls in bpy. So each worker starts by registering a bare package module
+(see BOOTSTRAP) pointing at this directory, which makes the submodules
+importable without it. The bootstrap runs through the builtin exec, as
+the pool initializer itself has to be importable without the package.
+
+Results come back through ProcessPoolExecutor.map, so they're in leaf
+order and the file is identical to the serial one.
+"""
+
+BOOTSTRAP = """
+import sys, types
+if pkg not in sys.modules:
+    m = types.ModuleType(pkg)
+    m.__path__ = [path]
+    sys.modules[pkg] = m
+"""
+
+# arrays of a snapshot that workers need (uvs are shared separately)
+SNAPSHOT_ARRAYS = (
+    "positions", "loop_vertex", "normals", "tangents", "bitangents",
+    "bitangent_signs", "tri_loops", "tri_material",
+)
+
+def available():
+    return shared_memory is not None
+
+# how many workers for a requested count (0 = all cores)
+def worker_count(workers):
+    if workers <= 0:
+        return os.cpu_count() or 1
+    return workers
+
+# parent side: copy of a snapshot's arrays in shared memory
+class SharedSnapshot:
+    def __init__(self, snapshot):
+        self.blocks = []
+        self.desc = {
+            "name": snapshot.name,
+            "materials": len(snapshot.materials),
+            "arrays": {},
+            "uvs": [],
+        }
+        for name in SNAPSHOT_ARRAYS:
+            a = getattr(snapshot, name)
+            if a is not None:
+                self.desc["arrays"][name] = self.share(a)
+        for uv in snapshot.uvs:
+            self.desc["uvs"].append(self.share(uv))
+
+    # return (block name, shape, dtype) of the shared copy
+    def share(self, a):
+        a = np.ascontiguousarray(a)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, a.nbytes))
+        np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)[...] = a
+        self.blocks.append(shm)
+        return (shm.name, a.shape, a.dtype.str)
+
+    def close(self):
+        for shm in self.blocks:
+            shm.close()
+            shm.unlink()
+        self.blocks = []
+
+# worker side: snapshot look alike over the shared memory views
+class SnapshotView:
+    def __init__(self, desc):
+        self.blocks = []
+        self.name = desc["name"]
+        # extraction only needs the material count
+        self.materials = [None] * desc["materials"]
+        self.tangents = None
+        self.bitangents = None
+        self.bitangent_signs = None
+        for (name, spec) in desc["arrays"].items():
+            setattr(self, name, self.attach(spec))
+        self.uvs = [self.attach(spec) for spec in desc["uvs"]]
+
+    def attach(self, spec):
+        (shm_name, shape, dtype) = spec
+        shm = shared_memory.SharedMemory(name=shm_name)
+        self.blocks.append(shm)
+        return np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+# per worker process
+_view = None
+
+# worker entry: extract (lods, optimize, meshlets, encode) one leaf
+# task is (snapshot desc, leaf triangles, vertex format, weld tolerances, encode?,
+#          vertex cache size, reorder fetch?, meshlet limits, lod ratios)
+# return dict of the LeafBuffer fields it filled (+ stage timings)
+def process_leaf(task):
+    global _view
+    (desc, tris, format, tolerances, encode, cache_size, reorder_fetch, meshlet_limits, lod_ratios) = task
+
+    if _view is None:
+        _view = SnapshotView(desc)
+
+    # timings only, the parent sums them up
+    inst = instrument.Instrument(instrument.ERROR)
+    with inst.stage("extract"):
+        (vb, ib) = extract.extract_arrays(_view, tris, format, tolerances)
+    vcount = len(vb[0]) if len(vb) else 0
+    index_size = layout.index_size(vcount)
+    r = {
+        "lods": None, "stats": None, "meshlets": None,
+        "vertex_bytes": None, "index_bytes": None, "meshlet_bytes": None,
+    }
+    if lod_ratios:
+        with inst.stage("lods"):
+            r["lods"] = simplify.leaf_lods(vb, ib, format, lod_ratios)
+    if cache_size > 0 or reorder_fetch:
+        with inst.stage("optimize"):
+            (vb, ib, r["stats"]) = optimize.optimize_leaf(vb, ib, vcount, layout.vertex_dtype(format).itemsize, cache_size, reorder_fetch)
+    if meshlet_limits is not None:
+        with inst.stage("meshlets"):
+            r["meshlets"] = meshlet.leaf_meshlets(vb, ib, format, meshlet_limits)
+    if encode:
+        with inst.stage("encode"):
+            r["vertex_bytes"] = layout.encode_vertices(vb, format)
+            r["index_bytes"] = layout.encode_indices(ib, index_size)
+            if r["meshlets"] is not None:
+                r["meshlet_bytes"] = meshlet.encode_meshlets(r["meshlets"], index_size)
+    r["vb"] = vb
+    r["ib"] = ib
+    r["timings"] = inst.stages
+    return r
+
+class LeafPool:
+    def __init__(self, snapshot, workers=0, executable=None):
+        self.shared = SharedSnapshot(snapshot)
+        self.workers = worker_count(workers)
+
+        # spawn, workers must not inherit blender's state
+        ctx = multiprocessing.get_context("spawn")
+        if executable:
+            ctx.set_executable(executable)
+
+        pkg = __name__.rpartition(".")[0]
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=ctx,
+            initializer=exec,
+            initargs=(BOOTSTRAP, {"pkg": pkg, "path": os.path.dirname(os.path.abspath(__file__))}),
+        )
+
+    # run leaves (list of triangle index arrays), results in leaf order
+    def map(self, leaf_tris, format, tolerances=None, encode=True, cache_size=0, reorder_fetch=False, meshlet_limits=None, lod_ratios=None):
+        desc = self.shared.desc
+        tasks = [(desc, tris, format, tolerances, encode, cache_size, reorder_fetch, meshlet_limits, lod_ratios) for tris in leaf_tris]
+        chunk = max(1, len(tasks) // (self.workers * 4))
+        return self.executor.map(process_leaf, tasks, chunksize=chunk)
+
+    # cancel drops the leaves no worker started yet (cancelled export)
+    def close(self, cancel=False):
+        if cancel:
+            try:
+                self.executor.shutdown(wait=True, cancel_futures=True)
+            except TypeError:
+                # python < 3.9, waits for all of them
+                self.executor.shutdown(wait=True)
+        else:
+            self.executor.shutdown(wait=True)
+        self.shared.close()
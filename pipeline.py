@@ -0,0 +1,328 @@
+from . import exporter
+from . import parallel
+from . import layout
+from . import optimize
+from . import meshlet
+from . import simplify
+from . import cache as leafcache
+from . import instrument
+from .instrument import log, stage, TRACE
+
+"""
+Author: Bowie
+Leaf processing pipeline
+
+Every good leaf goes through the stages exactly once:
+ - extract: split the leaf triangles out of the source snapshot and weld
+   them into a vertex buffer + per material index buffers
+ - lods (optional): simplified copies of the extracted leaf, one per LOD
+   ratio (see simplify.py), kept by node until the interior nodes need
+   them
+ - optimize (optional): reorder the triangles of every submesh for the
+   post-transform vertex cache, then (optional) renumber the vertices in
+   first use order for fetch locality (see optimize.py)
+ - meshlets (optional): cluster the triangles of every submesh (see
+   meshlet.py)
+ - encode: turn those into the bytes wb_mesh_data writes
+
+The result is a LeafBuffer, which both the ascii and the binary writer
+consume, so nothing gets extracted twice. The counters prove it.
+
+LOD meshes come out of lodLeaves once every leaf went through, interior
+nodes are simplified bottom up from their children's chains, and every
+LOD mesh goes through the stages after extraction like a leaf does.
+
+With workers > 1 both stages run in a process pool (see parallel.py),
+results still come out in leaf order.
+
+Every stage is timed and leaves are counted through instrument.py, stages
+run in the pool come back as summed worker.<stage> times.
+
+With a LeafCache (see cache.py) leaves whose inputs hash to a stored
+entry are loaded instead, only the rest go through the stages (and get
+stored). Cached leaves count as "cached" instead of "extracted".
+"""
+
+# optimize stats as "name(before -> after)" pairs
+def format_stats(stats):
+    parts = []
+    for name in ("acmr", "atvr", "overfetch"):
+        if name in stats:
+            parts.append("%s(%.3f -> %.3f)" % (name, stats[name + "_before"], stats[name]))
+    return " ".join(parts)
+
+# one processed leaf: extracted buffers + their encoded bytes
+class LeafBuffer:
+    def __init__(self, node, vb, ib):
+        self.node = node
+        # vb: list of attribute arrays, ib: list of [tri_count x 3] per material
+        self.vb = vb
+        self.ib = ib
+        self.vertex_count = len(vb[0]) if len(vb) else 0
+        self.triangle_count = sum(len(ids) for ids in ib)
+
+        # u16 indices unless there are too many vertices
+        self.index_size = layout.index_size(self.vertex_count)
+
+        # (start, num_elems) per submesh, start being the byte offset
+        # into the index buffer
+        self.submeshes = []
+        offset = 0
+        for ids in ib:
+            elem_count = len(ids) * 3
+            self.submeshes.append((offset, elem_count))
+            offset += elem_count * self.index_size
+
+        # filled by the optimize stage
+        self.stats = None
+
+        # (level, error) if this is a LOD mesh of node
+        self.lod = None
+
+        # filled by the meshlet stage
+        self.meshlets = None
+
+        # filled by the encode stage
+        self.vertex_bytes = None
+        self.index_bytes = None
+        self.meshlet_bytes = None
+
+    def isEncoded(self):
+        return self.vertex_bytes is not None
+
+class LeafPipeline:
+    # cache_size 0 = no vertex cache optimization
+    # reorder_fetch renumbers vertices for fetch locality
+    # meshlet_limits (max vertices, max triangles), None = no meshlets
+    # lod_ratios triangle ratio per LOD level, None = no LODs
+    # cache is a cache.LeafCache, None = process every leaf
+    def __init__(self, snapshot, format, tolerances=None, use_temp_mesh=False, encode=True, workers=1, executable=None, cache_size=0, reorder_fetch=False, meshlet_limits=None, lod_ratios=None, cache=None):
+        self.snapshot = snapshot
+        self.format = format
+        self.tolerances = tolerances
+        self.use_temp_mesh = use_temp_mesh
+        self.encode_leaves = encode
+        self.cache_size = cache_size
+        self.reorder_fetch = reorder_fetch
+        self.meshlet_limits = meshlet_limits
+        self.lod_ratios = list(lod_ratios) if lod_ratios else None
+        self.stride = layout.vertex_dtype(format).itemsize
+        # process pool only works on snapshot arrays, not temp meshes
+        self.workers = parallel.worker_count(workers)
+        if use_temp_mesh or not parallel.available():
+            self.workers = 1
+        self.executable = executable
+        self.cache = cache
+
+        self.counters = {
+            "leaves": 0,
+            "extracted": 0,
+            "encoded": 0,
+            "optimized": 0,
+            "meshlets": 0,
+            "lods": 0,
+            "cached": 0,
+        }
+        # summed optimize stats of all leaves
+        self.stats = {}
+        # extraction count per node, to catch double work
+        self._extracted = {}
+        # LOD chain (list of (vb, ib, error)) per node
+        self.lods = {}
+
+    # stage 1: split + extract
+    def extract(self, node):
+        with stage("extract"):
+            (vb, ib) = exporter.extract_leaf(node, self.snapshot, self.format, self.tolerances, self.use_temp_mesh)
+        self.counters["extracted"] += 1
+        self._extracted[node] = self._extracted.get(node, 0) + 1
+        return LeafBuffer(node, vb, ib)
+
+    # stage 1b: LOD chain of a leaf
+    def buildLods(self, leaf):
+        with stage("lods"):
+            self.lods[leaf.node] = simplify.leaf_lods(leaf.vb, leaf.ib, self.format, self.lod_ratios)
+        return leaf
+
+    # stage 2: vertex cache + fetch optimization
+    def optimize(self, leaf):
+        with stage("optimize"):
+            (leaf.vb, leaf.ib, stats) = optimize.optimize_leaf(leaf.vb, leaf.ib, leaf.vertex_count, self.stride, self.cache_size, self.reorder_fetch)
+        self.addStats(leaf, stats)
+        return leaf
+
+    def isOptimizing(self):
+        return self.cache_size > 0 or self.reorder_fetch
+
+    # keep a leaf's optimize stats, sum them up for the summary
+    def addStats(self, leaf, stats):
+        leaf.stats = stats
+        if instrument.enabled(TRACE):
+            log(TRACE, "OPTIMIZE: node[%d] %s", leaf.node._id, format_stats(stats))
+        for (k, v) in stats.items():
+            self.stats[k] = self.stats.get(k, 0) + v
+        self.counters["optimized"] += 1
+
+    # stage 3: meshlets
+    def buildMeshlets(self, leaf):
+        with stage("meshlets"):
+            leaf.meshlets = meshlet.leaf_meshlets(leaf.vb, leaf.ib, self.format, self.meshlet_limits)
+        self.counters["meshlets"] += len(leaf.meshlets)
+        return leaf
+
+    # stage 4: encode
+    def encode(self, leaf):
+        with stage("encode"):
+            leaf.vertex_bytes = exporter.encode_vertices(leaf.vb, self.format)
+            leaf.index_bytes = exporter.encode_indices(leaf.ib, leaf.index_size)
+            if leaf.meshlets is not None:
+                leaf.meshlet_bytes = meshlet.encode_meshlets(leaf.meshlets, leaf.index_size)
+        self.counters["encoded"] += 1
+        return leaf
+
+    # every stage after extraction, leaves and LOD meshes alike
+    def finish(self, leaf):
+        if self.isOptimizing():
+            self.optimize(leaf)
+        if self.meshlet_limits is not None:
+            self.buildMeshlets(leaf)
+        if self.encode_leaves:
+            self.encode(leaf)
+        return leaf
+
+    # run a single leaf through every stage
+    def process(self, node):
+        leaf = self.extract(node)
+        if self.lod_ratios:
+            self.buildLods(leaf)
+        self.finish(leaf)
+        self.countLeaf(leaf)
+        return leaf
+
+    def countLeaf(self, leaf):
+        self.counters["leaves"] += 1
+        instrument.count("triangles", leaf.triangle_count)
+        instrument.count("vertices", leaf.vertex_count)
+
+    # process leaves in order
+    def run(self, nodes):
+        if self.cache is not None:
+            yield from self.runCached(nodes)
+            return
+        yield from self.runLeaves(nodes)
+
+    # every stage on every leaf, serial or in the pool
+    def runLeaves(self, nodes):
+        if self.workers > 1 and len(nodes) > 1:
+            yield from self.runParallel(nodes)
+            return
+        for n in nodes:
+            yield self.process(n)
+
+    # same as run, but extract + encode in the process pool
+    def runParallel(self, nodes):
+        pool = parallel.LeafPool(self.snapshot, self.workers, self.executable)
+        done = False
+        try:
+            results = pool.map([n.polys for n in nodes], self.format, self.tolerances, self.encode_leaves, self.cache_size, self.reorder_fetch, self.meshlet_limits, self.lod_ratios)
+            for (n, r) in zip(nodes, results):
+                self.counters["extracted"] += 1
+                self._extracted[n] = self._extracted.get(n, 0) + 1
+                yield self.fromResult(n, r)
+            done = True
+        finally:
+            # stopped early (cancelled, error), don't wait for the rest
+            pool.close(not done)
+
+    # LeafBuffer out of a result dict (see parallel.process_leaf)
+    def fromResult(self, node, r):
+        leaf = LeafBuffer(node, r["vb"], r["ib"])
+        if r["lods"] is not None:
+            self.lods[node] = r["lods"]
+        if r["stats"] is not None:
+            self.addStats(leaf, r["stats"])
+        if r["meshlets"] is not None:
+            leaf.meshlets = r["meshlets"]
+            self.counters["meshlets"] += len(leaf.meshlets)
+        if r["vertex_bytes"] is not None:
+            leaf.vertex_bytes = r["vertex_bytes"]
+            leaf.index_bytes = r["index_bytes"]
+            leaf.meshlet_bytes = r["meshlet_bytes"]
+            self.counters["encoded"] += 1
+        for (name, (calls, wall, cpu)) in r.get("timings", {}).items():
+            instrument.current().addTime("worker." + name, wall, cpu, calls)
+        self.countLeaf(leaf)
+        return leaf
+
+    # and back, for the cache
+    def toResult(self, leaf):
+        return {
+            "vb": leaf.vb, "ib": leaf.ib,
+            "lods": self.lods.get(leaf.node), "stats": leaf.stats, "meshlets": leaf.meshlets,
+            "vertex_bytes": leaf.vertex_bytes, "index_bytes": leaf.index_bytes, "meshlet_bytes": leaf.meshlet_bytes,
+        }
+
+    # everything besides the leaf's own data that changes what it turns into
+    def cacheOptions(self):
+        tolerances = sorted(self.tolerances.items()) if self.tolerances else None
+        meshlet_limits = tuple(self.meshlet_limits) if self.meshlet_limits is not None else None
+        lod_ratios = tuple(self.lod_ratios) if self.lod_ratios else None
+        return (tolerances, self.use_temp_mesh, self.cache_size, self.reorder_fetch, meshlet_limits, lod_ratios)
+
+    # same as run, but leaves already in the cache are loaded, only the
+    # misses get processed (all at once, so the pool still gets them)
+    def runCached(self, nodes):
+        options = self.cacheOptions()
+        keys = [leafcache.leaf_key(self.snapshot, n.polys, self.format, options) for n in nodes]
+        hits = self.cache.lookup(keys)
+        fresh = self.runLeaves([n for (n, hit) in zip(nodes, hits) if not hit])
+        for (n, key, hit) in zip(nodes, keys, hits):
+            r = self.cache.get(key) if hit else None
+            if r is not None:
+                self.counters["cached"] += 1
+                yield self.fromResult(n, r)
+                continue
+            # broken entries weren't in the batch, do them here
+            leaf = next(fresh) if not hit else self.process(n)
+            self.cache.put(key, self.toResult(leaf))
+            yield leaf
+
+    # LOD meshes of nodes (breadth first, leaves already run), every level
+    # of a node in a row, interior chains built bottom up on the way
+    def lodLeaves(self, nodes):
+        for n in reversed(nodes):
+            if n not in self.lods:
+                children = [self.lods.get(c) for c in n.children]
+                with stage("node_lods"):
+                    self.lods[n] = simplify.node_lods(children, self.format, self.lod_ratios)
+        for n in nodes:
+            for (level, (vb, ib, error)) in enumerate(self.lods[n]):
+                leaf = LeafBuffer(n, vb, ib)
+                leaf.lod = (level, error)
+                self.finish(leaf)
+                self.counters["lods"] += 1
+                yield leaf
+
+    # make sure every leaf went through extraction exactly once
+    def check(self):
+        twice = [k for (k, c) in self._extracted.items() if c != 1]
+        if len(twice) or self.counters["extracted"] + self.counters["cached"] != self.counters["leaves"]:
+            raise Exception("Leaf pipeline extracted %d leaves %d times!" % (
+                self.counters["leaves"], self.counters["extracted"]
+            ))
+
+    def summary(self):
+        msg = "leaves(%d) extracted(%d) encoded(%d) workers(%d)" % (
+            self.counters["leaves"], self.counters["extracted"], self.counters["encoded"], self.workers
+        )
+        if self.meshlet_limits is not None:
+            msg += ", meshlets(%d)" % self.counters["meshlets"]
+        if self.lod_ratios:
+            msg += ", lods(%d)" % self.counters["lods"]
+        if self.cache is not None:
+            msg += ", cached(%d)" % self.counters["cached"]
+        count = self.counters["optimized"]
+        if count:
+            avg = dict((k, v / count) for (k, v) in self.stats.items())
+            msg += ", avg %s" % format_stats(avg)
+        return msg
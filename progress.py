@@ -0,0 +1,124 @@
+import time, threading
+
+"""
+Author: Bowie
+Progress, cancellation and the background export thread, no bpy in here
+
+The modal operator snapshots the mesh on the main thread (bpy isn't
+thread safe), then hands the rest (tree build, leaf extraction, writing)
+to an ExportJob, which runs it in a thread on the snapshot arrays only.
+The writers step an ExportProgress per mesh block written, that's where
+a cancel lands: step() raises ExportCancelled, the writer removes the
+partial file on the way out.
+
+The job also stands in for the operator's report() (the operator can't
+be called from the thread), the modal timer replays the queued reports
+on the main thread.
+"""
+
+class ExportCancelled(Exception):
+    pass
+
+# shared between the export thread and the UI, plain fields are fine to
+# read from the other thread, they only ever get replaced
+class ExportProgress:
+    def __init__(self):
+        self.phase = "snapshot"
+        self.total = 0
+        self.done = 0
+        self.cancelled = False
+        self.phase_start = time.perf_counter()
+
+    # phases: snapshot, tree, meshes
+    def setPhase(self, phase, total=0):
+        self.check()
+        self.phase = phase
+        self.total = total
+        self.done = 0
+        self.phase_start = time.perf_counter()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def check(self):
+        if self.cancelled:
+            raise ExportCancelled("Export cancelled")
+
+    def step(self, count=1):
+        self.check()
+        self.done += count
+
+    # 0..1 over the whole export, the mesh phase being most of it
+    def fraction(self):
+        if self.phase != "meshes":
+            return 0.0 if self.phase == "snapshot" else 0.05
+        if self.total == 0:
+            return 1.0
+        return 0.05 + 0.95 * min(self.done / self.total, 1.0)
+
+    # seconds left in the mesh phase, None until there's a rate
+    def eta(self):
+        if self.phase != "meshes" or self.done == 0:
+            return None
+        elapsed = time.perf_counter() - self.phase_start
+        return elapsed / self.done * (self.total - self.done)
+
+    def status(self):
+        if self.phase != "meshes":
+            return "LMF export: %s..." % ("building tree" if self.phase == "tree" else "snapshotting")
+        msg = "LMF export: mesh %d/%d" % (self.done, self.total)
+        eta = self.eta()
+        if eta is not None:
+            msg += ", ETA %s" % format_seconds(eta)
+        return msg + " (Esc to cancel)"
+
+def format_seconds(seconds):
+    seconds = int(seconds + 0.5)
+    if seconds < 60:
+        return "%ds" % seconds
+    if seconds < 3600:
+        return "%dm%02ds" % (seconds // 60, seconds % 60)
+    return "%dh%02dm" % (seconds // 3600, seconds % 3600 // 60)
+
+# one export running in a thread
+class ExportJob:
+    def __init__(self):
+        self.progress = ExportProgress()
+        self.thread = None
+        self.result = None
+        self.error = None
+        self.lock = threading.Lock()
+        self.reports = []
+
+    # same as Operator.report, but queued for the main thread
+    def report(self, kind, msg):
+        with self.lock:
+            self.reports.append((kind, msg))
+
+    # reports queued since the last call
+    def takeReports(self):
+        with self.lock:
+            reports = self.reports
+            self.reports = []
+        return reports
+
+    def start(self, fn):
+        def run():
+            try:
+                self.result = fn()
+            except ExportCancelled:
+                self.result = {'CANCELLED'}
+            except Exception as e:
+                self.error = e
+                self.result = {'CANCELLED'}
+        self.thread = threading.Thread(target=run, name="lmf-export", daemon=True)
+        self.thread.start()
+
+    def cancel(self):
+        self.progress.cancel()
+
+    def isCancelled(self):
+        return self.progress.cancelled
+
+    def isDone(self):
+        return self.thread is not None and not self.thread.is_alive()
@@ -0,0 +1,265 @@
+import heapq
+import numpy as np
+from . import welder
+from .layout import VTF_POS
+
+"""
+Author: Bowie
+Quadric edge collapse simplification + LOD chains, no bpy in here
+
+simplify() works on the extracted buffers of a leaf (attribute arrays +
+index buffers per material). Every collapse moves a vertex onto one of
+its neighbours (no new positions, so normals/uvs stay valid), cheapest
+quadric error (Garland & Heckbert 1997) first. Vertices that can't move:
+ - seams: more than one vertex at the same position (uv/normal splits)
+ - borders: on an edge used by one triangle only, keeps the outline of
+   a node so neighbouring nodes still line up
+Collapses flipping a triangle are rejected. Stops at the target triangle
+count or when nothing can collapse anymore.
+
+LOD chains (ratios like [0.5, 0.25]):
+ - a leaf's LOD i is its own geometry simplified to ratios[i] of its
+   triangles
+ - an interior node's LOD i is its children's LOD i merged (and welded,
+   so the shared border opens up) then simplified by ratios[i] again
+So every level up the tree is another ratios[i] coarser, with 0.5 a node
+costs about as much as one of its children.
+
+The error of a LOD is an object space distance: the largest collapse
+cost it took, divided by the area the quadrics summed up (so the area
+weighted mean squared distance to the planes, like meshoptimizer), square
+rooted, including everything below it. Levels
+are simplified independently, so it's clamped to never shrink going
+down the chain either, a renderer can pick the first level under its
+screen space budget.
+"""
+
+# 4x4 plane quadrics of triangles, area weighted
+# return (quadrics, areas), areas being the weights
+def triangle_quadrics(positions, tris):
+    p = positions[tris]
+    n = np.cross(p[:, 1] - p[:, 0], p[:, 2] - p[:, 0])
+    area = np.linalg.norm(n, axis=1)
+    safe = np.where(area > 0, area, 1)
+    n = n / safe[:, None]
+    d = -(n * p[:, 0]).sum(axis=1)
+    plane = np.column_stack((n, d))
+    # |n| = 2 * area, weight by area
+    weight = area * 0.5
+    return (plane[:, :, None] * plane[:, None, :] * weight[:, None, None], weight)
+
+# vertices that must not move (seams + borders)
+def locked_vertices(positions, tris):
+    (_, pos_id) = np.unique(positions, axis=0, return_inverse=True)
+    pos_id = pos_id.ravel()
+    vcount = len(positions)
+
+    # seams, same position more than once
+    shared = np.bincount(pos_id)
+    locked = shared[pos_id] > 1
+
+    # borders, edges (on positions) used once
+    if len(tris):
+        e = pos_id[tris]
+        edges = np.concatenate((e[:, [0, 1]], e[:, [1, 2]], e[:, [2, 0]]))
+        edges.sort(axis=1)
+        (uniq, counts) = np.unique(edges, axis=0, return_counts=True)
+        border = np.zeros(shared.shape[0], dtype=bool)
+        border[uniq[counts == 1].ravel()] = True
+        locked |= border[pos_id]
+    return locked[:vcount]
+
+# symmetric quadric as its 10 unique entries
+QUADRIC_IDS = ((0, 0), (0, 1), (0, 2), (0, 3), (1, 1), (1, 2), (1, 3), (2, 2), (2, 3), (3, 3))
+
+# q^T Q q for q = (x, y, z, 1), Q as 10 unique entries (numpy, vectorized)
+def quadric_costs(Q, p):
+    (x, y, z) = (p[:, 0], p[:, 1], p[:, 2])
+    return (Q[:, 0]*x*x + 2*Q[:, 1]*x*y + 2*Q[:, 2]*x*z + 2*Q[:, 3]*x
+        + Q[:, 4]*y*y + 2*Q[:, 5]*y*z + 2*Q[:, 6]*y
+        + Q[:, 7]*z*z + 2*Q[:, 8]*z + Q[:, 9])
+
+# same, one (summed) quadric, plain floats
+def quadric_cost(a, b, p):
+    q = [a[i] + b[i] for i in range(10)]
+    (x, y, z) = p
+    return (q[0]*x*x + 2*q[1]*x*y + 2*q[2]*x*z + 2*q[3]*x
+        + q[4]*y*y + 2*q[5]*y*z + 2*q[6]*y
+        + q[7]*z*z + 2*q[8]*z + q[9])
+
+def cross(a, b):
+    return (a[1]*b[2] - a[2]*b[1], a[2]*b[0] - a[0]*b[2], a[0]*b[1] - a[1]*b[0])
+
+def tri_normal(p0, p1, p2):
+    return cross((p1[0]-p0[0], p1[1]-p0[1], p1[2]-p0[2]), (p2[0]-p0[0], p2[1]-p0[1], p2[2]-p0[2]))
+
+# simplify index buffers (list of [tri_count x 3] per material) over
+# positions [vertex_count x 3] down to target triangles
+# return (list of [n x 3] per material, error)
+def simplify_indices(positions, ib, target):
+    positions = np.asarray(positions, dtype=np.float64)
+    mats = np.concatenate([np.full(len(t), m, dtype=np.int64) for (m, t) in enumerate(ib)]) if len(ib) else np.zeros(0, dtype=np.int64)
+    tris = np.concatenate([t.reshape(-1, 3) for t in ib]).astype(np.int64) if len(ib) else np.zeros((0, 3), dtype=np.int64)
+    tri_count = len(tris)
+    if tri_count <= target or tri_count == 0:
+        return ([t.reshape(-1, 3) for t in ib], 0.0)
+
+    vcount = len(positions)
+    locked = locked_vertices(positions, tris)
+    (K, area) = triangle_quadrics(positions, tris)
+    Qn = np.zeros((vcount, 10))
+    for (i, (r, c)) in enumerate(QUADRIC_IDS):
+        np.add.at(Qn[:, i], tris.ravel(), np.repeat(K[:, r, c], 3))
+    # summed weight of every vertex quadric, turns a cost into a distance
+    Wn = np.zeros(vcount)
+    np.add.at(Wn, tris.ravel(), np.repeat(area, 3))
+
+    # every half edge u -> v, u not locked, costed at once
+    u = tris.ravel()
+    v = tris[:, [1, 2, 0]].ravel()
+    u = np.concatenate((u, v))
+    v = np.concatenate((v, tris.ravel()))
+    movable = ~locked[u]
+    (u, v) = (u[movable], v[movable])
+    costs = quadric_costs(Qn[u] + Qn[v], positions[v])
+    heap = list(zip(costs.tolist(), u.tolist(), v.tolist(), [0] * len(u), [0] * len(u)))
+    heapq.heapify(heap)
+
+    P = positions.tolist()
+    Q = Qn.tolist()
+    W = Wn.tolist()
+    locked = locked.tolist()
+    corners = tris.tolist()
+    alive = [True] * tri_count
+    vert_tris = [set() for _ in range(vcount)]
+    for (t, tri) in enumerate(corners):
+        for w in tri:
+            vert_tris[w].add(t)
+    version = [0] * vcount
+    removed = [False] * vcount
+
+    def push(a, b):
+        if locked[a] or a == b:
+            return
+        heapq.heappush(heap, (quadric_cost(Q[a], Q[b], P[b]), a, b, version[a], version[b]))
+
+    # would moving a onto b flip (or flatten) any triangle staying alive?
+    def flips(a, b):
+        for t in vert_tris[a]:
+            tri = corners[t]
+            if b in tri:
+                continue
+            p = [P[w] for w in tri]
+            before = tri_normal(p[0], p[1], p[2])
+            p[tri.index(a)] = P[b]
+            after = tri_normal(p[0], p[1], p[2])
+            if before[0]*after[0] + before[1]*after[1] + before[2]*after[2] <= 0:
+                return True
+        return False
+
+    error = 0.0
+    while tri_count > target and len(heap):
+        (cost, a, b, version_a, version_b) = heapq.heappop(heap)
+        if removed[a] or removed[b] or version[a] != version_a or version[b] != version_b:
+            continue
+        # still an edge?
+        if not (vert_tris[a] & vert_tris[b]):
+            continue
+        if flips(a, b):
+            continue
+
+        # collapse a into b, the queue stays ordered by the area
+        # weighted cost, the error is per unit area (squared distance)
+        weight = W[a] + W[b]
+        if weight > 0:
+            error = max(error, cost / weight)
+        Q[b] = [Q[b][i] + Q[a][i] for i in range(10)]
+        W[b] = weight
+        for t in vert_tris[a]:
+            tri = corners[t]
+            if b in tri:
+                # degenerate now, gone
+                alive[t] = False
+                tri_count -= 1
+                for w in tri:
+                    if w != a:
+                        vert_tris[w].discard(t)
+            else:
+                tri[tri.index(a)] = b
+                vert_tris[b].add(t)
+        vert_tris[a] = set()
+        removed[a] = True
+        version[b] += 1
+
+        # new costs around b
+        neighbours = set()
+        for t in vert_tris[b]:
+            neighbours.update(corners[t])
+        neighbours.discard(b)
+        for w in neighbours:
+            push(b, w)
+            push(w, b)
+
+    out = np.array(corners, dtype=np.int64).reshape(-1, 3)
+    keep = np.array(alive, dtype=bool)
+    result = [out[keep & (mats == m)] for m in range(len(ib))]
+    return (result, float(np.sqrt(max(error, 0.0))))
+
+# drop unreferenced vertices, renumber indices
+def compact(vb, ib):
+    vcount = len(vb[0]) if len(vb) else 0
+    used = np.zeros(vcount, dtype=bool)
+    for t in ib:
+        used[t.ravel()] = True
+    remap = np.cumsum(used) - 1
+    return ([c[used] for c in vb], [remap[t] for t in ib])
+
+# simplify a leaf's buffers to ratio of its triangles
+# return (vb, ib, error)
+def simplify(vb, ib, format, ratio):
+    if not (format & VTF_POS):
+        raise Exception("LODs need positions in the vertex format!")
+    tri_count = sum(len(t) for t in ib)
+    target = int(tri_count * ratio)
+    # position is always the first attribute
+    (ib, error) = simplify_indices(vb[0], ib, target)
+    (vb, ib) = compact(vb, ib)
+    return (vb, ib, error)
+
+# merge (vb, ib) meshes of the same format, welding exact duplicates
+def merge(meshes):
+    meshes = [m for m in meshes if m is not None]
+    if len(meshes) == 1:
+        return meshes[0]
+    cols = [np.concatenate(c) for c in zip(*[m[0] for m in meshes])]
+    offset = 0
+    ibs = []
+    for (vb, ib) in meshes:
+        ibs.append([t + offset for t in ib])
+        offset += len(vb[0]) if len(vb) else 0
+    ib = [np.concatenate(ts) for ts in zip(*ibs)]
+    (first, remap) = welder.weldArrays(cols, None)
+    return ([c[first] for c in cols], [remap[t] for t in ib])
+
+# LOD chain of a leaf, list of (vb, ib, error) per ratio
+def leaf_lods(vb, ib, format, ratios):
+    lods = []
+    for r in ratios:
+        (lvb, lib, error) = simplify(vb, ib, format, r)
+        if len(lods):
+            error = max(error, lods[-1][2])
+        lods.append((lvb, lib, error))
+    return lods
+
+# LOD chain of an interior node from its children's chains (None for
+# children without geometry)
+def node_lods(children, format, ratios):
+    lods = []
+    for (i, r) in enumerate(ratios):
+        parts = [(c[i][0], c[i][1]) for c in children if c is not None]
+        (vb, ib) = merge(parts)
+        (vb, ib, error) = simplify(vb, ib, format, r)
+        # coarser than anything below it, and the level before
+        error = max([error] + [c[i][2] for c in children if c is not None] + [l[2] for l in lods[-1:]])
+        lods.append((vb, ib, error))
+    return lods
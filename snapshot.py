@@ -0,0 +1,247 @@
+import numpy as np
+from .instrument import log, WARN
+from .tangents import loop_tangents
+
+"""
+Author: Bowie
+Bulk snapshot of a blender mesh into contiguous numpy arrays
+
+Everything is pulled once through foreach_get, so the hot paths
+(tree build, split, extraction) never touch RNA per element again.
+Positions, normals, tangents and bitangents are already converted
+into the exported Y-up space: (x, y, z) -> (x, z, -y)
+
+Arrays:
+ - positions        [vert_count x 3] float32
+ - loop_vertex      [loop_count] int32
+ - normals          [loop_count x 3] float32 (split normals)
+ - tangents         [loop_count x 3] float32 (None if not computed)
+ - bitangents       [loop_count x 3] float32 (None if not computed)
+ - bitangent_signs  [loop_count] float32 (None if not computed)
+ - uvs              list of [loop_count x 2] float32, one per uv layer
+ - tri_loops        [tri_count x 3] int32 (loop indices of loop triangles)
+ - tri_material     [tri_count] int32
+
+Tangents come from one calc_tangents on the whole mesh, leaves (and the
+temp mesh fallback) slice them by loop index. Meshes calc_tangents
+refuses (ngons) get them from tangents.py on the loop triangles instead.
+"""
+
+# convert blender space into Y-up space, in place
+def to_yup(a):
+    y = a[:, 1].copy()
+    a[:, 1] = a[:, 2]
+    a[:, 2] = -y
+    return a
+
+# convert back Y-up space into blender space (returns new array)
+def to_blender(a):
+    b = np.empty_like(a)
+    b[:, 0] = a[:, 0]
+    b[:, 1] = -a[:, 2]
+    b[:, 2] = a[:, 1]
+    return b
+
+# grab a float vector attribute of a collection
+def get_floats(collection, attr, count, width=1):
+    buf = np.empty(count * width, dtype=np.float32)
+    collection.foreach_get(attr, buf)
+    if width > 1:
+        buf.shape = (count, width)
+    return buf
+
+# grab an int attribute of a collection
+def get_ints(collection, attr, count, width=1):
+    buf = np.empty(count * width, dtype=np.int32)
+    collection.foreach_get(attr, buf)
+    if width > 1:
+        buf.shape = (count, width)
+    return buf
+
+class MeshSnapshot:
+    # mesh None makes an empty one for merge_snapshots to fill
+    def __init__(self, mesh, tangents=True):
+        if mesh is None:
+            self.clear()
+            return
+        m = mesh
+        self.name = m.name
+        self.materials = list(m.materials)
+
+        # make sure loop triangles and split normals are there
+        m.calc_loop_triangles()
+        has_tangents = tangents and len(m.uv_layers) > 0
+        bulk_tangents = False
+        if has_tangents:
+            try:
+                # also computes split normals
+                m.calc_tangents()
+                bulk_tangents = True
+            except RuntimeError as e:
+                # only tris + quads in there, numpy does the rest below
+                log(WARN, "SNAPSHOT: calc_tangents failed on %s (%s), computing them in numpy", m.name, e)
+                m.calc_normals_split()
+        else:
+            m.calc_normals_split()
+
+        vcount = len(m.vertices)
+        lcount = len(m.loops)
+        tcount = len(m.loop_triangles)
+
+        self.positions = to_yup(get_floats(m.vertices, "co", vcount, 3))
+        self.loop_vertex = get_ints(m.loops, "vertex_index", lcount)
+        self.normals = to_yup(get_floats(m.loops, "normal", lcount, 3))
+
+        self.uvs = []
+        for l in m.uv_layers:
+            self.uvs.append(get_floats(l.data, "uv", lcount, 2))
+
+        self.tri_loops = get_ints(m.loop_triangles, "loops", tcount, 3)
+        self.tri_material = get_ints(m.loop_triangles, "material_index", tcount)
+
+        self.tangents = None
+        self.bitangents = None
+        self.bitangent_signs = None
+        if bulk_tangents:
+            self.tangents = to_yup(get_floats(m.loops, "tangent", lcount, 3))
+            self.bitangents = to_yup(get_floats(m.loops, "bitangent", lcount, 3))
+            self.bitangent_signs = get_floats(m.loops, "bitangent_sign", lcount)
+        elif has_tangents:
+            self.computeTangents()
+
+    def clear(self):
+        self.name = ""
+        self.materials = []
+        self.positions = np.zeros((0, 3), dtype=np.float32)
+        self.loop_vertex = np.zeros(0, dtype=np.int32)
+        self.normals = np.zeros((0, 3), dtype=np.float32)
+        self.tangents = None
+        self.bitangents = None
+        self.bitangent_signs = None
+        self.uvs = []
+        self.tri_loops = np.zeros((0, 3), dtype=np.int32)
+        self.tri_material = np.zeros(0, dtype=np.int32)
+
+    # tangent frames of every loop out of the arrays (first uv layer)
+    def computeTangents(self):
+        (self.tangents, self.bitangents, self.bitangent_signs) = loop_tangents(
+            self.positions, self.loop_vertex, self.normals, self.uvs[0], self.tri_loops
+        )
+
+    # tangent arrays of another snapshot, by its loop index per loop here
+    def sliceTangents(self, source, loops):
+        if source.tangents is None:
+            return
+        self.tangents = source.tangents[loops]
+        self.bitangents = source.bitangents[loops]
+        self.bitangent_signs = source.bitangent_signs[loops]
+
+    def triCount(self):
+        return len(self.tri_loops)
+
+    # vertex (position) indices of triangles
+    def triVertices(self, tris=None):
+        if tris is None:
+            return self.loop_vertex[self.tri_loops]
+        return self.loop_vertex[self.tri_loops[tris]]
+
+    # [tri_count x 3 x 3] triangle corner positions
+    def triPositions(self, tris=None):
+        return self.positions[self.triVertices(tris)]
+
+# blender space -> Y-up space, as a matrix
+YUP = np.array([[1, 0, 0], [0, 0, 1], [0, -1, 0]], dtype=np.float64)
+
+# Y-up version of a blender space 4x4 (world) matrix
+def matrix_to_yup(matrix):
+    m = np.asarray(matrix, dtype=np.float64).reshape(4, 4)
+    out = np.eye(4)
+    out[:3, :3] = YUP @ m[:3, :3] @ YUP.T
+    out[:3, 3] = YUP @ m[:3, 3]
+    return out
+
+def normalized(a):
+    l = np.linalg.norm(a, axis=1, keepdims=True)
+    return a / np.where(l > 0, l, 1)
+
+# apply a blender space 4x4 matrix to a snapshot, in place
+# normals get the inverse transpose, mirroring matrices flip the winding
+# (and the bitangent sign) so faces still point out
+def transform(snapshot, matrix):
+    snap = snapshot
+    m = matrix_to_yup(matrix)
+    linear = m[:3, :3]
+    if np.allclose(m, np.eye(4)):
+        return snap
+    snap.positions = (snap.positions @ linear.T + m[:3, 3]).astype(np.float32)
+    normal_matrix = np.linalg.inv(linear).T
+    snap.normals = normalized(snap.normals @ normal_matrix.T).astype(np.float32)
+    if snap.tangents is not None:
+        snap.tangents = normalized(snap.tangents @ linear.T).astype(np.float32)
+        snap.bitangents = normalized(snap.bitangents @ linear.T).astype(np.float32)
+    if np.linalg.det(linear) < 0:
+        snap.tri_loops = snap.tri_loops[:, [0, 2, 1]]
+        if snap.bitangent_signs is not None:
+            snap.bitangent_signs = -snap.bitangent_signs
+    return snap
+
+# merge snapshots into one, list of (snapshot, world matrix or None,
+# materials or None), materials being what the snapshot's material
+# indices point at (object material slots). Same materials end up as one
+# submesh, objects without materials share a None one
+def merge_snapshots(parts, name, tangents=True):
+    out = MeshSnapshot(None)
+    out.name = name
+    if len(parts) == 0:
+        return out
+
+    snaps = []
+    remaps = []
+    for (snap, matrix, materials) in parts:
+        if matrix is not None:
+            transform(snap, matrix)
+        if materials is None:
+            materials = snap.materials
+        if len(materials) == 0:
+            materials = [None]
+        # local slot -> merged material
+        remap = []
+        for mat in materials:
+            if mat not in out.materials:
+                out.materials.append(mat)
+            remap.append(out.materials.index(mat))
+        snaps.append(snap)
+        remaps.append(np.array(remap, dtype=np.int32))
+
+    vert_offsets = np.cumsum([0] + [len(s.positions) for s in snaps])
+    loop_offsets = np.cumsum([0] + [len(s.loop_vertex) for s in snaps])
+    out.positions = np.concatenate([s.positions for s in snaps])
+    out.loop_vertex = np.concatenate([s.loop_vertex + vert_offsets[i] for (i, s) in enumerate(snaps)]).astype(np.int32)
+    out.normals = np.concatenate([s.normals for s in snaps])
+    out.tri_loops = np.concatenate([s.tri_loops + loop_offsets[i] for (i, s) in enumerate(snaps)]).astype(np.int32)
+    # material indices past the slots use the last one, like blender
+    out.tri_material = np.concatenate([r[np.clip(s.tri_material, 0, len(r) - 1)] for (s, r) in zip(snaps, remaps)]).astype(np.int32)
+
+    # objects missing a uv layer (or tangents) get zeros there
+    layer_count = max(len(s.uvs) for s in snaps)
+    for layer in range(layer_count):
+        missing = sum(1 for s in snaps if layer >= len(s.uvs))
+        if missing:
+            log(WARN, "MERGE: %d of %d objects have no uv layer %d, zero filled", missing, len(snaps), layer)
+        out.uvs.append(np.concatenate([
+            s.uvs[layer] if layer < len(s.uvs) else np.zeros((len(s.loop_vertex), 2), dtype=np.float32)
+            for s in snaps
+        ]))
+    if tangents and any(s.tangents is not None for s in snaps):
+        missing = sum(1 for s in snaps if s.tangents is None)
+        if missing:
+            log(WARN, "MERGE: %d of %d objects have no tangents, zero filled", missing, len(snaps))
+        def column(attr, shape):
+            return np.concatenate([
+                getattr(s, attr) if getattr(s, attr) is not None else np.zeros((len(s.loop_vertex),) + shape, dtype=np.float32)
+                for s in snaps
+            ])
+        out.tangents = column("tangents", (3,))
+        out.bitangents = column("bitangents", (3,))
+        out.bitangent_signs = column("bitangent_signs", ())
+    return out
@@ -0,0 +1,102 @@
+import numpy as np
+
+"""
+Author: Bowie
+Per loop tangent frames in numpy, no bpy in here
+
+Same recipe as mikktspace (what blender's calc_tangents runs), over the
+whole mesh at once instead of per face:
+ - per triangle tangent direction out of the uv derivatives, handedness
+   from the sign of the uv area (mikktspace's orientation)
+ - per corner: projected onto the corner normal's plane, normalized and
+   weighted by the corner angle
+ - corners sharing vertex, normal, uv and handedness sum up (mikktspace
+   welds those the same way), so split uvs/normals keep their own frame
+ - Gram-Schmidt against the normal, bitangent = sign * cross(normal,
+   tangent), same convention as blender's loop.bitangent
+
+Not bit exact with mikktspace, that one also splits groups whose tangents
+diverge too much and patches degenerate triangles from their neighbours,
+here those get an arbitrary tangent perpendicular to the normal.
+"""
+
+# uv area below this is a degenerate mapping
+UV_EPSILON = 1e-12
+
+def normalize_rows(a):
+    length = np.linalg.norm(a, axis=-1, keepdims=True)
+    return a / np.where(length > 0, length, 1.0)
+
+# some unit vector perpendicular to every normal
+def any_perpendicular(n):
+    # cross with the axis the normal is least aligned with
+    axis = np.zeros_like(n)
+    axis[np.arange(len(n)), np.argmin(np.abs(n), axis=1)] = 1
+    return normalize_rows(np.cross(n, axis))
+
+# angle at every corner of [tri_count x 3 x 3] corner positions
+def corner_angles(p):
+    a = normalize_rows(np.roll(p, -1, axis=1) - p)
+    b = normalize_rows(np.roll(p, 1, axis=1) - p)
+    return np.arccos(np.clip((a * b).sum(axis=2), -1, 1))
+
+# tangents, bitangents [loop_count x 3] and bitangent signs [loop_count],
+# all float32, in whatever space positions and normals are in
+def loop_tangents(positions, loop_vertex, normals, uv, tri_loops):
+    lcount = len(loop_vertex)
+    tangents = np.zeros((lcount, 3), dtype=np.float32)
+    bitangents = np.zeros((lcount, 3), dtype=np.float32)
+    signs = np.ones(lcount, dtype=np.float32)
+    if len(tri_loops) == 0:
+        return (tangents, bitangents, signs)
+
+    corners = tri_loops.ravel()
+    p = positions[loop_vertex[tri_loops]].astype(np.float64)
+    t = uv[tri_loops].astype(np.float64)
+    n = normals[corners].astype(np.float64)
+
+    # tangent of every triangle, along +u
+    e1 = p[:, 1] - p[:, 0]
+    e2 = p[:, 2] - p[:, 0]
+    d1 = t[:, 1] - t[:, 0]
+    d2 = t[:, 2] - t[:, 0]
+    area = d1[:, 0] * d2[:, 1] - d2[:, 0] * d1[:, 1]
+    degenerate = np.abs(area) <= UV_EPSILON
+    sdir = (e1 * d2[:, 1:2] - e2 * d1[:, 1:2]) / np.where(degenerate, 1.0, area)[:, None]
+    sdir[degenerate] = 0
+    orient = np.where(area > 0, 1, -1).astype(np.int8)
+
+    # per corner, in the normal's plane, angle weighted
+    s = np.repeat(sdir, 3, axis=0)
+    s = normalize_rows(s - n * (s * n).sum(axis=1, keepdims=True))
+    s *= corner_angles(p).reshape(-1, 1)
+
+    # weld corners the way mikktspace does, sum per group
+    key = np.empty(len(corners), dtype=[("v", "i4"), ("n", "f4", 3), ("uv", "f4", 2), ("o", "i1")])
+    key["v"] = loop_vertex[corners]
+    key["n"] = normals[corners]
+    key["uv"] = uv[corners]
+    key["o"] = np.repeat(orient, 3)
+    (_, group) = np.unique(key.view("V%d" % key.dtype.itemsize), return_inverse=True)
+    group = group.ravel()
+    sums = np.zeros((group.max() + 1, 3))
+    for axis in range(3):
+        sums[:, axis] = np.bincount(group, s[:, axis], minlength=len(sums))
+
+    # Gram-Schmidt, zero sums (all degenerate) get any perpendicular
+    tan = sums[group]
+    tan -= n * (tan * n).sum(axis=1, keepdims=True)
+    length = np.linalg.norm(tan, axis=1)
+    tan = normalize_rows(tan)
+    bad = length <= UV_EPSILON
+    if bad.any():
+        tan[bad] = any_perpendicular(n[bad])
+
+    sign = np.repeat(orient, 3).astype(np.float64)
+    bitan = np.cross(n, tan) * sign[:, None]
+
+    # a loop shared by triangles of one face gets the same frame from each
+    tangents[corners] = tan
+    bitangents[corners] = bitan
+    signs[corners] = sign
+    return (tangents, bitangents, signs)
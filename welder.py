@@ -0,0 +1,95 @@
+"""
+Author: Bowie
+Vertex welding, shared by the exporter and the split mesh builder
+
+A vertex is a list of attributes (position, normal, uv, ...), each
+attribute being a short list/tuple of floats. Unique vertices are found
+through a hash map keyed on the packed attribute tuple, so welding a
+leaf costs O(loops) instead of the old O(loops^2) list search.
+
+Each attribute can get a quantization tolerance, in which case its
+components are snapped to a grid of that size before hashing. That way
+near identical normals/uvs weld together. The first vertex seen for a
+key is the one that ends up in the vertex array.
+
+weldArrays does the same on numpy attribute columns (one row per loop),
+sorting the packed rows instead of hashing them one by one.
+"""
+import numpy as np
+
+class VertexWelder:
+    def __init__(self, tolerances=None):
+        # one tolerance per attribute (None/0 = exact match)
+        self.tolerances = tolerances
+        self.lookup = {}
+        self.vertices = []
+
+    # build hashable key out of vertex attributes
+    def key(self, vertex):
+        tols = self.tolerances
+        if not tols:
+            return tuple(tuple(a) for a in vertex)
+
+        k = []
+        for (a_id, a) in enumerate(vertex):
+            tol = tols[a_id] if a_id < len(tols) else None
+            if tol:
+                k.append(tuple(round(c / tol) for c in a))
+            else:
+                k.append(tuple(a))
+        return tuple(k)
+
+    # add vertex, return its (possibly existing) index
+    def add(self, vertex):
+        k = self.key(vertex)
+        v_idx = self.lookup.get(k)
+        if v_idx is None:
+            v_idx = len(self.vertices)
+            self.lookup[k] = v_idx
+            self.vertices.append(vertex)
+        return v_idx
+
+    def __len__(self):
+        return len(self.vertices)
+
+# weld list of vertices in one pass
+# return tuple of (unique vertices, remap) where remap[i] is the
+# index of input vertex i inside unique vertices
+def weldVertices(vertices, tolerances=None):
+    w = VertexWelder(tolerances)
+    remap = [w.add(v) for v in vertices]
+    return (w.vertices, remap)
+
+# weld numpy attribute columns, each [count x width], row i being vertex i
+# return tuple of (first, remap) where first holds the input row of
+# every unique vertex (in discovery order) and remap[i] is the index of
+# input row i inside them
+def weldArrays(columns, tolerances=None):
+    keys = []
+    for (a_id, a) in enumerate(columns):
+        a = np.asarray(a, dtype=np.float64)
+        if a.ndim == 1:
+            a = a.reshape(-1, 1)
+        tol = None
+        if tolerances and a_id < len(tolerances):
+            tol = tolerances[a_id]
+        if tol:
+            a = np.round(a / tol)
+        keys.append(a)
+    keys = np.hstack(keys)
+    # -0.0 and 0.0 are the same vertex
+    keys += 0.0
+
+    if len(keys) == 0:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+
+    # stable, so index is the first occurence of each key
+    (_, index, inverse) = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    # renumber in discovery order
+    order = np.argsort(index, kind='stable')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+
+    return (index[order], rank[inverse])